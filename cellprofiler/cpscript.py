@@ -3,6 +3,18 @@ try:
 except:
     IMAGE = 'Image'
 
+try:
+    from runscript_support import memo, parallel, regions, sparse
+except ImportError:
+    memo = parallel = regions = sparse = None
+
+parallel_map = parallel.parallel_map if parallel is not None else None
+
+try:
+    from runscript_support.readonly import writable
+except ImportError:
+    writable = None
+
 
 class __Image__(object):
     pixel_data = None
@@ -35,10 +47,20 @@ class __ConstantWrapper__(dict):
     pass
 
 def __reset__():
-    global images, objects, measurements, constants
+    global images, objects, measurements, constants, batch_size, \
+        image_numbers, derived, columns, tile, group_measurements
     images = __ImageWrapper__()
     objects = __ObjectWrapper__()
     measurements = __MeasurementWrapper__()
+    group_measurements = __MeasurementWrapper__()
     constants = __ConstantWrapper__()
+    batch_size = 1
+    image_numbers = None
+    columns = {}
+    tile = None
+    derived = None
+    if memo is not None:
+        derived = memo.DerivedDataCache(images.__getitem__,
+                                        objects.__getitem__)
 
 __reset__()
@@ -2,6 +2,81 @@
 <hr>
 This module allows you to write small python scripts that are run as part
 of the CellProfiler pipeline.
+<p>By default the whole script is run for each image set. If the script
+defines a function <i>run()</i>, the body of the script and an optional
+function <i>setup()</i> are only run once and <i>run()</i> is called for
+each image set. This avoids repeating expensive imports or the loading of
+models. <i>run()</i> can return a dictionary with the output variables.
+The inputs have to be accessed through the <i>cpscript</i> module, e.g.
+<i>cpscript.images['DNA']</i>, inside of <i>run()</i>.</p>
+<p><i>cpscript.regions.label_statistics(labels, image)</i> computes the
+pixel count, centroid, bounding box and the intensity sum, mean, variance,
+minimum and maximum of all objects in one pass. Each statistic is an array
+with one element per object number.</p>
+<p><i>cpscript.parallel_map(func, objects, image)</i> calls
+<i>func(number, mask, pixel_data)</i> for the crop of each object in a pool
+of threads, or of forked processes with <i>processes=True</i>, and returns
+the results as an array ordered by object number.</p>
+<p><i>cpscript.sparse</i> converts objects into sparse forms whose size
+depends on the number of object pixels instead of the image area:
+<i>ijv(objects)</i> returns the row, column and object number of each
+pixel, <i>pixel_indices(objects)</i> the flat pixel indices of each object
+and <i>rle(objects)</i> the horizontal runs of pixels. Output objects can
+be created from these forms with <i>from_ijv(ijv, shape)</i> and
+<i>from_rle(runs, shape)</i>.</p>
+<p><i>cpscript.derived</i> computes data like <i>label_indexes('Nuclei')</i>,
+<i>find_objects('Nuclei')</i>, <i>mask('Nuclei')</i>, <i>ijv('Nuclei')</i> or
+<i>label_sums('Nuclei', 'DNA')</i> only once per image set and shares them
+between all RunScript modules. The data is computed again if the objects
+or images have been replaced. Its arrays are read-only, use
+<i>cpscript.writable(array)</i> for a copy that can be changed.</p>
+<p>Very large images can be processed in tiles. The script is then run for
+each tile on windows of the inputs that include a halo around the tile.
+<i>cpscript.tile</i> describes the tile, e.g. <i>cpscript.tile.inner</i> are
+the slices of the window without the halo. Output images are assembled
+from the tiles, objects are taken from the tile that contains their
+centroid and renumbered, and object measurements must have one value per
+object number of the window.</p>
+<p>Many object measurements can be output as one table. The script
+declares the columns of the table with a list of names or (name, type)
+tuples, e.g. <i>cpscript.columns['features'] = ['Area', ('Count',
+'integer')]</i>, and sets the variable <i>features</i> to a NumPy
+structured array or a dictionary with one array per column. Each column is
+stored as a measurement of the category of the output table. The list has
+to be a literal so that the columns are known before the script is
+run.</p>
+<p><i>cpscript.measurements.history('Image_Intensity_MeanIntensity_DNA')</i>
+returns a measurement of the image sets of the current group that have
+been processed so far, including the current one, as one array, e.g. to
+correct a drift of the background. Object measurements are concatenated;
+<i>with_image_numbers=True</i> also returns the image set number of each
+value. The history is only available when the script is run in the
+CellProfiler process one image set at a time. In a pool of worker
+processes, in batches and in tiles <i>history()</i> raises a
+RuntimeError.</p>
+<p>Measurements of a whole group, e.g. normalized by the plate or flagged
+as outliers, are computed by a function <i>post_group()</i> of a script
+with a <i>run()</i> function. It is called after all image sets of the
+group have been processed. <i>cpscript.group_measurements[key]</i> returns
+a measurement of all image sets of the group as one array and
+<i>cpscript.image_numbers</i> the image set numbers. <i>post_group()</i>
+returns a dictionary with the output measurements that are marked as
+computed for the whole group. It always runs in the CellProfiler process.
+If the script is run in a pool of worker processes, the body of the script
+and <i>setup()</i> are run once more in the CellProfiler process before
+the first call of <i>post_group()</i>, which does not see the state that
+<i>setup()</i> or <i>run()</i> have set up in the workers.</p>
+<p>In capture mode the inputs and outputs of the script are written to an
+archive for each image set. <i>python -m runscript_support.replay</i> runs
+the script on the archives without CellProfiler, times and profiles it and
+compares its outputs with the captured ones.</p>
+<p>By default the arrays of the input images and objects are read-only
+views, so that a script cannot change the inputs of later modules.
+<i>cpscript.writable(array)</i> returns a copy that can be changed.</p>
+<p>Helpers shared by several scripts can be kept in a script library
+directory. Its modules are imported from <i>cellprofiler.cpscript.lib</i>,
+e.g. <i>from cellprofiler.cpscript.lib import features</i>, and are loaded
+only once per process.</p>
 '''
 #################################
 #
@@ -14,9 +89,33 @@ import sys
 import ast
 import datetime
 import tempfile
+import contextlib
+import cProfile
+import pstats
+import StringIO
 
 import numpy as np
 
+# make the runscript_support package next to this file importable
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+
+import runscript_support.codecache as rscodecache
+import runscript_support.engine as rsengine
+import runscript_support.governor as rsgovernor
+import runscript_support.history as rshistory
+import runscript_support.memo as rsmemo
+import runscript_support.pool as rspool
+import runscript_support.precision as rsprecision
+import runscript_support.prefetch as rsprefetch
+import runscript_support.profiling as rsprofiling
+import runscript_support.readonly as rsreadonly
+import runscript_support.replay as rsreplay
+import runscript_support.resultcache as rsresultcache
+import runscript_support.sparse as rssparse
+import runscript_support.tiling as rstiling
+
 #################################
 #
 # Imports from CellProfiler
@@ -32,9 +131,10 @@ import cellprofiler.cpmodule as cpm
 import cellprofiler.measurements as cpmeas
 import cellprofiler.objects as cpo
 import cellprofiler.settings as cps
+import cellprofiler.workspace as cpw
 from cellprofiler.preferences import \
      DEFAULT_INPUT_FOLDER_NAME, DEFAULT_OUTPUT_FOLDER_NAME, NO_FOLDER_NAME, \
-     ABSOLUTE_FOLDER_NAME
+     ABSOLUTE_FOLDER_NAME, get_default_output_directory
 
 DIR_ALL = [DEFAULT_INPUT_FOLDER_NAME, DEFAULT_OUTPUT_FOLDER_NAME,
            NO_FOLDER_NAME, ABSOLUTE_FOLDER_NAME]
@@ -47,6 +147,23 @@ WD_NO = "No"
 WD_PDB = "Use pdb"
 WD_WINGDB = "Use wingdbstub"
 WD_RPDB2 = "Use rpdb2"
+WD_TIMING = "Record execution times"
+WD_CPROFILE = "Record execution times and profile with cProfile"
+WD_MEMORY = "Record execution times and peak memory"
+WD_DEBUGGERS = [WD_PDB, WD_WINGDB, WD_RPDB2]
+WD_PROFILERS = [WD_TIMING, WD_CPROFILE, WD_MEMORY]
+LA_ABORT = "Stop the analysis"
+LA_SKIP = "Skip the image set"
+EM_IN_PROCESS = "In the CellProfiler process"
+EM_WORKER_POOL = "In a pool of worker processes"
+PR_DOUBLE = "Double (64-bit floating point)"
+PR_SINGLE = "Single (32-bit floating point)"
+PR_NATIVE = "Native type of the image files"
+PRECISIONS = {
+    PR_DOUBLE: rsprecision.P_DOUBLE,
+    PR_SINGLE: rsprecision.P_SINGLE,
+    PR_NATIVE: rsprecision.P_NATIVE,
+}
 WT_FLOAT = "Float"
 WT_INT = "Integer"
 WT_LIST = "List"
@@ -57,6 +174,21 @@ WT_STRING = "String"
 
 SETTINGS_OFFSET = 4
 
+# phases of running a script that are timed separately
+PH_FETCH = 'Fetch'
+PH_SCRIPT = 'Script'
+PH_STORE = 'Store'
+C_EXECUTION_TIME = 'ExecutionTime'
+C_PEAK_MEMORY = 'PeakMemory'
+C_RESOURCE_USAGE = 'ResourceUsage'
+
+# name of the image set attribute holding the cache of derived data that is
+# shared by all RunScript modules
+DERIVED_DATA_ATTRIBUTE = 'runscript_derived_data'
+
+# version of the inputs found in a script, part of the key of the code cache
+INPUTS_VERSION = '2'
+
 MT_TYPES = [
     cpmeas.COLTYPE_FLOAT,
     cpmeas.COLTYPE_INTEGER,
@@ -67,14 +199,192 @@ class RunScript(cpm.CPModule):
 
     module_name = "RunScript"
     category = "Other"
-    variable_revision_number = 1
+    variable_revision_number = 17
 
     def create_settings(self):
 
         # add choice for debugging modes
-        self.wants_debug_mode = cps.Choice("Run script in debug mode?",
-                                           [WD_NO, WD_PDB,
-                                            WD_WINGDB, WD_RPDB2])
+        self.wants_debug_mode = cps.Choice(
+            "Run script in debug mode?",
+            [WD_NO] + WD_DEBUGGERS + WD_PROFILERS,
+            doc="""Choose a debugger to break at the start of the script, or
+            choose to record where the time goes when running the script.
+            The time spent fetching the inputs, running the script and
+            storing the outputs is recorded as image measurements in the
+            <i>%(C_EXECUTION_TIME)s</i> category. The peak increase of the
+            resident memory of the process while running the module can be
+            recorded in the <i>%(C_PEAK_MEMORY)s</i> category. It is
+            sampled every 10 ms, so short peaks may be missed, and includes
+            memory that other threads allocate meanwhile. If a memory limit
+            is set, the peak is only recorded in the
+            <i>%(C_RESOURCE_USAGE)s</i> category. A summary for all image sets
+            is written to the default output folder at the end of the run,
+            together with the cProfile statistics if the script has been
+            profiled.""" % globals())
+        # add choice for the process the script is run in
+        self.execution_mode = cps.Choice(
+            "Where should the script be run?",
+            [EM_IN_PROCESS, EM_WORKER_POOL],
+            doc="""Choose <i>%(EM_WORKER_POOL)s</i> to run the script in
+            worker processes that keep the compiled script and any imported
+            libraries loaded between image sets. The declared inputs are
+            sent to a worker and the outputs are sent back. The script
+            cannot be run in debug mode in a worker and cannot use the
+            measurement history. <i>post_group()</i> runs in the
+            CellProfiler process with its own <i>setup()</i>.""" % globals())
+        self.worker_count = cps.Integer(
+            "Number of worker processes", 4, minval=1)
+        self.wants_shared_memory = cps.Binary(
+            "Exchange arrays through shared memory?", True,
+            doc="""Images, label matrices and output arrays are exchanged
+            with the worker processes through memory-mapped files instead
+            of being copied through a pipe. The script sees its inputs as
+            read-only arrays.""")
+        self.wants_code_cache = cps.Binary(
+            "Cache the compiled script on disk?", True,
+            doc="""The compiled script and the inputs found in it are
+            stored in a cache in the temporary directory. Pipelines that
+            run the same script, for example the jobs of a batch run, load
+            it from the cache instead of parsing and compiling it
+            again.""")
+        self.batch_size = cps.Integer(
+            "Number of image sets per script run", 1, minval=1,
+            doc="""If more than one image set is run at once, the script is
+            called once for each batch of image sets. The inputs are
+            stacked along a new first axis, e.g. the pixel data of an
+            image has the shape (N, height, width), and images and label
+            matrices of different sizes are padded with zeros. Image
+            measurements are arrays and object measurements are lists with
+            one array per image set. <i>cpscript.batch_size</i> and
+            <i>cpscript.image_numbers</i> describe the batch. Each output
+            measurement must be a sequence with one value per image set.
+            Only measurements can be output, and they are stored when the
+            batch is complete or at the end of the image group, so later
+            modules cannot use them.""")
+        self.wants_prefetch = cps.Binary(
+            "Fetch the inputs in the background?", False,
+            doc="""<i>(Used only if the script is run in the CellProfiler
+            process)</i><br>
+            The images and objects used by the script are fetched in a
+            background thread as soon as the script is started, in the
+            order in which the script uses them. Loading the images then
+            overlaps with the execution of the script. Only enable this if
+            the modules providing the inputs can be run in a separate
+            thread.""")
+        self.wants_evict_inputs = cps.Binary(
+            "Remove unused input images after the script has run?", False,
+            doc="""The images and objects used by the script are compared
+            with the inputs of the modules that follow in the pipeline.
+            RunScript always drops the data it has derived from inputs
+            that no later module uses. If this option is checked, such
+            input images are also removed from the image set so that their
+            memory is freed before the next modules run. Objects cannot be
+            removed from the object set. Do not check this option if you
+            want to look at the images after the pipeline has run, e.g. in
+            test mode.""")
+        self.wants_result_cache = cps.Binary(
+            "Cache the outputs of the script?", False,
+            doc="""<i>(Used only if one image set is run at a time)</i><br>
+            The outputs of the script are stored in a cache in the
+            temporary directory, keyed by the script, its constants and the
+            values of its inputs. If an image set is processed again with
+            the same inputs, e.g. in test mode or when a plate is analyzed
+            again, the outputs are loaded from the cache and the script is
+            not run. Output objects are cached as label matrices only. Do
+            not use the cache if the outputs depend on anything else than
+            the inputs, e.g. on random numbers or on state kept between
+            image sets.""")
+        self.result_cache_size = cps.Integer(
+            "Maximum size of the output cache (MB)", 1024, minval=1)
+        self.wants_tiles = cps.Binary(
+            "Run the script on tiles of the images?", False,
+            doc="""<i>(Used only if one image set is run at a time)</i><br>
+            The images and label matrices are divided into tiles and the
+            script is run on each tile, so that the temporary arrays of
+            the script stay small for very large images. The tiles are run
+            in parallel if the script is run in a pool of worker processes.
+            Only object measurements can be output, with one value per
+            object number found in the window of the tile.""")
+        self.tile_size = cps.Integer(
+            "Tile size (pixels)", 1024, minval=16)
+        self.tile_halo = cps.Integer(
+            "Tile overlap (pixels)", 32, minval=0,
+            doc="""The number of pixels the window of a tile extends the
+            tile on each side. Objects should be smaller than this.""")
+        self.time_limit = cps.Float(
+            "Time limit per image set (seconds)", 0, minval=0,
+            doc="""The maximum wall time the script may run for an image
+            set, 0 for no limit. A script that runs in the CellProfiler
+            process is interrupted at the next Python instruction after
+            the limit, long NumPy operations are not interrupted. Storing
+            the outputs is never interrupted, a limit exceeded meanwhile
+            is handled when the image set is done. The worker processes
+            of a pool are restarted if a script exceeds the limit.""")
+        self.memory_limit = cps.Integer(
+            "Memory limit per image set (MB)", 0, minval=0,
+            doc="""<i>(Used only if the script is run in the CellProfiler
+            process)</i><br>
+            The maximum increase of the resident memory of CellProfiler
+            while the script runs, 0 for no limit.""")
+        self.limit_action = cps.Choice(
+            "When a limit is exceeded", [LA_ABORT, LA_SKIP],
+            doc="""Choose <i>%(LA_SKIP)s</i> to record the error and continue
+            with the next image set. The remaining modules are not run for
+            the image set that exceeded the limit. The time and memory used
+            by the script and whether a limit was exceeded are recorded as
+            image measurements in the <i>%(C_RESOURCE_USAGE)s</i>
+            category.""" % globals())
+        self.precision = cps.Choice(
+            "Precision of the pixel data", [PR_DOUBLE, PR_SINGLE, PR_NATIVE],
+            doc="""CellProfiler stores the pixel data of images as 64-bit
+            floating point numbers between 0 and 1. With
+            <i>%(PR_SINGLE)s</i> the script receives 32-bit floating point
+            numbers, which halves the memory and the time to copy the
+            images. With <i>%(PR_NATIVE)s</i> images loaded from integer
+            files are passed as integers of their original range, e.g.
+            16-bit integers between 0 and 65535, other images in single
+            precision. In both modes the script receives images with only
+            the attributes <i>pixel_data</i> and <i>mask</i>. Floating
+            point output images keep their type. Integer output images are
+            scaled back to 0..1 in single precision by the range of the
+            integer input images, which therefore all need the same
+            range.""" % globals())
+        self.wants_capture = cps.Binary(
+            "Capture the inputs of the script?", False,
+            doc="""Write the inputs and outputs of the script for each image
+            set to an archive in the capture directory. The archives can be
+            replayed without CellProfiler to time, profile or test the
+            script:<br>
+            <i>python -m runscript_support.replay DIRECTORY --repeat 5
+            --check</i><br>
+            The images are stored uncompressed so that they are
+            memory-mapped by the replay.""")
+        self.capture_dir = cps.DirectoryPath(
+            "Name of the capture directory",
+            dir_choices=DIR_ALL,
+            allow_metadata=False
+        )
+        self.wants_read_only = cps.Binary(
+            "Pass the inputs as read-only arrays?", True,
+            doc="""The arrays of the input images and objects, e.g.
+            <i>pixel_data</i> and <i>segmented</i>, are views that cannot be
+            changed, so that the script cannot change the inputs of later
+            modules by accident. The arrays are not copied.
+            <i>cpscript.writable(array)</i> returns a copy of a read-only
+            array that the script can change in place.""")
+        self.wants_library = cps.Binary(
+            "Use a script library?", False,
+            doc="""The Python modules in the script library directory can
+            be imported by the script from <i>cellprofiler.cpscript.lib</i>,
+            e.g. <i>from cellprofiler.cpscript.lib import features</i>. The
+            modules are compiled once, kept in the cache of compiled
+            scripts and executed only once per process for all RunScript
+            modules that use the same library.""")
+        self.library_dir = cps.DirectoryPath(
+            "Name of the script library directory",
+            dir_choices=DIR_ALL,
+            allow_metadata=False
+        )
         # add containers for groups
         self.input_image_groups = []
         self.input_object_groups = []
@@ -83,6 +393,11 @@ class RunScript(cpm.CPModule):
         self.output_image_groups = []
         self.output_object_groups = []
         self.output_measurement_groups = []
+        self.output_table_groups = []
+        # the columns of the output tables declared in the script, parsed
+        # when they are needed (see get_table_columns)
+        self.__table_columns = None
+        self.__table_columns_source = None
         # add hidden counts for groups
         self.input_image_count = cps.HiddenCount(
             self.input_image_groups, 'Input image count')
@@ -98,6 +413,8 @@ class RunScript(cpm.CPModule):
             self.output_object_groups, 'Output object count')
         self.output_measurement_count = cps.HiddenCount(
             self.output_measurement_groups, 'Output measurement count')
+        self.output_table_count = cps.HiddenCount(
+            self.output_table_groups, 'Output table count')
         # add buttons for adding inputs and outputs
         self.add_input_image = cps.DoSomething(
             "", "Add another input image",
@@ -121,6 +438,9 @@ class RunScript(cpm.CPModule):
         self.add_output_measurement = cps.DoSomething(
             "", "Add another output measurement",
             self.add_output_measurement_cb)
+        self.add_output_table = cps.DoSomething(
+            "", "Add another output table",
+            self.add_output_table_cb)
         # add directory input box for loading script
         self.script_dir = cps.DirectoryPath(
             "Name of the script file directory",
@@ -184,8 +504,8 @@ class RunScript(cpm.CPModule):
             ),
             (
                 self.add_input_constant, self.input_constant_groups,
-                ("constant", "type_choice"),
-                ("divider", "constant", "type_choice", "remover"),
+                ("constant", "type_choice", "py_name"),
+                ("divider", "constant", "type_choice", "py_name", "remover"),
                 self.add_input_constant_cb
             ),
             (
@@ -204,12 +524,19 @@ class RunScript(cpm.CPModule):
                 self.add_output_measurement, self.output_measurement_groups,
                 ("relate_to_object", "on_image", "object", "image",
                  "type_choice", "measurement_category", "measurement_name",
-                 "py_name"),
+                 "py_name", "wants_group"),
                 ("divider", "relate_to_object", "on_image", "object", "image",
                  "type_choice", "measurement_category", "measurement_name",
-                 "py_name", "remover"),
+                 "py_name", "wants_group", "remover"),
                 self.add_output_measurement_cb
             ),
+            (
+                self.add_output_table, self.output_table_groups,
+                ("objects", "measurement_category", "py_name"),
+                ("divider", "objects", "measurement_category", "py_name",
+                 "remover"),
+                self.add_output_table_cb
+            ),
         )
 
     def settings(self):
@@ -221,11 +548,23 @@ class RunScript(cpm.CPModule):
             self.output_image_count,
             self.output_object_count,
             self.output_measurement_count,
+            self.output_table_count,
         ]
         result += [self.wants_debug_mode]
         result += [self.script_dir]
         result += [self.script_file]
         result += [self.script_text]
+        result += [self.execution_mode, self.worker_count,
+                   self.wants_shared_memory]
+        result += [self.wants_code_cache, self.batch_size]
+        result += [self.wants_prefetch, self.wants_evict_inputs]
+        result += [self.wants_result_cache, self.result_cache_size]
+        result += [self.wants_tiles, self.tile_size, self.tile_halo]
+        result += [self.time_limit, self.memory_limit, self.limit_action]
+        result += [self.wants_library, self.library_dir]
+        result += [self.precision]
+        result += [self.wants_capture, self.capture_dir]
+        result += [self.wants_read_only]
         for group_btn, groups, attr_names, visible_attr_names, add_cb in \
             self.__setting_descr:
             for group in groups:
@@ -234,7 +573,27 @@ class RunScript(cpm.CPModule):
         return result
 
     def visible_settings(self):
-        result = [self.wants_debug_mode]
+        result = [self.wants_debug_mode, self.execution_mode]
+        if self.execution_mode.value == EM_WORKER_POOL:
+            result += [self.worker_count, self.wants_shared_memory]
+        else:
+            result += [self.wants_prefetch]
+        result += [self.precision, self.wants_read_only]
+        result += [self.wants_code_cache, self.batch_size,
+                   self.wants_evict_inputs, self.wants_result_cache]
+        if self.wants_result_cache.value:
+            result += [self.result_cache_size]
+        result += [self.wants_tiles]
+        if self.wants_tiles.value:
+            result += [self.tile_size, self.tile_halo]
+        result += [self.time_limit]
+        if self.execution_mode.value != EM_WORKER_POOL:
+            result += [self.memory_limit]
+        if self.has_limits():
+            result += [self.limit_action]
+        result += [self.wants_capture]
+        if self.wants_capture.value:
+            result += [self.capture_dir]
         for group_btn, groups, attr_names, visible_attr_names, add_cb in \
             self.__setting_descr:
             for group in groups:
@@ -266,6 +625,9 @@ class RunScript(cpm.CPModule):
                         result += [setting]
             result += [group_btn]
         result += [cps.Divider()]
+        result += [self.wants_library]
+        if self.wants_library.value:
+            result += [self.library_dir]
         result += [self.script_dir]
         result += [self.script_file]
         result += [self.script_load_btn]
@@ -280,7 +642,7 @@ class RunScript(cpm.CPModule):
         Adjust the number of input and output objects to
         match the number indicated in the settings.
         '''
-        counts = [int(x) for x in setting_values[:7]]
+        counts = [int(x) for x in setting_values[:8]]
         groups = [x[1] for x in self.__setting_descr]
         callbacks = [x[4] for x in self.__setting_descr]
         for count, group, add_cb in zip(counts, groups, callbacks):
@@ -288,6 +650,112 @@ class RunScript(cpm.CPModule):
             while len(group) < count:
                 add_cb()
 
+    def upgrade_settings(self, setting_values, variable_revision_number,
+                         module_name, from_matlab):
+        if variable_revision_number == 1:
+            # add the execution mode and the worker count after the script
+            setting_values = setting_values[:11] \
+                + [EM_IN_PROCESS, '4'] + setting_values[11:]
+            variable_revision_number = 2
+        if variable_revision_number == 2:
+            # add the shared memory option after the worker count
+            setting_values = setting_values[:13] \
+                + [cps.YES] + setting_values[13:]
+            variable_revision_number = 3
+        if variable_revision_number == 3:
+            # add the code cache option after the shared memory option
+            setting_values = setting_values[:14] \
+                + [cps.YES] + setting_values[14:]
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            # add the batch size after the code cache option
+            setting_values = setting_values[:15] \
+                + ['1'] + setting_values[15:]
+            variable_revision_number = 5
+        if variable_revision_number == 5:
+            # add the prefetch option after the batch size
+            setting_values = setting_values[:16] \
+                + [cps.NO] + setting_values[16:]
+            variable_revision_number = 6
+        if variable_revision_number == 6:
+            # store the python name of each constant after its type, the
+            # name was not saved before so all constants had the default
+            image_count, object_count, measurement_count, constant_count \
+                = [int(x) for x in setting_values[:4]]
+            offset = 17 + image_count + object_count + 3 * measurement_count
+            constant_values = []
+            for i in range(constant_count):
+                constant_values += setting_values[offset + 2 * i:
+                                                  offset + 2 * i + 2]
+                constant_values += ['cp_constant_in']
+            setting_values = setting_values[:offset] + constant_values \
+                + setting_values[offset + 2 * constant_count:]
+            variable_revision_number = 7
+        if variable_revision_number == 7:
+            # add the eviction option after the prefetch option
+            setting_values = setting_values[:17] \
+                + [cps.NO] + setting_values[17:]
+            variable_revision_number = 8
+        if variable_revision_number == 8:
+            # add the output table count after the output measurement count
+            setting_values = setting_values[:7] + ['0'] + setting_values[7:]
+            variable_revision_number = 9
+        if variable_revision_number == 9:
+            # add the output cache options after the eviction option
+            setting_values = setting_values[:19] \
+                + [cps.NO, '1024'] + setting_values[19:]
+            variable_revision_number = 10
+        if variable_revision_number == 10:
+            # add the tile options after the output cache options
+            setting_values = setting_values[:21] \
+                + [cps.NO, '1024', '32'] + setting_values[21:]
+            variable_revision_number = 11
+        if variable_revision_number == 11:
+            # add the resource limits after the tile options
+            setting_values = setting_values[:24] \
+                + ['0', '0', LA_ABORT] + setting_values[24:]
+            variable_revision_number = 12
+        if variable_revision_number == 12:
+            # add the script library after the resource limits
+            setting_values = setting_values[:27] \
+                + [cps.NO, cps.DirectoryPath.static_join_string(
+                    DEFAULT_INPUT_FOLDER_NAME, cps.NONE)] \
+                + setting_values[27:]
+            variable_revision_number = 13
+        if variable_revision_number == 13:
+            # add the group option at the end of each output measurement
+            counts = [int(x) for x in setting_values[:6]]
+            offset = 29 + counts[0] + counts[1] + 3 * counts[2] \
+                + 3 * counts[3] + 2 * counts[4] + 2 * counts[5]
+            measurement_count = int(setting_values[6])
+            measurement_values = []
+            for i in range(measurement_count):
+                measurement_values += setting_values[offset + 8 * i:
+                                                     offset + 8 * i + 8]
+                measurement_values += [cps.NO]
+            setting_values = setting_values[:offset] + measurement_values \
+                + setting_values[offset + 8 * measurement_count:]
+            variable_revision_number = 14
+        if variable_revision_number == 14:
+            # add the precision after the script library
+            setting_values = setting_values[:29] + [PR_DOUBLE] \
+                + setting_values[29:]
+            variable_revision_number = 15
+        if variable_revision_number == 15:
+            # add the capture options after the precision
+            setting_values = setting_values[:30] \
+                + [cps.NO, cps.DirectoryPath.static_join_string(
+                    DEFAULT_OUTPUT_FOLDER_NAME, cps.NONE)] \
+                + setting_values[30:]
+            variable_revision_number = 16
+        if variable_revision_number == 16:
+            # add the read-only option after the capture options, scripts
+            # of existing pipelines may change their inputs in place
+            setting_values = setting_values[:32] + [cps.NO] \
+                + setting_values[32:]
+            variable_revision_number = 17
+        return setting_values, variable_revision_number, from_matlab
+
     def load_script_file_cb(self):
         # load the script
         dir_name = self.script_dir.get_absolute_path()
@@ -463,6 +931,17 @@ class RunScript(cpm.CPModule):
             doc="""Select the name of the variable that """
                 """can be used to access the measurement"""
         ))
+        group.append('wants_group', cps.Binary(
+            "Computed for the whole group by post_group()?", False,
+            doc="""The measurement is not output for each image set but
+            returned by the function <i>post_group()</i> of the script
+            after all image sets of the group have been processed. It
+            returns a dictionary with an array of one value per image set
+            for an image measurement. Object measurements are a list with
+            an array per image set or one array with the values of all
+            objects, which is split by the <i>Count</i> measurement of the
+            objects."""
+        ))
         group.append(
             "remover",
             cps.RemoveSettingButton(
@@ -471,6 +950,32 @@ class RunScript(cpm.CPModule):
         )
         self.output_measurement_groups.append(group)
 
+    def add_output_table_cb(self):
+        '''Add a table to the output_table_groups collection'''
+        group = cps.SettingsGroup()
+        group.append("divider", cps.Divider())
+        group.append('objects', cps.ObjectNameSubscriber(
+            "Object name",
+            doc="""Select the objects the rows of the table belong to"""
+        ))
+        group.append('measurement_category', cps.Text(
+            "Measurement category",
+            "RunScript"
+        ))
+        group.append('py_name', cps.Text(
+            "Name for the table-variable in Python",
+            "cp_table_out",
+            doc="""Select the name of the variable that holds the table.
+            Its columns have to be declared in the script by assigning
+            them to <i>cpscript.columns[name]</i>."""
+        ))
+        group.append(
+            "remover",
+            cps.RemoveSettingButton(
+               "", "Remove this table", self.output_table_groups, group)
+        )
+        self.output_table_groups.append(group)
+
     def get_measurement_columns(self, pipeline):
         '''Return column definitions for measurements made by this module'''
         columns = []
@@ -495,6 +1000,18 @@ class RunScript(cpm.CPModule):
                                img),
                     group.type_choice.value
                 ))
+        table_columns = self.get_table_columns()
+        for group in self.output_table_groups:
+            for name, coltype in table_columns.get(group.py_name.value, []):
+                columns.append((
+                    group.objects.value,
+                    '%s_%s' % (group.measurement_category.value, name),
+                    coltype
+                ))
+        for category, measurement, coltype in self.get_image_features():
+            columns.append((cpmeas.IMAGE,
+                            '%s_%s' % (category, measurement),
+                            coltype))
         return columns
 
     def get_categories(self, pipeline, object_name):
@@ -506,6 +1023,15 @@ class RunScript(cpm.CPModule):
             )
             if object_name == group_object_name:
                 categories.append(group.measurement_category.value)
+        for group in self.output_table_groups:
+            if object_name == group.objects.value \
+               and group.measurement_category.value not in categories:
+                categories.append(group.measurement_category.value)
+        if object_name == cpmeas.IMAGE:
+            for category, measurement, coltype \
+                in self.get_image_features():
+                if category not in categories:
+                    categories.append(category)
         return categories
 
     def get_measurements(self, pipeline, object_name, category):
@@ -519,6 +1045,17 @@ class RunScript(cpm.CPModule):
             if object_name == group_object_name \
                and category == group_category:
                 measurements.append(group.measurement_name.value)
+        table_columns = self.get_table_columns()
+        for group in self.output_table_groups:
+            if object_name == group.objects.value \
+               and category == group.measurement_category.value:
+                measurements += [name for name, coltype in
+                                 table_columns.get(group.py_name.value, [])]
+        if object_name == cpmeas.IMAGE:
+            for feature_category, measurement, coltype \
+                in self.get_image_features():
+                if category == feature_category:
+                    measurements.append(measurement)
         return measurements
 
     def get_measurement_images(self, pipeline, object_name, \
@@ -569,55 +1106,213 @@ class RunScript(cpm.CPModule):
         elif type_choice == WT_DICT:
             return dict([x.split(':') for x in constant.split(',')])
         elif type_choice == WT_NPARRAY:
+            if constant.strip().endswith('.npy'):
+                # large arrays are mapped from a file instead of being parsed
+                return np.load(constant.strip(), mmap_mode='r')
             return np.array([float(x) for x in constant.split(',')])
         elif type_choice == WT_FLOATDICT:
-            l = RunScript.convert_to_type(constant, WT_LIST)
-            return dict([(k, float(v)) for k, v in l])
+            d = RunScript.convert_to_type(constant, WT_DICT)
+            return dict([(k, float(v)) for k, v in d.iteritems()])
+        elif type_choice == WT_STRING:
+            return constant
 
-    class __ImageWrapper__(object):
-        def __init__(self, workspace):
-            self.__workspace = workspace
+    def get_constant_table(self):
+        '''Convert all constants and return them by their python name
 
-        def __getitem__(self, name):
-            image = self.__workspace.image_set.get_image(name)
-            return image
+        Lists are converted to tuples and arrays are made read-only so that
+        a script cannot change the values seen by later image sets. The
+        path of an array file is relative to the script file directory.
+        '''
+        table = {}
+        for group in self.input_constant_groups:
+            constant = group.constant.value
+            type_choice = group.type_choice.value
+            if type_choice == WT_NPARRAY and constant.strip().endswith('.npy'):
+                constant = os.path.join(self.script_dir.get_absolute_path(),
+                                        os.path.expanduser(constant.strip()))
+            value = RunScript.convert_to_type(constant, type_choice)
+            if type_choice == WT_LIST:
+                value = tuple(value)
+            elif type_choice == WT_NPARRAY:
+                value.setflags(write=False)
+            table[group.py_name.value] = value
+        return table
 
-    class __ObjectWrapper__(object):
-        def __init__(self, workspace):
-            self.__workspace = workspace
+    class __PrefetchingWrapper__(object):
+        '''Base class for wrappers that can fetch their items in advance
+
+        fetch - the function that returns an item by name
+        prefetch_names - the names of the items to fetch in a background
+                         thread as soon as the wrapper is created
+        timer - a PhaseTimer accounting the time spent waiting for items
+        '''
+        def __init__(self, fetch, prefetch_names=None, timer=None):
+            self.__fetch = fetch
+            self.__timer = timer
+            self.__prefetcher = None
+            if prefetch_names:
+                self.__prefetcher = rsprefetch.Prefetcher(fetch,
+                                                          prefetch_names)
 
         def __getitem__(self, name):
-            objects = self.__workspace.object_set.get_objects(name)
-            return objects
+            if self.__timer is None:
+                return self.__get(name)
+            with self.__timer.phase(PH_FETCH):
+                return self.__get(name)
+
+        def __get(self, name):
+            if self.__prefetcher is not None:
+                return self.__prefetcher.get(name)
+            return self.__fetch(name)
+
+        def join(self):
+            '''Wait for the background thread to finish'''
+            if self.__prefetcher is not None:
+                self.__prefetcher.join()
+
+    class __ImageWrapper__(__PrefetchingWrapper__):
+        def __init__(self, workspace, prefetch_names=None, timer=None,
+                     precision=rsprecision.P_DOUBLE, read_only=False):
+            fetch = workspace.image_set.get_image
+            if precision != rsprecision.P_DOUBLE:
+                get_image = fetch
+
+                def fetch(name):
+                    # the conversion is done by the prefetching thread
+                    image = get_image(name)
+                    pixel_data = rsprecision.convert_input(
+                        image.pixel_data, precision,
+                        getattr(image, 'scale', None))
+                    mask = image.mask if image.has_mask else None
+                    if read_only:
+                        # the data may not have been converted
+                        pixel_data = rsreadonly.read_only(pixel_data)
+                        mask = rsreadonly.read_only(mask)
+                    return rsengine.ScriptImage(pixel_data, mask)
+            elif read_only:
+                get_image = fetch
+
+                def fetch(name):
+                    return rsreadonly.ReadOnlyProxy(
+                        get_image(name), rsreadonly.IMAGE_ARRAYS)
+            RunScript.__PrefetchingWrapper__.__init__(
+                self, fetch, prefetch_names, timer)
+
+    class __ObjectWrapper__(__PrefetchingWrapper__):
+        def __init__(self, workspace, prefetch_names=None, timer=None,
+                     read_only=False):
+            fetch = workspace.object_set.get_objects
+            if read_only:
+                get_objects = fetch
+
+                def fetch(name):
+                    return rsreadonly.ReadOnlyProxy(
+                        get_objects(name), rsreadonly.OBJECTS_ARRAYS)
+            RunScript.__PrefetchingWrapper__.__init__(
+                self, fetch, prefetch_names, timer)
 
     class __MeasurementWrapper__(object):
-        def __init__(self, workspace):
+        def __init__(self, workspace, history=None):
             self.__workspace = workspace
+            self.__history = history
 
         def __getitem__(self, key):
-            if hasattr(key, '__iter__'):
-                parts = tuple(key)
-            else:
-                parts = key.split('_')
-            if parts[0] == 'Image':
+            object_name, feature = rshistory.split_key(key)
+            if object_name == 'Image':
                 measurement = self.__workspace.measurements \
-                    .get_current_image_measurement('_'.join(parts[1:]))
+                    .get_current_image_measurement(feature)
             else:
                 measurement = self.__workspace.measurements \
-                    .get_current_measurement(parts[0], '_'.join(parts[1:]))
+                    .get_current_measurement(object_name, feature)
             return measurement
 
+        def history(self, key, with_image_numbers=False):
+            '''Return a measurement of all image sets of the group so far
+
+            The values of the image sets of the current group that have
+            been processed and of the current image set are returned as one
+            array, an image measurement with one value per image set, an
+            object measurement with the values of all objects. If
+            with_image_numbers is True, a tuple of the image set number of
+            each value and the values is returned.
+            '''
+            if self.__history is None:
+                raise RuntimeError(
+                    'The measurement history is only available when the'
+                    ' script is run in the CellProfiler process one image'
+                    ' set at a time')
+            return self.__history.get(
+                key, self.__workspace.measurements.image_set_number,
+                with_image_numbers)
+
     class __ConstantWrapper__(object):
-        def __init__(self, runscript_module):
-            self.__runscript = runscript_module
+        def __init__(self, constant_table):
+            self.__constant_table = constant_table
 
         def __getitem__(self, name):
-            for group in self.__runscript.input_constant_groups:
-                if group.py_name.value == name:
-                    constant = group.constant.value
-                    type_choice = group.type_choice.value
-                    return RunScript.convert_to_type(constant, type_choice)
-            raise KeyError('No such constant has been declared:', name)
+            try:
+                return self.__constant_table[name]
+            except KeyError:
+                raise KeyError('No such constant has been declared:', name)
+
+    @staticmethod
+    def find_table_columns(tree):
+        '''Find the columns of the output tables declared in the script
+
+        Returns a dictionary mapping the python name of each table to a list
+        of (column name, measurement type) tuples.
+        '''
+        cpscript_names = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                cpscript_names += [
+                    alias.name if alias.asname is None else alias.asname
+                    for alias in node.names
+                    if alias.name == 'cellprofiler.cpscript']
+            if isinstance(node, ast.ImportFrom) \
+               and node.module == 'cellprofiler':
+                cpscript_names += [
+                    alias.name if alias.asname is None else alias.asname
+                    for alias in node.names if alias.name == 'cpscript']
+        table_columns = {}
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Assign):
+                continue
+            for target in node.targets:
+                if not (isinstance(target, ast.Subscript)
+                        and isinstance(target.value, ast.Attribute)
+                        and target.value.attr == 'columns'
+                        and isinstance(target.value.value, ast.Name)
+                        and target.value.value.id in cpscript_names):
+                    continue
+                try:
+                    table_name = ast.literal_eval(target.slice.value)
+                    columns = ast.literal_eval(node.value)
+                except (AttributeError, ValueError):
+                    raise KeyError(
+                        'The name and the columns of a table have to be'
+                        ' literals in line %d' % node.lineno)
+                table_columns[table_name] = [
+                    (column, cpmeas.COLTYPE_FLOAT)
+                    if isinstance(column, basestring) else tuple(column)
+                    for column in columns]
+        return table_columns
+
+    def get_table_columns(self):
+        '''Return the columns of the output tables declared in the script
+
+        The script is parsed again only if it has been changed. Scripts
+        that cannot be parsed declare no columns.
+        '''
+        source = self.script_text.value
+        if source != self.__table_columns_source:
+            try:
+                tree = compile(source, '<script>', 'exec', ast.PyCF_ONLY_AST)
+                self.__table_columns = self.find_table_columns(tree)
+            except (SyntaxError, TypeError, KeyError):
+                self.__table_columns = {}
+            self.__table_columns_source = source
+        return self.__table_columns
 
     # parse the AST tree to find input images, objects and measurements
     def find_inputs(self, tree):
@@ -625,6 +1320,9 @@ class RunScript(cpm.CPModule):
         input_object_list = []
         input_measurement_list = []
         input_constant_list = []
+        # measurements read with measurements.history() and from
+        # group_measurements, they need not be declared
+        history_measurement_list = []
         name_to_list_map = {
             (ast.Load, 'images'): input_image_list,
             (ast.Load, 'objects'): input_object_list,
@@ -647,6 +1345,21 @@ class RunScript(cpm.CPModule):
         nodes.sort(cmp=cmp_nodes)
         # scan the nodes ...
         cpscript_names = []
+
+        def is_cpscript_attribute(node, attr):
+            return isinstance(node, ast.Attribute) and node.attr == attr \
+                and isinstance(node.value, ast.Name) \
+                and node.value.id in cpscript_names
+
+        def add_key(key_list, node):
+            # keys that are not literals are computed when the script runs
+            try:
+                value = ast.literal_eval(node)
+            except ValueError:
+                return
+            if hasattr(value, '__iter__'):
+                value = '_'.join(value)
+            key_list.append(value)
         for node in nodes:
             # check for imports of cellprofiler.cpscript
             if isinstance(node, ast.Import):
@@ -681,8 +1394,44 @@ class RunScript(cpm.CPModule):
                             'The key for indexing %s.%s may not be a slice' \
                             % (cpscript_name, name)
                         )
+                elif is_cpscript_attribute(node.value, 'group_measurements') \
+                        and isinstance(node.slice, ast.Index):
+                    add_key(history_measurement_list, node.slice.value)
+            # check for measurements.history(key) and
+            # group_measurements.get(key)
+            if isinstance(node, ast.Call) and node.args \
+               and isinstance(node.func, ast.Attribute):
+                wrapper = node.func.value
+                if node.func.attr == 'history' \
+                   and is_cpscript_attribute(wrapper, 'measurements') \
+                   or node.func.attr == 'get' \
+                   and is_cpscript_attribute(wrapper, 'group_measurements'):
+                    add_key(history_measurement_list, node.args[0])
         return (input_image_list, input_object_list,
-                input_measurement_list, input_constant_list)
+                input_measurement_list, input_constant_list,
+                history_measurement_list)
+
+    def compile_script(self, source, path):
+        '''Compile the script source and find the inputs it uses
+
+        source - the source of the script
+        path - the file name to compile the script with
+
+        Returns the code object and the lists of input images, objects,
+        measurements and constants and of the measurements read from the
+        history.
+        '''
+        # compile the script source into an AST tree
+        asttree = compile(source, path, 'exec', ast.PyCF_ONLY_AST)
+        # compile the AST tree into a code object
+        codeobj = compile(asttree, path, 'exec')
+        try:
+            # parse the AST tree to find all images, objects and measurements
+            # that the script is using as input
+            inputs = self.find_inputs(asttree)
+        except KeyError as err:
+            raise cps.ValidationError(err.message, self.script_text)
+        return codeobj, inputs
 
     def prepare_run(self, *args):
         #import cellprofiler.utilities.get_revision
@@ -695,6 +1444,36 @@ class RunScript(cpm.CPModule):
         #else:
             #workspace = args[0]
 
+        if self.execution_mode.value == EM_WORKER_POOL \
+           and self.wants_debug_mode.value in WD_DEBUGGERS:
+            raise cps.ValidationError(
+                'The script cannot be debugged when it is run in a pool of'
+                ' worker processes', self.execution_mode)
+        if self.execution_mode.value == EM_WORKER_POOL \
+           and self.wants_debug_mode.value in (WD_CPROFILE, WD_MEMORY):
+            raise cps.ValidationError(
+                'The script can only be profiled and its memory recorded'
+                ' when it is run in the CellProfiler process',
+                self.wants_debug_mode)
+        if self.batch_size.value > 1 \
+           and len(self.output_image_groups + self.output_object_groups) > 0:
+            raise cps.ValidationError(
+                'Only measurements can be output when the script is run on'
+                ' batches of image sets', self.batch_size)
+        if self.wants_tiles.value:
+            self.validate_tiles()
+        if self.wants_capture.value and (
+                self.batch_size.value > 1 or self.wants_tiles.value):
+            raise cps.ValidationError(
+                'The inputs can only be captured if the script is run once'
+                ' per image set without tiles', self.wants_capture)
+        table_columns = self.get_table_columns()
+        for group in self.output_table_groups:
+            if group.py_name.value not in table_columns:
+                raise cps.ValidationError(
+                    'The script does not declare the columns of the table %s'
+                    ' in cpscript.columns' % group.py_name.value,
+                    group.py_name)
         source = self.script_text.value
         # maybe add some debugging stuff
         if self.wants_debug_mode.value == WD_PDB:
@@ -706,25 +1485,79 @@ class RunScript(cpm.CPModule):
             source = u"import rpdb2\nrpdb2.set_trace()\n\n" + source
         # TODO: only print when not in batch mode
         #print 'Script source:', source
-        # create a temporary file with the script source for debugging
-        tmpfile_handle, tmpfile_path = tempfile.mkstemp(
-            suffix='.py', prefix='CPRunScript_')
-        tmpfile = os.fdopen(tmpfile_handle, 'w')
-        tmpfile.write(source)
-        tmpfile.close()
-        # keep path of temporary file for deletion in post_run()
-        self.__tmpfile_path = tmpfile_path
-        # compile the script source into an AST tree
-        asttree = compile(source, tmpfile_path, 'exec', ast.PyCF_ONLY_AST)
-        # compile the AST tree into a code object
-        self.__codeobj = compile(asttree, tmpfile_path, 'exec')
+        if self.wants_code_cache.value:
+            # look up the compiled script and its inputs in the cache
+            cache = rscodecache.CodeCache()
+            key = cache.key(source, self.wants_debug_mode.value,
+                            INPUTS_VERSION)
+            compiled = cache.get(key)
+            if compiled is None:
+                compiled = self.compile_script(source, cache.source_path(key))
+                cache.put(key, source, compiled)
+            # the source file is owned by the cache
+            self.__tmpfile_path = None
+        else:
+            # create a temporary file with the script source for debugging
+            tmpfile_handle, tmpfile_path = tempfile.mkstemp(
+                suffix='.py', prefix='CPRunScript_')
+            tmpfile = os.fdopen(tmpfile_handle, 'w')
+            tmpfile.write(source)
+            tmpfile.close()
+            # keep path of temporary file for deletion in post_run()
+            self.__tmpfile_path = tmpfile_path
+            compiled = self.compile_script(source, tmpfile_path)
+        self.__codeobj, inputs = compiled
+        if len(self.get_group_measurement_groups()) > 0 and not (
+                rsengine.defines_function(self.__codeobj,
+                                          rsengine.RUN_FUNCTION)
+                and rsengine.defines_function(
+                    self.__codeobj, rsengine.POST_GROUP_FUNCTION)):
+            raise cps.ValidationError(
+                'The script has to define the functions run() and'
+                ' post_group() to compute measurements for the whole group',
+                self.get_group_measurement_groups()[0].wants_group)
+        self.__library = None
+        if self.wants_library.value:
+            library_dir = self.library_dir.get_absolute_path()
+            if not os.path.isdir(library_dir):
+                raise cps.ValidationError(
+                    'The script library directory %s does not exist'
+                    % library_dir, self.library_dir)
+            self.__library = rsengine.get_library(
+                library_dir, self.wants_code_cache.value)
+        input_images, input_objects, input_measurements, input_constants, \
+            history_measurements = inputs
+        self.__input_images = input_images
+        self.__input_objects = input_objects
+        # parse the constants only once
         try:
-            # parse the AST tree to find all images, objects and measurements
-            # that the script is using as input
-            input_images, input_objects, input_measurements, input_constants \
-                = self.find_inputs(asttree)
-        except KeyError as err:
-            raise cps.ValidationError(err.message, self.script_text)
+            self.__constants = self.get_constant_table()
+        except (ValueError, IOError) as err:
+            raise cps.ValidationError(
+                'Invalid constant: %s' % err, self.input_constant_groups)
+        self.__result_cache = None
+        if self.wants_result_cache.value:
+            # the part of the key that is the same for all image sets
+            self.__result_cache = rsresultcache.ResultCache(
+                max_bytes=self.result_cache_size.value * 1024 * 1024)
+            self.__result_key = self.__result_cache.key(
+                source, self.get_output_names(), self.__constants,
+                self.__library.key() if self.__library is not None else None)
+        self.__executor = rsengine.ScriptExecutor(self.__codeobj,
+                                                  self.__library)
+        self.__pool = None
+        self.__batch = []
+        self.__batch_image_numbers = []
+        self.__history = None
+        self.__group_image_numbers = []
+        self.__timer = rsprofiling.PhaseTimer()
+        self.__profile_report = rsprofiling.ProfileReport()
+        self.__profile = None
+        if self.wants_debug_mode.value == WD_CPROFILE:
+            self.__profile = cProfile.Profile()
+        # the inputs that can be released are found in the first run when
+        # the pipeline is known
+        self.__unused_inputs = None
         # this is just a sanity check to see if any inputs used in the script
         # where not declared in the cellprofiler settings ..
         # ... for images
@@ -765,7 +1598,7 @@ class RunScript(cpm.CPModule):
             )
             if measurement_name in input_measurements_copy:
                 input_measurements_copy.remove(measurement_name)
-            else:
+            elif measurement_name not in history_measurements:
                 print 'WARNING: Input measurements (%s, %s) has been' \
                       ' declared but is never used in the script' \
                       % (object_name, group.measurement.value)
@@ -798,89 +1631,747 @@ class RunScript(cpm.CPModule):
     # This is where you do the real work.
     #
     def run(self, workspace):
+        self.__timer = rsprofiling.PhaseTimer()
+        monitor = None
+        if self.wants_debug_mode.value == WD_MEMORY \
+           and self.get_memory_limit() is None:
+            monitor = rsprofiling.PeakMemoryMonitor()
+            monitor.start()
+        # worker processes are stopped by a timeout instead (see run_script)
+        governor = rsgovernor.ResourceGovernor(
+            self.get_time_limit()
+            if self.execution_mode.value != EM_WORKER_POOL else None,
+            self.get_memory_limit())
+        exceeded = None
+        # only the code of the script is interrupted, not the storing of
+        # its outputs or the code around it
+        self.__executor.guard = governor.guard
+        try:
+            with governor:
+                self.run_image_set(workspace)
+            self.__group_image_numbers.append(
+                workspace.measurements.image_set_number)
+            if self.__history is not None:
+                self.__history.add_image_set(
+                    workspace.measurements.image_set_number)
+            self.release_inputs(workspace)
+        except rsgovernor.BudgetExceeded as err:
+            exceeded = err
+        finally:
+            self.__executor.guard = None
+            peak_memory = monitor.stop() if monitor is not None else None
+            self.clear_derived_data(workspace)
+        if self.wants_debug_mode.value in WD_PROFILERS:
+            self.record_profile(workspace, peak_memory)
+        if self.has_limits():
+            self.record_resource_usage(workspace, governor, exceeded)
+        if exceeded is not None:
+            self.handle_exceeded_limit(workspace, exceeded)
 
-        # Finder and loader object for use in the script.
-        # The imported module provides access to the input objects for
-        # the script.
-        # This implements the importer protocol as described in PEP302
-        # (see http://www.python.org/dev/peps/pep-0302/).
-        # The module can be imported as:
-        #   from cellprofiler import cpscript
-        class cpscript_hook(object):
-            def find_module(self, fullname, path=None):
-                if fullname in ('cellprofiler.cpscript'):
-                    return self
-
-            def load_module(self, fullname):
-                if fullname == 'cellprofiler.cpscript':
-                    import sys
-                    import imp
-                    module = sys.modules.setdefault(fullname,
-                                                    imp.new_module(fullname))
-                    module.__file__ = "<%s>" % self.__class__.__name__
-                    module.__loader__ = self
-                    module.__dict__.update({
-                        'IMAGE': cpmeas.IMAGE,
-                        'images': RunScript.__ImageWrapper__(workspace),
-                        'objects': RunScript.__ObjectWrapper__(workspace),
-                        'measurements': RunScript \
-                            .__MeasurementWrapper__(workspace),
-                        'constants': RunScript \
-                            .__ConstantWrapper__(workspace),
-                    })
-                    return module
-        cpscript_hook_inst = cpscript_hook()
-        # set up a namespace for the script to run in
-        script_name = '<runscript script>'
-        script_namespace = {
-            '__name__': script_name,
-            '__package__': None,
-            '__doc__': None,
-        }
-        # add importer hook
-        sys.meta_path.append(cpscript_hook_inst)
+    def has_limits(self):
+        return self.time_limit.value > 0 or self.get_memory_limit() is not None
+
+    def get_time_limit(self):
+        '''Return the time limit in seconds or None'''
+        return self.time_limit.value if self.time_limit.value > 0 else None
+
+    def get_memory_limit(self):
+        '''Return the memory limit in bytes or None'''
+        if self.memory_limit.value == 0 \
+           or self.execution_mode.value == EM_WORKER_POOL:
+            return None
+        return self.memory_limit.value * 1024 * 1024
+
+    def get_resource_features(self):
+        '''Return (category, measurement, type) of the resource features'''
+        if not self.has_limits():
+            return []
+        prefix = self.get_feature_prefix()
+        features = [(C_RESOURCE_USAGE, prefix + 'Time', cpmeas.COLTYPE_FLOAT)]
+        if self.get_memory_limit() is not None:
+            features.append((C_RESOURCE_USAGE, prefix + 'Memory',
+                             cpmeas.COLTYPE_INTEGER))
+        features.append((C_RESOURCE_USAGE, prefix + 'LimitExceeded',
+                         cpmeas.COLTYPE_INTEGER))
+        return features
+
+    def get_image_features(self):
+        '''Return (category, measurement, type) of all image features
+        recorded in addition to the outputs of the script'''
+        return self.get_profile_features() + self.get_resource_features()
+
+    def record_resource_usage(self, workspace, governor, exceeded):
+        '''Add the time and memory used by the script as measurements'''
+        for category, measurement, coltype in self.get_resource_features():
+            if measurement.endswith('Time'):
+                value = governor.elapsed
+            elif measurement.endswith('Memory'):
+                value = governor.peak_memory
+            else:
+                value = 0 if exceeded is None else 1
+            workspace.measurements.add_image_measurement(
+                '%s_%s' % (category, measurement), value)
+
+    def handle_exceeded_limit(self, workspace, exceeded):
+        '''Stop the analysis or skip the image set after a limit has been
+        exceeded'''
+        message = '%s #%d, image set %d: %s' % (
+            self.module_name, self.module_num,
+            workspace.measurements.image_set_number, exceeded)
+        if self.limit_action.value == LA_SKIP \
+           and hasattr(cpw, 'DISPOSITION_SKIP'):
+            print 'WARNING: %s, skipping the image set' % message
+            workspace.disposition = cpw.DISPOSITION_SKIP
+            return
+        raise RuntimeError(message)
+
+    def run_image_set(self, workspace):
+        '''Run the script on the current image set and store its outputs'''
+        if self.batch_size.value > 1:
+            # collect the inputs until the batch is complete
+            with self.__timer.phase(PH_FETCH):
+                self.__batch.append(self.get_script_inputs(workspace))
+            self.__batch_image_numbers.append(
+                workspace.measurements.image_set_number)
+            if len(self.__batch) == self.batch_size.value:
+                self.run_batch(workspace)
+            return
+        if self.wants_tiles.value:
+            outputs = self.run_tiled(workspace)
+        elif self.wants_capture.value:
+            outputs = self.run_script_captured(workspace)
+        elif self.__result_cache is not None:
+            outputs = self.run_script_cached(workspace)
+        else:
+            outputs = self.run_script(workspace)
+        with self.__timer.phase(PH_STORE):
+            self.store_outputs(workspace, outputs)
+
+    def run_script_cached(self, workspace):
+        '''Return the cached outputs for the current inputs
+
+        The script is only run if the outputs are not in the cache.
+        '''
+        with self.__timer.phase(PH_FETCH):
+            inputs = self.get_script_inputs(workspace)
+            key = self.__result_cache.key(
+                self.__result_key, inputs['images'], inputs['objects'],
+                inputs['measurements'])
+            outputs = self.__result_cache.get(key)
+        if outputs is not None:
+            return outputs
+        if self.execution_mode.value == EM_WORKER_POOL:
+            outputs = self.run_script(workspace, inputs)
+        else:
+            # the script sees the same inputs as without the cache
+            outputs = self.run_script(workspace)
+        outputs = self.get_cacheable_outputs(outputs)
+        with self.__timer.phase(PH_STORE):
+            self.__result_cache.put(key, outputs)
+        return outputs
+
+    def run_script_captured(self, workspace):
+        '''Run the script and write its inputs and outputs to an archive'''
+        with self.__timer.phase(PH_FETCH):
+            inputs = self.get_script_inputs(workspace)
+        if self.execution_mode.value == EM_WORKER_POOL:
+            outputs = self.run_script(workspace, inputs)
+        else:
+            outputs = self.run_script(workspace)
+        outputs = self.get_cacheable_outputs(outputs)
+        image_number = workspace.measurements.image_set_number
+        directory = self.capture_dir.get_absolute_path()
+        rscodecache.make_directory(directory)
+        with self.__timer.phase(PH_STORE):
+            rsreplay.write_capture(
+                rsreplay.capture_path(directory, self.module_num,
+                                      image_number),
+                inputs, outputs, self.script_text.value,
+                self.get_output_names(), image_number,
+                self.library_dir.get_absolute_path()
+                if self.wants_library.value else None)
+        return outputs
+
+    def get_cacheable_outputs(self, namespace):
+        '''Return the outputs of the script in a form that can be pickled
+
+        Images are converted to stand-ins with the pixel data and the mask,
+        objects to their label matrix.
+        '''
+        outputs = dict((name, rsreadonly.unwrap(namespace[name]))
+                       for name in self.get_output_names())
+        for group in self.output_image_groups:
+            image = outputs[group.py_name.value]
+            if isinstance(image, cpi.Image):
+                outputs[group.py_name.value] = rsengine.ScriptImage(
+                    image.pixel_data, image.mask if image.has_mask else None)
+        for group in self.output_object_groups:
+            objects = outputs[group.py_name.value]
+            if isinstance(objects, cpo.Objects):
+                outputs[group.py_name.value] = objects.segmented
+        return outputs
+
+    @contextlib.contextmanager
+    def script_phase(self):
+        '''Time the execution of the script and profile it if requested'''
+        with self.__timer.phase(PH_SCRIPT):
+            if self.__profile is not None:
+                self.__profile.enable()
+            try:
+                yield
+            finally:
+                if self.__profile is not None:
+                    self.__profile.disable()
+
+    def get_feature_prefix(self):
+        '''Return the module name and number that start the feature names
+        of the profile and the resource usage'''
+        return '%s%02d' % (self.module_name, self.module_num)
+
+    def get_profile_features(self):
+        '''Return (category, measurement, type) of the profiling features'''
+        if self.wants_debug_mode.value not in WD_PROFILERS:
+            return []
+        prefix = self.get_feature_prefix()
+        features = [
+            (C_EXECUTION_TIME, prefix + phase, cpmeas.COLTYPE_FLOAT)
+            for phase in (PH_FETCH, PH_SCRIPT, PH_SCRIPT + 'CPU', PH_STORE)]
+        # the governor records the peak memory already if there is a limit
+        if self.wants_debug_mode.value == WD_MEMORY \
+           and self.get_memory_limit() is None:
+            features.append(
+                (C_PEAK_MEMORY, prefix + PH_SCRIPT, cpmeas.COLTYPE_INTEGER))
+        return features
+
+    def record_profile(self, workspace, peak_memory):
+        '''Add the times and memory of the last run() as measurements'''
+        values = {}
+        for category, measurement, coltype in self.get_profile_features():
+            feature = '%s_%s' % (category, measurement)
+            if category == C_PEAK_MEMORY:
+                values[feature] = peak_memory
+            elif measurement.endswith('CPU'):
+                values[feature] = self.__timer.cpu.get(PH_SCRIPT, 0.0)
+            else:
+                phase = measurement[len(self.get_feature_prefix()):]
+                values[feature] = self.__timer.wall.get(phase, 0.0)
+            workspace.measurements.add_image_measurement(feature,
+                                                         values[feature])
+        self.__profile_report.add(workspace.measurements.image_set_number,
+                                  values)
+
+    def write_profile_report(self):
+        '''Write the profile of all image sets to the output folder'''
+        prefix = os.path.join(get_default_output_directory(),
+                              self.get_feature_prefix())
+        extra_text = None
+        if self.__profile is not None:
+            self.__profile.dump_stats(prefix + '_profile.prof')
+            stream = StringIO.StringIO()
+            stats = pstats.Stats(self.__profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(40)
+            extra_text = stream.getvalue()
+        self.__profile_report.write(
+            prefix + '_profile.txt',
+            'Profile of %s #%d' % (self.module_name, self.module_num),
+            extra_text)
+
+    def validate_tiles(self):
+        '''Check that the outputs of the script can be stitched from tiles'''
+        if self.batch_size.value > 1 or self.wants_result_cache.value:
+            raise cps.ValidationError(
+                'Tiles cannot be combined with batches of image sets or the'
+                ' output cache', self.wants_tiles)
+        objects_names = [group.objects.value
+                         for group in self.input_object_groups] \
+            + [group.objects_name.value for group in self.output_object_groups]
+        for group in self.get_image_set_measurement_groups():
+            if not group.relate_to_object.value:
+                raise cps.ValidationError(
+                    'Image measurements cannot be merged from tiles',
+                    group.relate_to_object)
+            if group.object.value not in objects_names:
+                raise cps.ValidationError(
+                    'The objects of a measurement must be input or output'
+                    ' objects of the script when it is run on tiles',
+                    group.object)
+        for group in self.output_table_groups:
+            if group.objects.value not in objects_names:
+                raise cps.ValidationError(
+                    'The objects of a table must be input or output objects'
+                    ' of the script when it is run on tiles', group.objects)
+
+    def run_tiled(self, workspace):
+        '''Run the script on each tile and stitch the outputs of the tiles'''
+        with self.__timer.phase(PH_FETCH):
+            inputs = self.get_script_inputs(workspace)
+        shapes = set(
+            [pixel_data.shape[:2]
+             for pixel_data, mask in inputs['images'].itervalues()]
+            + [labels.shape[:2] for labels in inputs['objects'].itervalues()])
+        if len(shapes) != 1:
+            raise ValueError('The input images and objects must all have the'
+                             ' same size to be divided into tiles')
+        shape = shapes.pop()
+        tiles = rstiling.make_tiles(shape, self.tile_size.value,
+                                    self.tile_halo.value)
+        tile_inputs = [rstiling.crop_inputs(inputs, tile) for tile in tiles]
+        output_names = self.get_output_names()
+        if self.execution_mode.value == EM_WORKER_POOL:
+            with self.script_phase():
+                results = self.run_in_pool(tile_inputs)
+        else:
+            results = []
+            for inputs_of_tile in tile_inputs:
+                with self.script_phase():
+                    namespace = self.__executor.execute(
+                        rsengine.make_attributes(inputs_of_tile))
+                results.append(rsengine.get_outputs(
+                    namespace, output_names,
+                    workspace.measurements.image_set_number))
+        return self.stitch_outputs(inputs, tiles, shape, results)
+
+    def stitch_outputs(self, inputs, tiles, shape, results):
+        '''Assemble the outputs of the image set from those of the tiles'''
+        stitcher = rstiling.TileStitcher(tiles, shape)
+        outputs = {}
+        for group in self.output_image_groups:
+            name = group.py_name.value
+            for tile, tile_outputs in zip(tiles, results):
+                image = tile_outputs[name]
+                stitcher.add_image(name, tile,
+                                   getattr(image, 'pixel_data', image))
+            outputs[name] = stitcher.images[name]
+        for group in self.output_object_groups:
+            name = group.py_name.value
+            objects_name = group.objects_name.value
+            for tile, tile_outputs in zip(tiles, results):
+                objects = tile_outputs[name]
+                stitcher.add_objects(objects_name, tile,
+                                     getattr(objects, 'segmented', objects))
+            outputs[name] = stitcher.objects[objects_name]
+        # input objects keep their numbers
+        for objects_name, labels in inputs['objects'].iteritems():
+            if not stitcher.has_objects(objects_name):
+                stitcher.assign_objects(objects_name, labels)
+        for group in self.get_image_set_measurement_groups():
+            name = group.py_name.value
+            outputs[name] = stitcher.merge_values(
+                group.object.value,
+                [tile_outputs[name] for tile_outputs in results])
+        for group in self.output_table_groups:
+            name = group.py_name.value
+            outputs[name] = stitcher.merge_tables(
+                group.objects.value,
+                [tile_outputs[name] for tile_outputs in results])
+        return outputs
+
+    def run_in_pool(self, inputs_list):
+        '''Run the script in the worker pool for each of several inputs'''
+        try:
+            return self.get_pool().map(inputs_list, self.get_output_names(),
+                                       self.get_time_limit())
+        except rspool.TimeoutError:
+            # the workers may still be running the script
+            self.__pool.terminate()
+            self.__pool = None
+            raise rsgovernor.BudgetExceeded(
+                rsgovernor.R_TIME, self.get_time_limit(),
+                self.get_time_limit())
+
+    def get_pool(self):
+        '''Return the pool of worker processes running the script'''
+        # the pool is started when it is needed for the first time so
+        # that no processes are created when a pipeline is only prepared
+        if self.__pool is None:
+            self.__pool = rspool.WorkerPool(
+                self.__codeobj, self.worker_count.value,
+                self.wants_shared_memory.value, self.__library)
+        return self.__pool
+
+    def run_script(self, workspace, inputs=None):
+        '''Run the script and return a dictionary containing its outputs
+
+        inputs - the inputs for the script as returned by get_script_inputs
+                 or None to collect them from the workspace
+        '''
+        if self.execution_mode.value == EM_WORKER_POOL:
+            if inputs is None:
+                with self.__timer.phase(PH_FETCH):
+                    inputs = self.get_script_inputs(workspace)
+            with self.script_phase():
+                return self.run_in_pool([inputs])[0]
+        if inputs is not None:
+            with self.script_phase():
+                namespace = self.__executor.execute(
+                    rsengine.make_attributes(inputs))
+            # a batch has no single image set to name
+            return rsengine.get_outputs(
+                namespace, self.get_output_names(),
+                workspace.measurements.image_set_number
+                if inputs.get('image_numbers') is None else None)
+        # start fetching the inputs found in the script right away so that
+        # loading them overlaps with the execution of the script
+        if self.wants_prefetch.value:
+            image_names = self.__input_images
+            objects_names = self.__input_objects
+        else:
+            image_names = objects_names = None
+        images = RunScript.__ImageWrapper__(
+            workspace, image_names, self.__timer,
+            PRECISIONS[self.precision.value], self.wants_read_only.value)
+        objects = RunScript.__ObjectWrapper__(
+            workspace, objects_names, self.__timer,
+            self.wants_read_only.value)
+        attributes = rsengine.common_attributes()
+        attributes.update({
+            'IMAGE': cpmeas.IMAGE,
+            'batch_size': 1,
+            'image_numbers': None,
+            'images': images,
+            'objects': objects,
+            'measurements': RunScript.__MeasurementWrapper__(
+                workspace, self.get_history(workspace)),
+            'constants': RunScript.__ConstantWrapper__(self.__constants),
+            'derived': self.get_derived_data_cache(workspace),
+            'tile': None,
+        })
         try:
-            # run script
-            exec self.__codeobj in script_namespace
+            with self.script_phase():
+                namespace = self.__executor.execute(attributes)
+            return rsengine.get_outputs(
+                namespace, self.get_output_names(),
+                workspace.measurements.image_set_number)
         finally:
-            # remove importer hooks
-            sys.meta_path.remove(cpscript_hook_inst)
+            # no fetching may go on while the next modules run
+            images.join()
+            objects.join()
+
+    def get_history(self, workspace):
+        '''Return the index of the measurements of the current group'''
+        if self.__history is None:
+            self.__history = rshistory.MeasurementHistory(
+                self.get_measurement_reader(workspace.measurements))
+        return self.__history
+
+    @staticmethod
+    def get_measurement_reader(measurements):
+        '''Return a function reading a measurement of any image set
+
+        The function is called as get_measurement(object name, feature,
+        image set number) and returns None for missing measurements.
+        '''
+        def get_measurement(object_name, feature, image_number):
+            if not measurements.has_feature(object_name, feature):
+                return None
+            return measurements.get_measurement(
+                object_name, feature, image_set_number=image_number)
+        return get_measurement
+
+    def get_derived_data_cache(self, workspace):
+        '''Return the cache of derived data of the current image set
+
+        The cache is stored in the image set so that it is shared by all
+        RunScript modules of the pipeline.
+        '''
+        image_set = workspace.image_set
+        cache = getattr(image_set, DERIVED_DATA_ATTRIBUTE, None)
+        if cache is None:
+            object_set = workspace.object_set
+            cache = rsmemo.DerivedDataCache(image_set.get_image,
+                                            object_set.get_objects)
+            setattr(image_set, DERIVED_DATA_ATTRIBUTE, cache)
+        return cache
+
+    def clear_derived_data(self, workspace):
+        '''Clear the cache of derived data after the last RunScript module
+
+        The cache may have been filled by earlier modules in any execution
+        mode of this one.
+        '''
+        cache = getattr(workspace.image_set, DERIVED_DATA_ATTRIBUTE, None)
+        if cache is not None and self.is_last_runscript(workspace.pipeline):
+            cache.clear()
+
+    def is_last_runscript(self, pipeline):
+        '''Return True if no RunScript module follows in the pipeline'''
+        return not any(module.module_name == self.module_name
+                       and module.module_num > self.module_num
+                       for module in pipeline.modules())
+
+    def get_later_inputs(self, pipeline):
+        '''Return the names of the images and objects used after this module
+
+        Returns two sets with the names of the images and the objects that
+        are used by any of the following modules. The inputs of RunScript
+        modules are the ones they declare, other modules use the images
+        and objects selected in any of their settings.
+        '''
+        images = set()
+        objects = set()
+        for module in pipeline.modules():
+            if module.module_num <= self.module_num:
+                continue
+            if module.module_name == self.module_name:
+                images.update(group.image.value
+                              for group in module.input_image_groups)
+                objects.update(group.objects.value
+                               for group in module.input_object_groups)
+                continue
+            for setting in module.settings():
+                if isinstance(setting, cps.ImageNameSubscriber):
+                    images.add(setting.value)
+                elif isinstance(setting, cps.ObjectNameSubscriber):
+                    objects.add(setting.value)
+        return images, objects
+
+    def release_inputs(self, workspace):
+        '''Release the inputs of the script that no later module uses
+
+        The data derived from these inputs is dropped from the shared cache
+        and the images are removed from the image set if requested.
+        '''
+        if self.__unused_inputs is None:
+            images, objects = self.get_later_inputs(workspace.pipeline)
+            self.__unused_inputs = (
+                [name for name in set(self.__input_images)
+                 if name not in images],
+                [name for name in set(self.__input_objects)
+                 if name not in objects])
+        unused_images, unused_objects = self.__unused_inputs
+        cache = getattr(workspace.image_set, DERIVED_DATA_ATTRIBUTE, None)
+        if cache is not None:
+            for name in unused_images:
+                cache.release(rsmemo.KIND_IMAGE, name)
+            for name in unused_objects:
+                cache.release(rsmemo.KIND_OBJECTS, name)
+        # older versions of CellProfiler cannot remove images
+        clear_image = getattr(workspace.image_set, 'clear_image', None)
+        if self.wants_evict_inputs.value and clear_image is not None:
+            for name in unused_images:
+                clear_image(name)
+
+    def run_batch(self, workspace):
+        '''Run the script on the collected batch of image sets
+
+        The measurements returned by the script are sequences with one
+        value per image set and are added to the measurements of the
+        corresponding image sets.
+        '''
+        image_numbers = self.__batch_image_numbers
+        inputs = rsengine.stack_inputs(self.__batch, image_numbers)
+        self.__batch = []
+        self.__batch_image_numbers = []
+        outputs = self.run_script(workspace, inputs)
+        with self.__timer.phase(PH_STORE):
+            self.store_batch_outputs(workspace, outputs, image_numbers)
+
+    def store_batch_outputs(self, workspace, outputs, image_numbers):
+        '''Add the measurements of a batch to their image sets'''
+        for group in self.get_image_set_measurement_groups():
+            object_name, measurement_name = \
+                self.get_output_measurement_name(group)
+            values = outputs[group.py_name.value]
+            if len(values) != len(image_numbers):
+                raise ValueError(
+                    'The script returned %d values for %s in a batch of %d'
+                    ' image sets' % (len(values), group.py_name.value,
+                                     len(image_numbers)))
+            for image_number, value in zip(image_numbers, values):
+                workspace.measurements.add_measurement(
+                    object_name,
+                    measurement_name,
+                    value,
+                    image_set_number=image_number
+                )
+        for group in self.output_table_groups:
+            tables = outputs[group.py_name.value]
+            if len(tables) != len(image_numbers):
+                raise ValueError(
+                    'The script returned %d tables for %s in a batch of %d'
+                    ' image sets' % (len(tables), group.py_name.value,
+                                     len(image_numbers)))
+            for image_number, table in zip(image_numbers, tables):
+                self.store_table(workspace, group, table, image_number)
+
+    def store_table(self, workspace, group, table, image_set_number=None):
+        '''Add the columns of an output table as object measurements
+
+        table - a structured array or a dictionary of column arrays
+        image_set_number - the image set to add the measurements to or None
+                           for the current image set
+        '''
+        kwargs = {}
+        if image_set_number is not None:
+            kwargs['image_set_number'] = image_set_number
+        columns = self.get_table_columns()[group.py_name.value]
+        category = group.measurement_category.value
+        for name, coltype in columns:
+            try:
+                values = table[name]
+            except (KeyError, ValueError):
+                raise KeyError('The table %s has no column %s' % (
+                    group.py_name.value, name))
+            dtype = np.int32 if coltype == cpmeas.COLTYPE_INTEGER \
+                else np.float64
+            workspace.measurements.add_measurement(
+                group.objects.value,
+                '%s_%s' % (category, name),
+                np.ascontiguousarray(values, dtype),
+                **kwargs
+            )
+
+    def make_output_image(self, workspace, pixel_data, mask=None):
+        '''Create an image from output pixel data in the chosen precision
+
+        Integer pixel data is scaled by the scale of the integer inputs of
+        the script (see get_native_scale).
+        '''
+        if self.precision.value == PR_DOUBLE:
+            return cpi.Image(pixel_data, mask=mask)
+        scale = None
+        if np.asarray(pixel_data).dtype.kind in 'ui':
+            scale = self.get_native_scale(workspace)
+        pixel_data = rsprecision.to_float(pixel_data, scale)
+        kwargs = {} if scale is None else {'scale': scale}
+        try:
+            # keep single precision data as it is
+            return cpi.Image(pixel_data, mask=mask, convert=False, **kwargs)
+        except TypeError:
+            # this version of CellProfiler always converts the data
+            return cpi.Image(pixel_data, mask=mask)
+
+    def get_native_scale(self, workspace):
+        '''Return the scale of the integer images the script received
+
+        Returns None if the precision is not native or no input image was
+        passed as integers. Raises a ValueError if the input images have
+        different scales.
+        '''
+        if self.precision.value != PR_NATIVE:
+            return None
+        names = set(self.__input_images) | set(
+            group.image.value for group in self.input_image_groups)
+        scales = set()
+        for name in names:
+            scale = getattr(workspace.image_set.get_image(name), 'scale',
+                            None)
+            if rsprecision.is_native(scale):
+                scales.add(scale)
+        if len(scales) > 1:
+            raise ValueError(
+                'The integer input images have different ranges (%s), the'
+                ' range of integer output images is unknown' %
+                ', '.join('0..%g' % scale for scale in sorted(scales)))
+        return scales.pop() if scales else None
+
+    def get_output_names(self):
+        '''Return the names of all script variables used as outputs'''
+        groups = self.output_image_groups + self.output_object_groups \
+            + self.get_image_set_measurement_groups() \
+            + self.output_table_groups
+        return [group.py_name.value for group in groups]
+
+    def get_image_set_measurement_groups(self):
+        '''Return the output measurements set for each image set'''
+        return [group for group in self.output_measurement_groups
+                if not group.wants_group.value]
+
+    def get_group_measurement_groups(self):
+        '''Return the output measurements computed by post_group()'''
+        return [group for group in self.output_measurement_groups
+                if group.wants_group.value]
+
+    def get_script_inputs(self, workspace):
+        '''Collect the declared inputs of the script from the workspace
+
+        The inputs are returned as plain arrays and values so that they can
+        be sent to a worker process (see runscript_support.engine).
+        '''
+        inputs = {
+            'images': {},
+            'objects': {},
+            'measurements': {},
+            'constants': {},
+            'read_only': self.wants_read_only.value,
+        }
+        for group in self.input_image_groups:
+            image = workspace.image_set.get_image(group.image.value)
+            mask = image.mask if image.has_mask else None
+            pixel_data = rsprecision.convert_input(
+                image.pixel_data, PRECISIONS[self.precision.value],
+                getattr(image, 'scale', None))
+            inputs['images'][group.image.value] = (pixel_data, mask)
+        for group in self.input_object_groups:
+            objects = workspace.object_set.get_objects(group.objects.value)
+            inputs['objects'][group.objects.value] = objects.segmented
+        measurements = RunScript.__MeasurementWrapper__(workspace)
+        for group in self.input_measurement_groups:
+            object_name = cpmeas.IMAGE if group.wants_image.value \
+                else group.use_object_name.value
+            key = (object_name, group.measurement.value)
+            inputs['measurements']['_'.join(key)] = measurements[key]
+        inputs['constants'].update(self.__constants)
+        return inputs
+
+    def get_output_measurement_name(self, group):
+        '''Return the object and feature name of an output measurement'''
+        img = None
+        object_name = (cpmeas.IMAGE if not group.relate_to_object.value
+                       else group.object.value)
+        if group.on_image.value:
+            # if the value of group.relate_to_object.value is False,
+            # group.on_image.value will be True (see visible_settings),
+            img = group.image.value
+        if img is None:
+            measurement_name = "%s_%s" % (
+                group.measurement_category.value,
+                group.measurement_name.value
+            )
+        else:
+            measurement_name = "%s_%s_%s" % (
+                group.measurement_category.value,
+                group.measurement_name.value,
+                img
+            )
+        return object_name, measurement_name
+
+    def store_outputs(self, workspace, outputs):
+        '''Add the outputs of the script to the workspace
+
+        outputs - dictionary mapping the python names of the outputs to
+                  their values
+        '''
         # retrieve output images from the script namespace
         for group in self.output_image_groups:
-            image = script_namespace[group.py_name.value]
-            if not isinstance(image, cpi.Image):
-                image = cpi.Image(image)
+            image = rsreadonly.unwrap(outputs[group.py_name.value])
+            if isinstance(image, rsengine.ScriptImage):
+                image = self.make_output_image(workspace, image.pixel_data,
+                                               image.mask)
+            elif not isinstance(image, cpi.Image):
+                image = self.make_output_image(workspace, image)
             workspace.image_set.add(group.image_name.value, image)
         # retrieve output objects from the script namespace
         for group in self.output_object_groups:
-            objects = script_namespace[group.py_name.value]
-            if not isinstance(objects, cpo.Objects):
+            objects = rsreadonly.unwrap(outputs[group.py_name.value])
+            if isinstance(objects, rssparse.SparseObjects):
+                new_objects = cpo.Objects()
+                if hasattr(new_objects, 'set_ijv'):
+                    # the pixels are stored without a dense label matrix
+                    new_objects.set_ijv(objects.ijv, objects.shape)
+                else:
+                    new_objects.segmented = objects.segmented
+                objects = new_objects
+            elif not isinstance(objects, cpo.Objects):
                 new_objects = cpo.Objects()
                 new_objects.segmented = objects
                 objects = new_objects
             workspace.object_set.add_objects(objects, group.objects_name.value)
         # retrieve output measurements from the script namespace
-        for group in self.output_measurement_groups:
-            img = None
-            object_name = (cpmeas.IMAGE if not group.relate_to_object.value
-                           else group.object.value)
-            if group.on_image.value:
-                # if the value of group.relate_to_object.value is False,
-                # group.on_image.value will be True (see visible_settings),
-                img = group.image.value
-            py_name = group.py_name.value
-            measurement = script_namespace[py_name]
-            if img is None:
-                measurement_name = "%s_%s" % (
-                    group.measurement_category.value,
-                    group.measurement_name.value
-                )
-            else:
-                measurement_name = "%s_%s_%s" % (
-                    group.measurement_category.value,
-                    group.measurement_name.value,
-                    img
-                )
+        for group in self.get_image_set_measurement_groups():
+            object_name, measurement_name = \
+                self.get_output_measurement_name(group)
+            measurement = outputs[group.py_name.value]
             if object_name == cpmeas.IMAGE:
                 workspace.measurements.add_image_measurement(
                     measurement_name,
@@ -892,10 +2383,102 @@ class RunScript(cpm.CPModule):
                     measurement_name,
                     measurement
                 )
+        # retrieve output tables from the script namespace
+        for group in self.output_table_groups:
+            self.store_table(workspace, group, outputs[group.py_name.value])
+
+    def prepare_group(self, workspace, grouping, image_numbers):
+        # the measurement history starts again with each group
+        self.__history = None
+        self.__group_image_numbers = []
+        return True
+
+    def post_group(self, workspace, grouping):
+        # run the script on the incomplete last batch of the group
+        if self.batch_size.value > 1 and len(self.__batch) > 0:
+            self.__timer = rsprofiling.PhaseTimer()
+            self.run_batch(workspace)
+        if len(self.get_group_measurement_groups()) > 0 \
+           and len(self.__group_image_numbers) > 0:
+            self.run_group_script(workspace)
+
+    def run_group_script(self, workspace):
+        '''Call post_group() of the script and store its measurements'''
+        image_numbers = self.__group_image_numbers
+        self.__group_image_numbers = []
+        group_measurements = rshistory.GroupMeasurements(
+            image_numbers,
+            self.get_measurement_reader(workspace.measurements))
+        attributes = rsengine.common_attributes()
+        attributes.update({
+            'IMAGE': cpmeas.IMAGE,
+            'batch_size': len(image_numbers),
+            'image_numbers': group_measurements.image_numbers,
+            'images': {},
+            'objects': {},
+            'measurements': rsengine.MeasurementDict(),
+            'group_measurements': group_measurements,
+            'constants': RunScript.__ConstantWrapper__(self.__constants),
+            'derived': None,
+            'tile': None,
+        })
+        outputs = self.__executor.call(rsengine.POST_GROUP_FUNCTION,
+                                       attributes)
+        if not isinstance(outputs, dict):
+            raise ValueError('post_group() has to return a dictionary with'
+                             ' the measurements of the group')
+        self.store_group_outputs(workspace, outputs, image_numbers)
+
+    def store_group_outputs(self, workspace, outputs, image_numbers):
+        '''Add the measurements returned by post_group() to the image sets
+
+        Object measurements can be one array with the values of the objects
+        of all image sets, which is split by the object counts.
+        '''
+        measurements = workspace.measurements
+        for group in self.get_group_measurement_groups():
+            name = group.py_name.value
+            if name not in outputs:
+                raise KeyError(
+                    'post_group() did not return the measurement %s' % name)
+            object_name, measurement_name = \
+                self.get_output_measurement_name(group)
+            values = outputs[name]
+            if object_name != cpmeas.IMAGE \
+               and not isinstance(values, (list, tuple)):
+                counts = [int(measurements.get_measurement(
+                    cpmeas.IMAGE, 'Count_%s' % object_name,
+                    image_set_number=image_number))
+                    for image_number in image_numbers]
+                if len(values) != sum(counts):
+                    raise ValueError(
+                        'post_group() returned %d values for %s but the group'
+                        ' has %d %s' % (len(values), name, sum(counts),
+                                        object_name))
+                values = np.split(np.asarray(values), np.cumsum(counts)[:-1])
+            if len(values) != len(image_numbers):
+                raise ValueError(
+                    'post_group() returned %d values for %s in a group of %d'
+                    ' image sets' % (len(values), name, len(image_numbers)))
+            for image_number, value in zip(image_numbers, values):
+                measurements.add_measurement(
+                    object_name,
+                    measurement_name,
+                    value,
+                    image_set_number=image_number
+                )
 
     def post_run(self, workspace):
+        # stop the worker processes and remove their shared arrays
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool = None
+        if self.wants_debug_mode.value in WD_PROFILERS \
+           and len(self.__profile_report.rows) > 0:
+            self.write_profile_report()
         # remove temporary file
-        os.remove(self.__tmpfile_path)
+        if self.__tmpfile_path is not None:
+            os.remove(self.__tmpfile_path)
 
     ################################
     #
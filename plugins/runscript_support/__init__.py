@@ -0,0 +1,6 @@
+'''Support code for the RunScript module
+
+The modules in this package do not depend on CellProfiler so that they can
+be used by the RunScript module as well as by worker processes and tools
+that execute RunScript scripts outside of a CellProfiler pipeline.
+'''
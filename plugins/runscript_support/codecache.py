@@ -0,0 +1,134 @@
+'''On-disk cache of compiled RunScript scripts
+
+Entries are keyed by a hash of the script source, the debug mode and the
+bytecode version of the interpreter. Each entry consists of the source
+file, which the code object refers to for tracebacks and debuggers, and a
+marshal file with the code object and the inputs found in the script. The
+least recently used entries are removed when the cache grows too large.
+'''
+
+import os
+import imp
+import errno
+import marshal
+import hashlib
+import tempfile
+
+CODE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'CPRunScript_cache')
+CODE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SOURCE_EXT = '.py'
+CODE_EXT = '.rsc'
+
+
+class CodeCache(object):
+    '''A size-bounded cache of code objects and script inputs
+
+    directory - the directory to store the entries in
+    max_bytes - the maximum total size of all entries
+    '''
+    def __init__(self, directory=CODE_CACHE_DIR,
+                 max_bytes=CODE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(source, *variant):
+        '''Return the cache key for a script source
+
+        variant - further strings that change the compiled code
+        '''
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        digest = hashlib.sha1(imp.get_magic())
+        for part in variant:
+            digest.update(part.encode('utf-8') + '\0')
+        digest.update(source)
+        return digest.hexdigest()
+
+    def source_path(self, key):
+        '''Return the path of the source file to compile an entry with'''
+        return os.path.join(self.directory, 'CPRunScript_' + key + SOURCE_EXT)
+
+    def get(self, key):
+        '''Return the cached value for a key or None'''
+        code_path = self.__code_path(key)
+        try:
+            with open(code_path, 'rb') as f:
+                value = marshal.load(f)
+            # mark the entry as recently used
+            os.utime(code_path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not os.path.exists(self.source_path(key)):
+            return None
+        return value
+
+    def put(self, key, source, value):
+        '''Store the source of a script and a marshallable value
+
+        The code objects in value must have been compiled with the
+        file name returned by source_path(key).
+        '''
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        make_directory(self.directory)
+        write_file(self.source_path(key), source)
+        write_file(self.__code_path(key), marshal.dumps(value))
+        self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits'''
+        evict(self.directory, (CODE_EXT, SOURCE_EXT), self.max_bytes)
+
+    def __code_path(self, key):
+        return os.path.join(self.directory, 'CPRunScript_' + key + CODE_EXT)
+
+
+def make_directory(directory):
+    '''Create a cache directory if it does not exist yet'''
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def write_file(path, data):
+    '''Write a cache file atomically'''
+    # write to a temporary file and rename it so that concurrent jobs
+    # never see a partially written entry
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def evict(directory, extensions, max_bytes):
+    '''Remove the least recently used entries of a cache directory
+
+    directory - the directory of the cache
+    extensions - the extensions of the files of an entry, the files of an
+                 entry share the name without the extension
+    max_bytes - the maximum total size of all entries
+    '''
+    entries = {}
+    for filename in os.listdir(directory):
+        stem, ext = os.path.splitext(filename)
+        if ext not in extensions:
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        size, mtime = entries.get(stem, (0, 0))
+        entries[stem] = (size + stat.st_size, max(mtime, stat.st_mtime))
+    total = sum(size for size, mtime in entries.itervalues())
+    for stem in sorted(entries, key=lambda stem: entries[stem][1]):
+        if total <= max_bytes:
+            break
+        for ext in extensions:
+            try:
+                os.remove(os.path.join(directory, stem + ext))
+            except OSError:
+                pass
+        total -= entries[stem][0]
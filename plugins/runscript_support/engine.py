@@ -0,0 +1,375 @@
+'''Execution of compiled RunScript scripts
+
+The script accesses its inputs through the module cellprofiler.cpscript.
+This module is not a real module but is provided by an importer hook
+(see PEP302, http://www.python.org/dev/peps/pep-0302/) while the script
+is running. The modules of a script library (see library) are provided
+as its subpackage cellprofiler.cpscript.lib.
+'''
+
+import sys
+import imp
+import types
+import contextlib
+
+import numpy as np
+
+from runscript_support import library
+from runscript_support import memo
+from runscript_support import parallel
+from runscript_support import readonly
+from runscript_support import regions
+from runscript_support import sparse
+
+CPSCRIPT_PACKAGE = 'cellprofiler'
+CPSCRIPT_NAME = 'cpscript'
+CPSCRIPT_MODULE = '%s.%s' % (CPSCRIPT_PACKAGE, CPSCRIPT_NAME)
+LIBRARY_PACKAGE = '%s.%s' % (CPSCRIPT_MODULE, library.LIBRARY_NAME)
+SCRIPT_NAME = '<runscript script>'
+SETUP_FUNCTION = 'setup'
+RUN_FUNCTION = 'run'
+POST_GROUP_FUNCTION = 'post_group'
+IMAGE = 'Image'
+
+
+class CPScriptHook(object):
+    '''Finder and loader object for the cpscript module
+
+    The module can be imported by the script as:
+      from cellprofiler import cpscript
+    The module object is kept by the hook so that functions defined by a
+    script keep seeing the current inputs when the hook is installed again.
+
+    library - the script library (see library.ScriptLibrary) whose modules
+              are imported from cellprofiler.cpscript.lib or None
+    '''
+    def __init__(self, library=None):
+        self.library = library
+        self.module = imp.new_module(CPSCRIPT_MODULE)
+        self.module.__file__ = "<%s>" % self.__class__.__name__
+        self.module.__loader__ = self
+        # the module is a package so that the library can be imported
+        self.module.__path__ = []
+
+    def find_module(self, fullname, path=None):
+        if fullname == CPSCRIPT_MODULE:
+            return self
+        if self.library is not None:
+            return self.library.find_module(fullname, path)
+
+    def load_module(self, fullname):
+        sys.modules[fullname] = self.module
+        return self.module
+
+    def install(self, attributes):
+        '''Update the attributes of the module and add the hook
+
+        attributes - dictionary of names provided by the cpscript module
+        '''
+        self.module.__dict__.update(attributes)
+        self.__forget_module()
+        sys.meta_path.append(self)
+
+    def uninstall(self):
+        '''Remove the hook and any imported instance of the module'''
+        sys.meta_path.remove(self)
+        self.__forget_module()
+
+    def __forget_module(self):
+        # the import machinery caches the module in sys.modules and as an
+        # attribute of the parent package, both have to go so that the
+        # next import of the script is served by the currently active hook
+        sys.modules.pop(CPSCRIPT_MODULE, None)
+        if self.library is not None:
+            self.library.forget()
+        package = sys.modules.get(CPSCRIPT_PACKAGE)
+        if package is not None and CPSCRIPT_NAME in package.__dict__:
+            delattr(package, CPSCRIPT_NAME)
+
+
+def ensure_cpscript_package():
+    '''Make sure that the parent package of cpscript can be imported
+
+    Outside of CellProfiler an empty package takes its place so that
+    scripts can import cpscript from it.
+    '''
+    try:
+        __import__(CPSCRIPT_PACKAGE)
+    except ImportError:
+        package = imp.new_module(CPSCRIPT_PACKAGE)
+        package.__path__ = []
+        sys.modules[CPSCRIPT_PACKAGE] = package
+
+
+def get_library(directory, code_cache=True):
+    '''Return the script library of a directory (see library.get_library)'''
+    return library.get_library(directory, LIBRARY_PACKAGE, code_cache)
+
+
+def defines_function(codeobj, name):
+    '''Return True if a function is defined at the top level of the code'''
+    return any(isinstance(const, types.CodeType) and const.co_name == name
+               for const in codeobj.co_consts)
+
+
+@contextlib.contextmanager
+def _unguarded():
+    yield
+
+
+class ScriptExecutor(object):
+    '''Runs a compiled script with the inputs provided through cpscript
+
+    codeobj - the code object of the compiled script
+    library - the script library the script can import from or None
+
+    If the script defines a top-level function run(), the script is split
+    into two phases. The body of the script and an optional function
+    setup() are executed only once, the first time the script is run. The
+    resulting namespace is kept and only run() is called for each further
+    execution. Each execution returns a copy of that namespace to which
+    the dictionary returned by run() is added, so that it can provide the
+    outputs of the script. Outputs returned by an earlier call are not
+    kept, an output missing from the result of run() is not set. Further
+    top-level functions of such a script, e.g. post_group(), can be called
+    with call.
+
+    guard can be set to a function returning a context manager that is
+    entered around the code of the script only, e.g.
+    governor.ResourceGovernor.guard. Installing and removing the cpscript
+    module happen outside of it.
+    '''
+    def __init__(self, codeobj, library=None):
+        self.codeobj = codeobj
+        self.hook = CPScriptHook(library)
+        self.phased = defines_function(codeobj, RUN_FUNCTION)
+        self.namespace = None
+        self.guard = None
+
+    def execute(self, attributes):
+        '''Run the script and return the namespace it has been run in
+
+        attributes - dictionary of names provided by the cpscript module
+        '''
+        self.hook.install(attributes)
+        try:
+            with self.__guard():
+                if not self.phased or self.namespace is None:
+                    namespace = self.__new_namespace()
+                    exec self.codeobj in namespace
+                    if self.phased:
+                        self.__setup(namespace)
+                if self.phased:
+                    outputs = self.namespace[RUN_FUNCTION]()
+            if self.phased:
+                namespace = dict(self.namespace)
+                if isinstance(outputs, dict):
+                    namespace.update(outputs)
+        finally:
+            self.hook.uninstall()
+        return namespace
+
+    def call(self, name, attributes):
+        '''Call a top-level function of a phased script and return its result
+
+        name - the name of the function
+        attributes - dictionary of names provided by the cpscript module
+
+        The body of the script and setup() are run first if this has not
+        happened in this process yet.
+        '''
+        self.hook.install(attributes)
+        try:
+            with self.__guard():
+                if self.namespace is None:
+                    namespace = self.__new_namespace()
+                    exec self.codeobj in namespace
+                    self.__setup(namespace)
+                return self.namespace[name]()
+        finally:
+            self.hook.uninstall()
+
+    def __guard(self):
+        if self.guard is None:
+            return _unguarded()
+        return self.guard()
+
+    def __setup(self, namespace):
+        setup = namespace.get(SETUP_FUNCTION)
+        if callable(setup):
+            setup()
+        self.namespace = namespace
+
+    def reset(self):
+        '''Discard the namespace kept by setup() for a phased script'''
+        self.namespace = None
+
+    @staticmethod
+    def __new_namespace():
+        # set up a namespace for the script to run in
+        return {
+            '__name__': SCRIPT_NAME,
+            '__package__': None,
+            '__doc__': None,
+        }
+
+
+class ScriptImage(object):
+    '''Minimal stand-in for cpi.Image outside of the CellProfiler process'''
+    def __init__(self, pixel_data, mask=None):
+        self.pixel_data = pixel_data
+        self.mask = mask
+
+    @property
+    def has_mask(self):
+        return self.mask is not None
+
+
+class ScriptObjects(object):
+    '''Minimal stand-in for cpo.Objects outside of the CellProfiler process'''
+    def __init__(self, segmented):
+        self.segmented = segmented
+
+
+class MeasurementDict(dict):
+    '''Measurements keyed by '<object>_<feature>' or (object, feature)'''
+    def __setitem__(self, key, value):
+        if hasattr(key, '__iter__'):
+            key = '_'.join(key)
+        super(MeasurementDict, self).__setitem__(key, value)
+
+    def __getitem__(self, key):
+        if hasattr(key, '__iter__'):
+            key = '_'.join(key)
+        return super(MeasurementDict, self).__getitem__(key)
+
+    def history(self, key, with_image_numbers=False):
+        '''Not available outside of the CellProfiler process'''
+        raise RuntimeError(
+            'The measurement history is only available when the script is'
+            ' run in the CellProfiler process one image set at a time')
+
+
+def get_outputs(namespace, output_names, image_number=None):
+    '''Return the outputs of a script from the namespace it has been run in
+
+    output_names - the names of the output variables
+    image_number - the number of the image set for the error message or
+                   None
+
+    Raises a KeyError if the script did not set some of the outputs.
+    '''
+    missing = [name for name in output_names if name not in namespace]
+    if missing:
+        message = 'The script did not set %s' % ', '.join(missing)
+        if image_number is not None:
+            message += ' for image set %d' % image_number
+        raise KeyError(message)
+    return dict((name, namespace[name]) for name in output_names)
+
+
+def common_attributes():
+    '''Return the attributes of the cpscript module that are not inputs'''
+    return {
+        'IMAGE': IMAGE,
+        'regions': regions,
+        'parallel_map': parallel.parallel_map,
+        'sparse': sparse,
+        'writable': readonly.writable,
+        'columns': {},
+    }
+
+
+def make_attributes(inputs):
+    '''Create the attributes of the cpscript module from shipped inputs
+
+    inputs - dictionary with the keys 'images' (name -> (pixel_data, mask)),
+             'objects' (name -> segmented), 'measurements' (key -> value)
+             and 'constants' (name -> value). Stacked inputs (see
+             stack_inputs) also have the keys 'batch_size' and
+             'image_numbers', the inputs of a tile (see tiling.crop_inputs)
+             the key 'tile'. If the key 'read_only' is True, the arrays
+             of the images and objects are read-only views.
+    '''
+    measurements = MeasurementDict()
+    for key, value in inputs['measurements'].iteritems():
+        measurements[key] = value
+    if inputs.get('read_only', False):
+        view = readonly.read_only
+    else:
+        view = lambda array: array
+    images = dict(
+        (name, ScriptImage(view(pixel_data), view(mask)))
+        for name, (pixel_data, mask) in inputs['images'].iteritems())
+    objects = dict(
+        (name, ScriptObjects(view(segmented)))
+        for name, segmented in inputs['objects'].iteritems())
+    attributes = common_attributes()
+    attributes.update({
+        'batch_size': inputs.get('batch_size', 1),
+        'image_numbers': inputs.get('image_numbers'),
+        'tile': inputs.get('tile'),
+        'images': images,
+        'objects': objects,
+        'measurements': measurements,
+        'derived': memo.DerivedDataCache(images.__getitem__,
+                                         objects.__getitem__),
+        'constants': dict(inputs['constants']),
+    })
+    return attributes
+
+
+def stack_arrays(arrays, fill=0):
+    '''Stack arrays along a new first axis, padding them to a common shape
+
+    arrays - a list of arrays with the same number of dimensions
+    fill - the value for the padded elements
+    '''
+    shape = tuple(np.max([array.shape for array in arrays], axis=0))
+    if all(array.shape == shape for array in arrays):
+        return np.array(arrays)
+    dtype = np.result_type(*arrays)
+    stacked = np.empty((len(arrays),) + shape, dtype)
+    stacked.fill(fill)
+    for stacked_array, array in zip(stacked, arrays):
+        stacked_array[tuple(slice(0, n) for n in array.shape)] = array
+    return stacked
+
+
+def stack_inputs(inputs_list, image_numbers):
+    '''Combine the inputs of several image sets into a batch
+
+    inputs_list - the inputs of each image set (see make_attributes)
+    image_numbers - the image set number of each image set
+
+    Images and label matrices are stacked along a new first axis and
+    padded with zeros if their shapes differ. Image measurements become
+    one array, object measurements a list with an array per image set.
+    '''
+    first = inputs_list[0]
+    batch = {
+        'images': {},
+        'objects': {},
+        'measurements': {},
+        'constants': first['constants'],
+        'read_only': first.get('read_only', False),
+        'batch_size': len(inputs_list),
+        'image_numbers': np.array(image_numbers),
+    }
+    for name in first['images']:
+        pixel_data = [inputs['images'][name][0] for inputs in inputs_list]
+        masks = [inputs['images'][name][1] for inputs in inputs_list]
+        if any(mask is None for mask in masks):
+            mask = None
+        else:
+            mask = stack_arrays(masks, False)
+        batch['images'][name] = (stack_arrays(pixel_data), mask)
+    for name in first['objects']:
+        batch['objects'][name] = stack_arrays(
+            [inputs['objects'][name] for inputs in inputs_list])
+    for key in first['measurements']:
+        values = [inputs['measurements'][key] for inputs in inputs_list]
+        if all(np.isscalar(value) for value in values):
+            values = np.array(values)
+        batch['measurements'][key] = values
+    return batch
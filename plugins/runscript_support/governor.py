@@ -0,0 +1,168 @@
+'''Wall-time and memory budgets for running a script
+
+A ResourceGovernor watches the thread running a script from a timer and a
+memory sampling thread. If a budget is exceeded while the code of the
+script runs (see ResourceGovernor.guard), an exception is raised
+asynchronously in the watched thread, which interrupts the script at the
+next Python instruction. Long calls into compiled code, e.g. a single
+NumPy operation, finish before the script is interrupted. The code around
+the script, e.g. storing its outputs, is never interrupted, a budget
+exceeded there is reported when the governed block ends.
+'''
+
+import time
+import ctypes
+import threading
+import contextlib
+
+from runscript_support import profiling
+
+R_TIME = 'time'
+R_MEMORY = 'memory'
+
+
+class BudgetExceeded(Exception):
+    '''Raised when a script has exceeded its time or memory budget
+
+    resource - R_TIME or R_MEMORY
+    limit - the budget in seconds or bytes
+    usage - the time or memory used until the script was stopped
+    '''
+    def __init__(self, resource, limit, usage):
+        if resource == R_TIME:
+            text = 'ran for %.1f s, the limit is %.1f s' % (usage, limit)
+        else:
+            text = 'allocated %.1f MB, the limit is %.1f MB' % (
+                usage / 2.0 ** 20, limit / 2.0 ** 20)
+        Exception.__init__(self, 'The script %s' % text)
+        self.resource = resource
+        self.limit = limit
+        self.usage = usage
+
+
+class _Interrupt(BaseException):
+    # raised asynchronously in the watched thread, derived from
+    # BaseException so that "except Exception" in a script does not stop it
+    pass
+
+
+def _interrupt(thread_id, exception):
+    '''Raise an exception in another thread, None cancels a pending one'''
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread_id),
+        None if exception is None else ctypes.py_object(exception))
+
+
+class ResourceGovernor(object):
+    '''Context manager enforcing budgets on the code run inside of it
+
+    time_limit - the wall-time budget in seconds or None
+    memory_limit - the budget for the increase of the resident memory in
+                   bytes or None
+    interval - the memory sampling interval in seconds
+
+    After the block, elapsed is the wall time and peak_memory the peak
+    memory increase (only measured if there is a memory budget). A block
+    that exceeds a budget raises BudgetExceeded. Only the parts of the
+    block run in guard() are interrupted.
+    '''
+    def __init__(self, time_limit=None, memory_limit=None, interval=0.01):
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.interval = interval
+        self.elapsed = 0.0
+        self.peak_memory = 0
+        self.exceeded = None
+        self.__lock = threading.Lock()
+        self.__active = False
+        self.__guarded = False
+
+    def __enter__(self):
+        self.exceeded = None
+        self.peak_memory = 0
+        self.__thread_id = threading.current_thread().ident
+        self.__active = True
+        self.__timer = None
+        self.__monitor = None
+        self.__start = time.time()
+        if self.time_limit:
+            self.__timer = threading.Timer(self.time_limit, self.__exceed,
+                                           (R_TIME,))
+            self.__timer.daemon = True
+            self.__timer.start()
+        if self.memory_limit:
+            self.__monitor = profiling.PeakMemoryMonitor(
+                self.interval, callback=self.__check_memory)
+            self.__monitor.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self.__lock:
+            self.__active = False
+            if self.exceeded is not None:
+                # guard() has cancelled the interrupt already, but nothing
+                # may be left pending for the code after the block
+                _interrupt(self.__thread_id, None)
+        self.elapsed = time.time() - self.__start
+        if self.__timer is not None:
+            self.__timer.cancel()
+        if self.__monitor is not None:
+            self.peak_memory = self.__monitor.stop()
+        # an interrupt that escaped guard(), e.g. delivered in the code of
+        # the context manager itself, is replaced by BudgetExceeded as well
+        if self.exceeded == R_TIME:
+            raise BudgetExceeded(R_TIME, self.time_limit, self.elapsed)
+        elif self.exceeded == R_MEMORY:
+            raise BudgetExceeded(R_MEMORY, self.memory_limit,
+                                 self.peak_memory)
+        return False
+
+    @contextlib.contextmanager
+    def guard(self):
+        '''Allow the code run inside of it to be interrupted
+
+        Raises BudgetExceeded right away if a budget has already been
+        exceeded and if the code inside is interrupted.
+        '''
+        with self.__lock:
+            if self.exceeded is None:
+                self.__guarded = True
+        if not self.__guarded:
+            self.__raise_exceeded()
+        try:
+            try:
+                yield
+            finally:
+                self.__unguard()
+        except _Interrupt:
+            # the interrupt can also be delivered after the code inside has
+            # finished but before __unguard has cancelled it
+            self.__unguard()
+            self.__raise_exceeded()
+
+    def __unguard(self):
+        with self.__lock:
+            if self.__guarded and self.exceeded is not None:
+                # cancel the interrupt in case it has not been delivered
+                # yet, it must not stop the code after the script
+                _interrupt(self.__thread_id, None)
+            self.__guarded = False
+
+    def __raise_exceeded(self):
+        if self.exceeded == R_TIME:
+            raise BudgetExceeded(R_TIME, self.time_limit,
+                                 time.time() - self.__start)
+        raise BudgetExceeded(R_MEMORY, self.memory_limit,
+                             self.__monitor.peak if self.__monitor else 0)
+
+    def __check_memory(self, increase):
+        if increase > self.memory_limit:
+            self.__exceed(R_MEMORY)
+
+    def __exceed(self, resource):
+        with self.__lock:
+            if not self.__active or self.exceeded is not None:
+                return
+            self.exceeded = resource
+            if self.__guarded:
+                _interrupt(self.__thread_id, _Interrupt)
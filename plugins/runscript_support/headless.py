@@ -0,0 +1,316 @@
+'''Run a RunScript script over a directory of images without CellProfiler
+
+Usage (from the plugins directory):
+  python -m runscript_support.headless script.py ../test/images \
+      --image 'DNA=dapi\.tif$' --labels 'Nuclei=nuclei\.npy$' \
+      --measurement py_img_output --measurement Nuclei:py_obj_output \
+      --output results.csv --workers 4 --library ~/cpscript_lib
+
+Each --image and --labels option assigns the files whose name matches a
+regular expression to an input of the script. If the expressions have
+named groups, e.g. '(?P<Well>[A-P][0-9]{2})_dapi\.tif', files with the
+same values of the groups form an image set. Otherwise the matching files
+of each input are paired in the order of their names.
+
+The image sets are run in a pool of worker processes that load the files
+themselves. The measurements are written in the order of the image sets
+as soon as they are available, so that large archives can be processed
+without keeping all results in memory. A measurement 'NAME' is an image
+measurement with one value per image set, 'OBJECTS:NAME' is an object
+measurement with one value per object. The modules of the --library
+directory can be imported from cellprofiler.cpscript.lib as in
+CellProfiler.
+
+Output formats:
+  .csv - image measurements in the given file with one row per image set,
+         object measurements in '<file>_<OBJECTS>.csv' with one row per
+         object
+  .npz - one array '<NAME>_<image number>' per measurement and image set
+'''
+
+import os
+import re
+import io
+import csv
+import sys
+import ast
+import marshal
+import zipfile
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+from runscript_support import engine
+
+# the script executor of a worker process
+_executor = None
+
+
+def _init_worker(code_string, library_dir):
+    global _executor
+    engine.ensure_cpscript_package()
+    library = None
+    if library_dir is not None:
+        library = engine.get_library(library_dir)
+    _executor = engine.ScriptExecutor(marshal.loads(code_string), library)
+
+
+def _run_image_set(image_set, constants, output_names):
+    image_number, files = image_set[:2]
+    inputs = {
+        'images': {},
+        'objects': {},
+        'measurements': {},
+        'constants': constants,
+    }
+    for name, path in files['images'].iteritems():
+        inputs['images'][name] = (load_array(path), None)
+    for name, path in files['objects'].iteritems():
+        inputs['objects'][name] = load_array(path, labels=True)
+    namespace = _executor.execute(engine.make_attributes(inputs))
+    return engine.get_outputs(namespace, output_names, image_number)
+
+
+def load_array(path, labels=False):
+    '''Load an image or a label matrix from a file
+
+    Arrays saved by numpy are loaded as they are, other files are read
+    with PIL. The intensities of integer images are scaled to 0..1 by the
+    maximum of their type like CellProfiler does.
+    '''
+    if path.endswith('.npy'):
+        data = np.load(path)
+    elif PILImage is None:
+        raise IOError('PIL is needed to read %s' % path)
+    else:
+        data = np.asarray(PILImage.open(path))
+    if labels:
+        return data.astype(np.int32)
+    if data.dtype.kind in 'ui':
+        data = data.astype(np.float64) / np.iinfo(data.dtype).max
+    return data
+
+
+def find_image_sets(directory, image_patterns, label_patterns):
+    '''Group the files of a directory into image sets
+
+    image_patterns, label_patterns - lists of (input name, regex) tuples
+
+    Returns a list of (image number, files, metadata) tuples with files
+    being a dictionary {'images': {name: path}, 'objects': {name: path}}.
+    '''
+    file_names = sorted(os.listdir(directory))
+    patterns = [('images', name, re.compile(pattern))
+                for name, pattern in image_patterns] \
+        + [('objects', name, re.compile(pattern))
+           for name, pattern in label_patterns]
+    if not patterns:
+        raise ValueError('No input images or labels have been given')
+    by_key = {}
+    for kind, name, pattern in patterns:
+        matches = [(file_name, pattern.search(file_name))
+                   for file_name in file_names]
+        matches = [(file_name, match) for file_name, match in matches
+                   if match is not None]
+        for index, (file_name, match) in enumerate(matches):
+            if pattern.groupindex:
+                key = tuple(sorted(match.groupdict().items()))
+            else:
+                key = index
+            files = by_key.setdefault(key, {'images': {}, 'objects': {}})
+            if name in files[kind]:
+                raise ValueError('%s and %s both match %s for the same'
+                                 ' image set' % (files[kind][name],
+                                                 file_name, name))
+            files[kind][name] = os.path.join(directory, file_name)
+    image_sets = []
+    for key in sorted(by_key):
+        files = by_key[key]
+        found = len(files['images']) + len(files['objects'])
+        if found != len(patterns):
+            print >> sys.stderr, 'Skipping incomplete image set %s' % (key,)
+            continue
+        metadata = dict(key) if isinstance(key, tuple) else {}
+        image_sets.append((len(image_sets) + 1, files, metadata))
+    return image_sets
+
+
+class CSVWriter(object):
+    '''Writes image measurements and object measurements to CSV files'''
+    def __init__(self, path, image_names, object_names):
+        self.path = path
+        self.image_names = image_names
+        self.object_names = object_names
+        self.__files = []
+        self.__image_writer = None
+        self.__object_writers = {}
+
+    def __open(self, path, header):
+        f = open(path, 'wb')
+        self.__files.append(f)
+        writer = csv.writer(f)
+        writer.writerow(header)
+        return writer
+
+    def write(self, image_number, files, metadata, outputs):
+        if self.__image_writer is None:
+            self.__metadata_keys = sorted(metadata)
+            self.__file_keys = sorted(
+                (kind, name) for kind in files for name in files[kind])
+            header = ['ImageNumber'] \
+                + ['Metadata_%s' % key for key in self.__metadata_keys] \
+                + ['FileName_%s' % name for kind, name in self.__file_keys] \
+                + self.image_names
+            self.__image_writer = self.__open(self.path, header)
+            base = os.path.splitext(self.path)[0]
+            for objects in sorted(set(o for o, name in self.object_names)):
+                header = ['ImageNumber', 'ObjectNumber'] + [
+                    name for o, name in self.object_names if o == objects]
+                self.__object_writers[objects] = self.__open(
+                    '%s_%s.csv' % (base, objects), header)
+        self.__image_writer.writerow(
+            [image_number]
+            + [metadata.get(key, '') for key in self.__metadata_keys]
+            + [os.path.basename(files[kind][name])
+               for kind, name in self.__file_keys]
+            + [outputs[name] for name in self.image_names])
+        for objects, writer in self.__object_writers.iteritems():
+            names = [name for o, name in self.object_names if o == objects]
+            columns = [np.atleast_1d(outputs[name]) for name in names]
+            for index, row in enumerate(zip(*columns)):
+                writer.writerow([image_number, index + 1] + list(row))
+
+    def close(self):
+        for f in self.__files:
+            f.close()
+
+
+class NPZWriter(object):
+    '''Writes each measurement of each image set as an array of an .npz'''
+    def __init__(self, path, image_names, object_names):
+        self.names = image_names + [name for o, name in object_names]
+        self.__zipfile = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                                         allowZip64=True)
+
+    def write(self, image_number, files, metadata, outputs):
+        for name in self.names:
+            stream = io.BytesIO()
+            np.lib.format.write_array(stream, np.asanyarray(outputs[name]))
+            self.__zipfile.writestr('%s_%d.npy' % (name, image_number),
+                                    stream.getvalue())
+
+    def close(self):
+        self.__zipfile.close()
+
+
+WRITERS = {
+    '.csv': CSVWriter,
+    '.npz': NPZWriter,
+}
+
+
+def parse_assignment(text):
+    '''Split a NAME=VALUE command line argument'''
+    name, sep, value = text.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError('Expected NAME=VALUE: %s' % text)
+    return name, value
+
+
+def parse_constant(text):
+    '''Parse NAME=VALUE with VALUE being a python literal or a string'''
+    name, value = parse_assignment(text)
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def run(script_path, image_sets, constants, image_names, object_names,
+        writer, workers, library_dir=None):
+    '''Run the script on each image set and write its measurements'''
+    with open(script_path) as f:
+        codeobj = compile(f.read(), script_path, 'exec')
+    output_names = image_names + [name for o, name in object_names]
+    args = [(image_set, constants, output_names) for image_set in image_sets]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (marshal.dumps(codeobj), library_dir))
+        results = pool.imap(_run_image_set_star, args)
+    else:
+        pool = None
+        _init_worker(marshal.dumps(codeobj), library_dir)
+        results = (_run_image_set(*arg) for arg in args)
+    try:
+        # izip takes each result only when it is written
+        for (image_number, files, metadata), outputs \
+                in itertools.izip(image_sets, results):
+            writer.write(image_number, files, metadata, outputs)
+            print >> sys.stderr, 'Image set %d of %d done' % (
+                image_number, len(image_sets))
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _run_image_set_star(args):
+    return _run_image_set(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a RunScript script over a directory of images')
+    parser.add_argument('script', help='the script file to run')
+    parser.add_argument('directory', help='the directory with the images')
+    parser.add_argument('--image', type=parse_assignment, action='append',
+                        default=[], metavar='NAME=REGEX',
+                        help='an input image and its file name pattern')
+    parser.add_argument('--labels', type=parse_assignment, action='append',
+                        default=[], metavar='NAME=REGEX',
+                        help='input objects and the file name pattern of'
+                             ' their label matrices')
+    parser.add_argument('--constant', type=parse_constant, action='append',
+                        default=[], metavar='NAME=VALUE',
+                        help='an input constant')
+    parser.add_argument('--measurement', action='append', default=[],
+                        metavar='[OBJECTS:]NAME',
+                        help='a script variable to write as an image or'
+                             ' object measurement')
+    parser.add_argument('--output', required=True,
+                        help='the .csv or .npz file to write')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='the number of worker processes, 1 runs the'
+                             ' script in this process')
+    parser.add_argument('--library', metavar='DIRECTORY',
+                        help='the directory of the script library')
+    options = parser.parse_args(argv)
+    extension = os.path.splitext(options.output)[1].lower()
+    if extension not in WRITERS:
+        parser.error('The output must be a .csv or .npz file')
+    image_names = []
+    object_names = []
+    for measurement in options.measurement:
+        objects, sep, name = measurement.rpartition(':')
+        if sep:
+            object_names.append((objects, name))
+        else:
+            image_names.append(name)
+    image_sets = find_image_sets(options.directory, options.image,
+                                 options.labels)
+    writer = WRITERS[extension](options.output, image_names, object_names)
+    run(options.script, image_sets, dict(options.constant), image_names,
+        object_names, writer, options.workers, options.library)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''Measurements of the previous image sets of a group
+
+A MeasurementHistory keeps one growing array per measurement that a script
+has asked for, with the values of the image sets of the current group that
+have already been processed. The values of an image set are read from the
+measurements only once, when the measurement is requested for the first
+time after the image set has been processed. The values of the current
+image set are always read again because later modules may still add them.
+GroupMeasurements provides the measurements of a whole group after its
+image sets have been processed.
+'''
+
+import numpy as np
+
+IMAGE = 'Image'
+
+# measurement key -> (object name, feature name)
+_split_keys = {}
+
+
+def split_key(key):
+    '''Split a key '<object>_<feature>' or (object, feature)'''
+    if hasattr(key, '__iter__'):
+        parts = tuple(key)
+        return parts[0], '_'.join(parts[1:])
+    try:
+        return _split_keys[key]
+    except KeyError:
+        object_name, sep, feature = key.partition('_')
+        _split_keys[key] = (object_name, feature)
+        return object_name, feature
+
+
+def _as_values(value, is_image):
+    # one value for an image measurement, an array for object measurements
+    if value is None:
+        return np.array([np.nan]) if is_image else np.zeros(0)
+    values = np.atleast_1d(np.asarray(value))
+    if values.dtype.kind in 'SU':
+        values = values.astype(object)
+    return values
+
+
+class _Column(object):
+    '''A growing array with the image set number of each value'''
+    def __init__(self):
+        self.values = np.zeros(0)
+        self.image_numbers = np.zeros(0, int)
+        self.count = 0
+        # the number of image sets of the history that have been indexed
+        self.indexed = 0
+
+    def append(self, image_number, values):
+        end = self.count + len(values)
+        if end > len(self.values) \
+           or np.result_type(self.values, values) != self.values.dtype:
+            size = max(end, 2 * len(self.values), 16)
+            grown = np.empty(size, np.result_type(self.values, values))
+            grown[:self.count] = self.values[:self.count]
+            numbers = np.empty(size, int)
+            numbers[:self.count] = self.image_numbers[:self.count]
+            self.values, self.image_numbers = grown, numbers
+        self.values[self.count:end] = values
+        self.image_numbers[self.count:end] = image_number
+        self.count = end
+
+
+class MeasurementHistory(object):
+    '''Index of the measurements of the processed image sets of a group
+
+    get_measurement - called as get_measurement(object name, feature,
+                      image set number), returns the value of a
+                      measurement or None if it does not exist
+    '''
+    def __init__(self, get_measurement):
+        self.get_measurement = get_measurement
+        self.image_numbers = []
+        self.__columns = {}
+
+    def reset(self):
+        '''Start a new group'''
+        self.image_numbers = []
+        self.__columns = {}
+
+    def add_image_set(self, image_number):
+        '''Mark an image set as processed'''
+        self.image_numbers.append(image_number)
+
+    def get(self, key, current=None, with_image_numbers=False):
+        '''Return the values of a measurement of all processed image sets
+
+        key - '<object>_<feature>' or (object, feature)
+        current - the number of the current image set, which has not been
+                  added yet and whose values are appended, or None
+        with_image_numbers - also return the image set number of each value
+
+        An image measurement has one value per image set, NaN if it is
+        missing. The values of an object measurement are concatenated.
+        '''
+        object_name, feature = split_key(key)
+        is_image = object_name == IMAGE
+        column = self.__columns.get((object_name, feature))
+        if column is None:
+            column = self.__columns[(object_name, feature)] = _Column()
+        for image_number in self.image_numbers[column.indexed:]:
+            column.append(image_number, _as_values(
+                self.get_measurement(object_name, feature, image_number),
+                is_image))
+        column.indexed = len(self.image_numbers)
+        values = column.values[:column.count]
+        image_numbers = column.image_numbers[:column.count]
+        if current is not None:
+            current_values = _as_values(
+                self.get_measurement(object_name, feature, current),
+                is_image)
+            values = np.hstack((values, current_values))
+            image_numbers = np.hstack((
+                image_numbers,
+                np.repeat(current, len(current_values))))
+        else:
+            # the arrays of the index must not be changed by the script
+            values = values.copy()
+            image_numbers = image_numbers.copy()
+        if with_image_numbers:
+            return image_numbers, values
+        return values
+
+
+class GroupMeasurements(object):
+    '''The measurements of all image sets of a group as columns
+
+    image_numbers - the image set numbers of the group
+    get_measurement - see MeasurementHistory
+
+    group_measurements[key] returns the values of a measurement of all
+    image sets, see MeasurementHistory.get.
+    '''
+    def __init__(self, image_numbers, get_measurement):
+        self.image_numbers = np.array(image_numbers, int)
+        self.__history = MeasurementHistory(get_measurement)
+        for image_number in image_numbers:
+            self.__history.add_image_set(image_number)
+
+    def __getitem__(self, key):
+        return self.__history.get(key)
+
+    def get(self, key, with_image_numbers=False):
+        '''Return the values and optionally the image set number of each'''
+        return self.__history.get(key, with_image_numbers=with_image_numbers)
@@ -0,0 +1,157 @@
+'''Shared library of modules for RunScript scripts
+
+The Python modules in a library directory can be imported by the scripts
+of all RunScript modules as submodules of cellprofiler.cpscript.lib, e.g.
+  from cellprofiler.cpscript.lib import features
+Subdirectories with an __init__.py are packages. Each module is compiled
+once and its code object kept in the code cache (see codecache), so that
+worker processes only load the bytecode. A module is executed only once
+per process and shared by all scripts that import it, unless its file has
+changed since.
+'''
+
+import os
+import imp
+import sys
+import hashlib
+import threading
+
+from runscript_support import codecache
+
+LIBRARY_NAME = 'lib'
+PACKAGE_INIT = '__init__'
+SOURCE_EXT = '.py'
+
+# the libraries of the current process by directory
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+def get_library(directory, package, code_cache=True):
+    '''Return the library of a directory, which is shared in the process
+
+    directory - the directory with the modules
+    package - the full name of the package the modules are imported from
+    code_cache - keep the compiled modules in the code cache
+    '''
+    key = (os.path.abspath(directory), package, code_cache)
+    with _libraries_lock:
+        if key not in _libraries:
+            _libraries[key] = ScriptLibrary(*key)
+        return _libraries[key]
+
+
+class ScriptLibrary(object):
+    '''Finder and loader for the modules of a library directory
+
+    directory - the directory with the modules
+    package - the full name of the package the modules are imported from
+    code_cache - keep the compiled modules in the code cache
+    '''
+    def __init__(self, directory, package, code_cache=True):
+        self.directory = directory
+        self.package = package
+        self.code_cache = codecache.CodeCache() if code_cache else None
+        # full name -> ((modification time, size), module)
+        self.__modules = {}
+        # the names in sys.modules that forget() removes
+        self.__imported = set()
+
+    def find_module(self, fullname, path=None):
+        if fullname == self.package:
+            return self
+        if fullname.startswith(self.package + '.'):
+            if self.__find(fullname) is not None:
+                return self
+            # Python 2 marks the failed implicit relative imports of the
+            # modules of the library with None in sys.modules
+            self.__imported.add(fullname)
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        self.__imported.add(fullname)
+        if fullname == self.package:
+            if fullname not in self.__modules:
+                module = imp.new_module(fullname)
+                module.__file__ = os.path.join(self.directory, PACKAGE_INIT)
+                module.__path__ = [self.directory]
+                module.__package__ = fullname
+                module.__loader__ = self
+                self.__modules[fullname] = (None, module)
+            module = self.__modules[fullname][1]
+            sys.modules[fullname] = module
+            return module
+        path, is_package = self.__find(fullname)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+        loaded = self.__modules.get(fullname)
+        if loaded is not None and loaded[0] == stamp:
+            sys.modules[fullname] = loaded[1]
+            return loaded[1]
+        module = imp.new_module(fullname)
+        module.__file__ = path
+        module.__loader__ = self
+        if is_package:
+            module.__path__ = [os.path.dirname(path)]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+        sys.modules[fullname] = module
+        try:
+            exec self.get_code(fullname) in module.__dict__
+        except:
+            del sys.modules[fullname]
+            raise
+        self.__modules[fullname] = (stamp, module)
+        return module
+
+    def get_code(self, fullname):
+        '''Return the code object of a module of the library'''
+        path, is_package = self.__find(fullname)
+        with open(path, 'rU') as f:
+            source = f.read()
+        if self.code_cache is None:
+            return compile(source, path, 'exec')
+        key = self.code_cache.key(source, path)
+        codeobj = self.code_cache.get(key)
+        if codeobj is None:
+            codeobj = compile(source, self.code_cache.source_path(key),
+                              'exec')
+            self.code_cache.put(key, source, codeobj)
+        return codeobj
+
+    def key(self):
+        '''Return a hash of the sources of all modules of the library'''
+        digest = hashlib.sha1()
+        for dirpath, dirnames, filenames in sorted(os.walk(self.directory)):
+            for filename in sorted(filenames):
+                if not filename.endswith(SOURCE_EXT):
+                    continue
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, self.directory) + '\0')
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def forget(self):
+        '''Remove the modules of the library from sys.modules
+
+        The modules are kept by the library and are not executed again
+        when they are imported the next time.
+        '''
+        imported, self.__imported = self.__imported, set()
+        for fullname in imported:
+            sys.modules.pop(fullname, None)
+
+    def __find(self, fullname):
+        # return the path of the source of a module and whether it is a
+        # package or None if the library has no such module
+        parts = fullname[len(self.package) + 1:].split('.')
+        base = os.path.join(self.directory, *parts)
+        init_path = os.path.join(base, PACKAGE_INIT + SOURCE_EXT)
+        if os.path.isfile(init_path):
+            return init_path, True
+        if os.path.isfile(base + SOURCE_EXT):
+            return base + SOURCE_EXT, False
+        return None
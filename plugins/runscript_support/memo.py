@@ -0,0 +1,131 @@
+'''Memoization of data derived from the images and objects of an image set
+
+Several scripts in a pipeline often compute the same data from the same
+objects, e.g. label indexes, bounding box slices or per-label sums. A
+DerivedDataCache is shared by all scripts of an image set and computes
+each of them only once.
+'''
+
+import numpy as np
+import scipy.ndimage as nd
+
+from runscript_support import regions
+from runscript_support import sparse
+from runscript_support import readonly
+
+KIND_IMAGE = 'image'
+KIND_OBJECTS = 'objects'
+
+
+def _read_only(value):
+    # a result that the scripts cannot change for each other
+    if isinstance(value, np.ndarray):
+        return readonly.read_only(value)
+    if isinstance(value, regions.LabelStatistics):
+        return regions.LabelStatistics(**dict(
+            (name, _read_only(column))
+            for name, column in value.__dict__.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_read_only(item) for item in value)
+    return value
+
+
+class DerivedDataCache(object):
+    '''Memoizes data derived from images and objects by name
+
+    get_image - function returning the current image with a given name
+    get_objects - function returning the current objects with a given name
+
+    Each entry remembers the images and objects it has been computed from.
+    If one of the names has been added to the image set again since then,
+    the entry is computed again. The arrays of the results are read-only
+    because they are shared, lists are returned as tuples.
+    '''
+    def __init__(self, get_image, get_objects):
+        self.__getters = {KIND_IMAGE: get_image, KIND_OBJECTS: get_objects}
+        self.__entries = {}
+
+    def get(self, operation, compute, sources, *args):
+        '''Return the memoized result of an operation
+
+        operation - a name for the operation
+        compute - the function computing the result from the source images
+                  and objects and the additional arguments
+        sources - a sequence of (kind, name) tuples with kind being
+                  KIND_IMAGE or KIND_OBJECTS
+        args - additional hashable arguments of the operation
+        '''
+        sources = tuple(sources)
+        current = [self.__getters[kind](name) for kind, name in sources]
+        key = (operation, sources) + args
+        entry = self.__entries.get(key)
+        if entry is not None and len(entry[0]) == len(current) \
+           and all(a is b for a, b in zip(entry[0], current)):
+            return entry[1]
+        value = _read_only(compute(*(current + list(args))))
+        self.__entries[key] = (current, value)
+        return value
+
+    def clear(self):
+        self.__entries.clear()
+
+    def release(self, kind, name):
+        '''Forget all entries computed from an image or objects'''
+        for key in [key for key in self.__entries if (kind, name) in key[1]]:
+            del self.__entries[key]
+
+    def label_indexes(self, objects_name):
+        '''Return the object numbers 1..N of the objects'''
+        return self.get(
+            'label_indexes',
+            lambda objects: np.arange(1, objects.segmented.max() + 1
+                                      if objects.segmented.size > 0 else 1),
+            [(KIND_OBJECTS, objects_name)])
+
+    def find_objects(self, objects_name):
+        '''Return the bounding box slices of the objects'''
+        return self.get(
+            'find_objects',
+            lambda objects: nd.find_objects(objects.segmented),
+            [(KIND_OBJECTS, objects_name)])
+
+    def mask(self, objects_name):
+        '''Return a mask of the pixels covered by the objects'''
+        return self.get(
+            'mask',
+            lambda objects: objects.segmented > 0,
+            [(KIND_OBJECTS, objects_name)])
+
+    def ijv(self, objects_name):
+        '''Return the ijv form of the objects (see sparse.ijv)'''
+        return self.get('ijv', sparse.ijv, [(KIND_OBJECTS, objects_name)])
+
+    def pixel_indices(self, objects_name):
+        '''Return the flat pixel indices of each object'''
+        return self.get('pixel_indices', sparse.pixel_indices,
+                        [(KIND_OBJECTS, objects_name)])
+
+    def rle(self, objects_name):
+        '''Return the horizontal runs of the objects (see sparse.rle)'''
+        return self.get('rle', sparse.rle, [(KIND_OBJECTS, objects_name)])
+
+    def statistics(self, objects_name, image_name=None):
+        '''Return the label statistics of the objects
+
+        See regions.label_statistics. The intensity statistics are computed
+        on the given image.
+        '''
+        if image_name is None:
+            return self.get(
+                'statistics',
+                lambda objects: regions.label_statistics(objects.segmented),
+                [(KIND_OBJECTS, objects_name)])
+        return self.get(
+            'statistics',
+            lambda objects, image: regions.label_statistics(
+                objects.segmented, image.pixel_data),
+            [(KIND_OBJECTS, objects_name), (KIND_IMAGE, image_name)])
+
+    def label_sums(self, objects_name, image_name):
+        '''Return the intensity sum of each object on an image'''
+        return self.statistics(objects_name, image_name).sum
@@ -0,0 +1,125 @@
+'''Parallel per-object computations for RunScript scripts
+
+parallel_map applies a function to the crop of each object of a label
+matrix in a pool of threads or processes and returns the results ordered
+by object number. Threads suit functions that spend their time in NumPy
+or SciPy calls that release the GIL. Processes suit pure Python functions;
+they are forked so that the workers share the label matrix and the image
+with the script instead of receiving copies.
+'''
+
+import sys
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+import numpy as np
+import scipy.ndimage as nd
+
+# the function, label matrix, image and bounding boxes of the current
+# parallel_map in process mode, inherited by the forked workers
+_task = None
+_task_lock = threading.Lock()
+
+
+def _crop(task, number):
+    func, labels, pixel_data, slices = task
+    window = slices[number - 1]
+    mask = labels[window] == number
+    crop = None if pixel_data is None else pixel_data[window]
+    return func(number, mask, crop)
+
+
+def _map_chunk(numbers):
+    return [_crop(_task, number) for number in numbers]
+
+
+def _as_array(value):
+    '''Return the data of images and objects or an array as it is'''
+    for attribute in ('segmented', 'pixel_data'):
+        if hasattr(value, attribute):
+            return getattr(value, attribute)
+    return value
+
+
+def _collect(results, count):
+    '''Combine the results into an array with one row per object'''
+    template = next((np.asarray(result) for result in results
+                     if result is not None), None)
+    if template is None:
+        return np.zeros(count)
+    collected = np.empty((count,) + template.shape,
+                         np.result_type(template.dtype, np.float64))
+    for index, result in enumerate(results):
+        collected[index] = np.nan if result is None else result
+    return collected
+
+
+def parallel_map(func, objects, image=None, workers=None, processes=False,
+                 chunks_per_worker=4):
+    '''Apply a function to each object and return the results by object
+
+    func - called as func(number, mask, pixel_data) with the object number,
+           the mask of the object within its bounding box and the pixel
+           data of the image in the bounding box (None if no image is
+           given). It returns a number or a fixed-size sequence of numbers.
+    objects - objects with a label matrix (segmented) or a label matrix
+    image - an image with pixel data or an array, optional
+    workers - the number of threads or processes, by default the number of
+              processors
+    processes - use forked processes instead of threads. Threads are used
+                if forking is not possible, e.g. in a worker process.
+    chunks_per_worker - the objects are distributed in this many chunks per
+                        worker to balance the load
+
+    Returns an array with one row per object number 1..N. The rows of
+    objects without pixels are NaN. The arrays must not be modified by
+    func.
+    '''
+    labels = np.asarray(_as_array(objects))
+    pixel_data = None if image is None else np.asarray(_as_array(image))
+    # read-only views make sure that no worker changes the shared data
+    labels = labels.view()
+    labels.setflags(write=False)
+    if pixel_data is not None:
+        pixel_data = pixel_data.view()
+        pixel_data.setflags(write=False)
+    slices = nd.find_objects(labels)
+    count = len(slices)
+    numbers = [number for number in range(1, count + 1)
+               if slices[number - 1] is not None]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    nchunks = max(1, min(len(numbers), workers * chunks_per_worker))
+    chunks = [numbers[i::nchunks] for i in range(nchunks)]
+    task = (func, labels, pixel_data, slices)
+    use_processes = processes and sys.platform != 'win32' \
+        and not multiprocessing.current_process().daemon
+    if workers <= 1 or len(numbers) <= 1:
+        chunk_results = [[_crop(task, number) for number in chunk]
+                         for chunk in chunks]
+    elif use_processes:
+        global _task
+        with _task_lock:
+            _task = task
+            pool = multiprocessing.Pool(workers)
+            try:
+                chunk_results = pool.map(_map_chunk, chunks)
+            finally:
+                pool.terminate()
+                pool.join()
+                _task = None
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            chunk_results = pool.map(
+                lambda chunk: [_crop(task, number) for number in chunk],
+                chunks)
+        finally:
+            pool.close()
+            pool.join()
+    results = [None] * count
+    for chunk, values in zip(chunks, chunk_results):
+        for number, value in zip(chunk, values):
+            results[number - 1] = value
+    return _collect(results, count)
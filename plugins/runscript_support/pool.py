@@ -0,0 +1,142 @@
+'''Pool of long-lived worker processes for RunScript scripts
+
+Each worker compiles the script once and keeps it together with any
+libraries the script imports for the lifetime of the pool. Inputs are
+shipped to the workers as plain arrays and values (see
+engine.make_attributes) and the requested outputs are sent back. Arrays
+can optionally be exchanged through shared memory (see transport).
+'''
+
+import time
+import marshal
+import multiprocessing
+
+from multiprocessing import TimeoutError
+
+from runscript_support import engine
+from runscript_support import transport
+
+# the script executor of a worker process
+_executor = None
+# the store for the shared output arrays of a worker process, the files
+# are removed by the process that receives the outputs or, if they are
+# never received, by the prefix of the pool
+_output_store = None
+
+
+def _init_worker(code_string, library_dir, code_cache, prefix):
+    global _executor, _output_store
+    library = None
+    if library_dir is not None:
+        library = engine.get_library(library_dir, code_cache)
+    _executor = engine.ScriptExecutor(marshal.loads(code_string), library)
+    _output_store = transport.SharedArrayStore(prefix)
+
+
+def _run_in_worker(inputs, output_names, shared_memory):
+    if shared_memory:
+        inputs = transport.resolve(inputs)
+    namespace = _executor.execute(engine.make_attributes(inputs))
+    outputs = engine.get_outputs(namespace, output_names)
+    if shared_memory:
+        outputs = _output_store.export(outputs)
+    return outputs
+
+
+class WorkerPool(object):
+    '''A pool of processes running the same compiled script
+
+    codeobj - the code object of the compiled script
+    processes - the number of worker processes
+    shared_memory - exchange arrays through shared memory instead of
+                    pickling them
+    library - the script library (see library.ScriptLibrary) or None, the
+              workers load the compiled modules from the same code cache
+    '''
+    def __init__(self, codeobj, processes, shared_memory=False,
+                 library=None):
+        if library is not None:
+            library_args = (library.directory,
+                            library.code_cache is not None)
+        else:
+            library_args = (None, False)
+        # the shared files of the pool and its workers have a common prefix
+        self.__prefix = transport.make_prefix()
+        self.__pool = multiprocessing.Pool(
+            processes, _init_worker,
+            (marshal.dumps(codeobj),) + library_args + (self.__prefix,))
+        self.__shared_memory = shared_memory
+        self.__store = transport.SharedArrayStore(self.__prefix)
+
+    def run(self, inputs, output_names, timeout=None):
+        '''Run the script once and return a dictionary of its outputs
+
+        inputs - the inputs for the script (see engine.make_attributes)
+        output_names - the names of the script variables to return
+        timeout - the time in seconds after which TimeoutError is raised
+        '''
+        return self.map([inputs], output_names, timeout)[0]
+
+    def map(self, inputs_list, output_names, timeout=None):
+        '''Run the script concurrently for each of several inputs
+
+        A TimeoutError is raised if the results are not available after
+        timeout seconds. The pool should be terminated then. If a script
+        raises an exception, the outputs of the other scripts are
+        discarded.
+        '''
+        if self.__shared_memory:
+            inputs_list = [self.__store.export(inputs)
+                           for inputs in inputs_list]
+        async_results = []
+        discard = False
+        try:
+            async_results = [
+                self.__pool.apply_async(
+                    _run_in_worker,
+                    (inputs, output_names, self.__shared_memory))
+                for inputs in inputs_list]
+            if timeout is not None:
+                deadline = time.time() + timeout
+                results = [result.get(max(0, deadline - time.time()))
+                           for result in async_results]
+            else:
+                results = [result.get() for result in async_results]
+            if self.__shared_memory:
+                results = [self.__receive(outputs) for outputs in results]
+        except TimeoutError:
+            # the files of the running scripts are removed by terminate
+            raise
+        except:
+            discard = True
+            raise
+        finally:
+            # the arrays that have been attached stay valid after their
+            # files have been removed
+            self.__store.cleanup()
+            if discard and self.__shared_memory:
+                # the outputs of the scripts that did not fail are never
+                # received
+                for result in async_results:
+                    result.wait()
+                transport.remove_files(self.__prefix)
+        return results
+
+    def __receive(self, outputs):
+        # tables can be dictionaries of arrays
+        for shared_array in transport.shared_arrays(outputs):
+            self.__store.adopt(shared_array)
+        return transport.resolve(outputs, writeable=True)
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+        self.__store.cleanup()
+        transport.remove_files(self.__prefix)
+
+    def terminate(self):
+        '''Stop the workers without waiting for running scripts'''
+        self.__pool.terminate()
+        self.__pool.join()
+        self.__store.cleanup()
+        transport.remove_files(self.__prefix)
@@ -0,0 +1,89 @@
+'''Reduced precision pixel data for RunScript scripts
+
+CellProfiler converts the pixel data of all images to float64 in 0..1. In
+single precision the scripts receive the pixel data as float32, in native
+precision images that were loaded from integer files receive it as integers
+of their original range, e.g. uint16 for 16-bit TIFFs. Output images in
+reduced precision keep their floating point type, integer outputs are
+scaled back to 0..1 in float32 by the scale of the integer inputs.
+
+The conversions never create a float64 temporary of the size of the image,
+they cast while copying, work in place or on blocks of rows.
+'''
+
+import numpy as np
+
+P_DOUBLE = 'float64'
+P_SINGLE = 'float32'
+P_NATIVE = 'native'
+
+# the number of pixels converted at once by to_native
+BLOCK_PIXELS = 1024 * 1024
+
+
+def integer_type(scale):
+    '''Return the smallest unsigned type holding the values 0..scale'''
+    return np.min_scalar_type(int(round(scale)))
+
+
+def to_single(pixel_data):
+    '''Return the pixel data as float32, unchanged if it already is'''
+    return np.asarray(pixel_data).astype(np.float32, copy=False)
+
+
+def to_native(pixel_data, scale):
+    '''Return pixel data in 0..1 as integers in 0..scale
+
+    scale - the maximum value of the type of the original image file
+    '''
+    pixel_data = np.asarray(pixel_data)
+    native = np.empty(pixel_data.shape, integer_type(scale))
+    rows = max(1, BLOCK_PIXELS // max(1, pixel_data[:1].size))
+    for start in range(0, len(pixel_data), rows):
+        block = np.multiply(pixel_data[start:start + rows], scale,
+                            dtype=np.float32)
+        np.rint(block, out=block)
+        native[start:start + rows] = block
+    return native
+
+
+def to_float(pixel_data, scale=None):
+    '''Return integer pixel data in 0..scale scaled to 0..1 as float32
+
+    scale - the scale of the integer inputs the script received, see
+            to_native, or None if it did not receive any
+
+    Floating point and boolean data is returned unchanged. A ValueError is
+    raised for integer data without a scale.
+    '''
+    pixel_data = np.asarray(pixel_data)
+    if pixel_data.dtype.kind not in 'ui':
+        return pixel_data
+    if scale is None:
+        raise ValueError(
+            'The scale of the integer pixel data of type %s is unknown,'
+            ' the script has to return floating point data in 0..1'
+            % pixel_data.dtype)
+    scaled = pixel_data.astype(np.float32)
+    scaled *= np.float32(1.0 / scale)
+    return scaled
+
+
+def is_native(scale):
+    '''Return True if an image of the scale is passed as integers'''
+    return scale is not None and scale > 1
+
+
+def convert_input(pixel_data, precision, scale=None):
+    '''Convert the pixel data of an input image for the script
+
+    precision - P_DOUBLE, P_SINGLE or P_NATIVE
+    scale - the maximum value of the type of the image file or None if the
+            image was not loaded from an integer file. Such images are
+            passed in single precision in native mode.
+    '''
+    if precision == P_DOUBLE or np.asarray(pixel_data).dtype.kind == 'b':
+        return pixel_data
+    if precision == P_NATIVE and is_native(scale):
+        return to_native(pixel_data, scale)
+    return to_single(pixel_data)
@@ -0,0 +1,57 @@
+'''Background prefetching of script inputs
+
+The inputs a script reads are known from its source (see
+RunScript.find_inputs). A Prefetcher starts fetching them in a thread so
+that loading and computing them overlaps with the execution of the script.
+'''
+
+import sys
+import threading
+
+
+class Prefetcher(object):
+    '''Fetches values by name in a background thread
+
+    fetch - a function that returns the value for a name
+    names - the names to fetch, in the order in which they are needed
+    '''
+    def __init__(self, fetch, names):
+        self.__fetch = fetch
+        self.__results = {}
+        self.__events = {}
+        ordered_names = []
+        for name in names:
+            if name not in self.__events:
+                self.__events[name] = threading.Event()
+                ordered_names.append(name)
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(ordered_names,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, names):
+        for name in names:
+            try:
+                self.__results[name] = (True, self.__fetch(name))
+            except Exception:
+                self.__results[name] = (False, sys.exc_info())
+            self.__events[name].set()
+
+    def get(self, name):
+        '''Return the value for a name, waiting for it if necessary
+
+        Names that are not prefetched are fetched in the calling thread.
+        Errors raised while fetching are raised again here.
+        '''
+        event = self.__events.get(name)
+        if event is None:
+            return self.__fetch(name)
+        event.wait()
+        success, value = self.__results[name]
+        if not success:
+            raise value[0], value[1], value[2]
+        return value
+
+    def join(self):
+        '''Wait until all names have been fetched'''
+        self.__thread.join()
@@ -0,0 +1,131 @@
+'''Timing, memory accounting and reports for RunScript scripts'''
+
+import os
+import time
+import threading
+import contextlib
+
+
+def cpu_time():
+    '''Return the user and system CPU time of the process'''
+    times = os.times()
+    return times[0] + times[1]
+
+
+class PhaseTimer(object):
+    '''Accumulates the wall and CPU time spent in named phases
+
+    Phases can be nested. The time spent in an inner phase is only
+    accounted to the inner phase, not to the enclosing one.
+    '''
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.__stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = (time.time(), cpu_time())
+        if self.__stack:
+            self.__account(self.__stack[-1], now)
+        self.__stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = (time.time(), cpu_time())
+            self.__account(self.__stack.pop(), now)
+            if self.__stack:
+                self.__stack[-1][1] = now
+
+    def __account(self, entry, now):
+        name, (wall, cpu) = entry
+        self.wall[name] = self.wall.get(name, 0.0) + now[0] - wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + now[1] - cpu
+        entry[1] = now
+
+
+def resident_memory():
+    '''Return the resident memory of the process in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        # ru_maxrss is the peak and not the current value, but it is the
+        # best that is available on systems without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemoryMonitor(object):
+    '''Measures the peak increase of the resident memory while it is running
+
+    The resident memory (RSS) of the process is sampled in a background
+    thread, so short-lived peaks between two samples are missed.
+
+    interval - the sampling interval in seconds
+    callback - an optional function that is called with the current memory
+               increase at each sample
+    '''
+    def __init__(self, interval=0.01, callback=None):
+        self.interval = interval
+        self.callback = callback
+        self.peak = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.peak = 0
+        self.__baseline = resident_memory()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__sample)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        '''Stop monitoring and return the peak increase in bytes'''
+        self.__stop.set()
+        self.__thread.join()
+        self.__update()
+        return self.peak
+
+    def __update(self):
+        increase = resident_memory() - self.__baseline
+        self.peak = max(self.peak, increase)
+        if self.callback is not None:
+            self.callback(increase)
+
+    def __sample(self):
+        while not self.__stop.wait(self.interval):
+            self.__update()
+
+
+class ProfileReport(object):
+    '''Collects per image set values and writes aggregated statistics'''
+    def __init__(self):
+        self.rows = []
+
+    def add(self, image_number, values):
+        '''Add the values (feature -> value) recorded for an image set'''
+        self.rows.append((image_number, values))
+
+    def write(self, path, title, extra_text=None):
+        '''Write a tab-separated report with a summary per feature'''
+        features = sorted(set(feature for image_number, values in self.rows
+                              for feature in values))
+        with open(path, 'w') as f:
+            f.write('%s\n\n' % title)
+            f.write('Feature\tCount\tTotal\tMean\tMinimum\tMaximum\n')
+            for feature in features:
+                values = [v[feature] for image_number, v in self.rows
+                          if feature in v]
+                f.write('%s\t%d\t%g\t%g\t%g\t%g\n' % (
+                    feature, len(values), sum(values),
+                    float(sum(values)) / len(values),
+                    min(values), max(values)))
+            f.write('\nImageNumber\t%s\n' % '\t'.join(features))
+            for image_number, values in self.rows:
+                f.write('%s\t%s\n' % (image_number, '\t'.join(
+                    '%g' % values[feature] if feature in values else ''
+                    for feature in features)))
+            if extra_text:
+                f.write('\n%s\n' % extra_text)
@@ -0,0 +1,67 @@
+'''Read-only views of the inputs of RunScript scripts
+
+The images and objects a script receives in the CellProfiler process are
+the ones of the image set, changing their arrays in place would change the
+inputs of all later modules. Wrapped in a ReadOnlyProxy, their arrays are
+handed out as views that cannot be written to, without copying them. A
+script that needs to change an array asks for a copy with writable().
+'''
+
+import numpy as np
+
+IMAGE_ARRAYS = ('pixel_data', 'mask', 'crop_mask', 'image')
+OBJECTS_ARRAYS = ('segmented', 'unedited_segmented',
+                  'small_removed_segmented', 'ijv')
+
+
+def read_only(value):
+    '''Return a read-only view of an array, other values as they are'''
+    if not isinstance(value, np.ndarray):
+        return value
+    view = value.view()
+    view.setflags(write=False)
+    return view
+
+
+def writable(array):
+    '''Return an array that can be changed in place
+
+    Read-only arrays, e.g. the inputs of the script, are copied, other
+    arrays are returned as they are.
+    '''
+    array = np.asarray(array)
+    if array.flags.writeable:
+        return array
+    return array.copy()
+
+
+class ReadOnlyProxy(object):
+    '''Gives access to an image or objects with read-only arrays
+
+    target - the image or objects
+    array_attributes - the names of the attributes that are arrays
+
+    All other attributes are those of the target. Attributes cannot be
+    set through the proxy.
+    '''
+    def __init__(self, target, array_attributes):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_array_attributes',
+                           frozenset(array_attributes))
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name in self._array_attributes:
+            return read_only(value)
+        return value
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The inputs of the script are read-only, %s'
+                             ' cannot be set' % name)
+
+
+def unwrap(value):
+    '''Return the target of a proxy or the value itself'''
+    if isinstance(value, ReadOnlyProxy):
+        return value._target
+    return value
@@ -0,0 +1,120 @@
+'''Statistics of labeled regions computed in a single vectorized pass
+
+All statistics are computed for every label at once with bincount and
+reduceat over the labeled pixels, instead of one scipy.ndimage call per
+statistic or a Python loop over the labels. The results are arrays with
+one element per label 1..N, aligned to the object numbers.
+'''
+
+import numpy as np
+
+
+class LabelStatistics(object):
+    '''Per-label statistics of a label matrix and an optional image
+
+    labels - the object numbers 1..N
+    count - the number of pixels of each label
+    centroid - the centroid of each label, shape (N, ndim)
+    bbox_min, bbox_max - the bounding box of each label, shape (N, ndim).
+                         bbox_max is exclusive like the stop of a slice.
+                         Labels without pixels have a bounding box of -1.
+    The following attributes are None if no image was given:
+    sum, mean, variance, minimum, maximum - the intensity statistics of
+                                            each label. mean, variance,
+                                            minimum and maximum are NaN
+                                            for labels without pixels.
+    '''
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def slices(self):
+        '''Return a tuple of slices for the bounding box of each label'''
+        return [tuple(slice(start, stop) for start, stop in zip(lo, hi))
+                if count > 0 else None
+                for lo, hi, count in zip(self.bbox_min, self.bbox_max,
+                                         self.count)]
+
+
+def label_statistics(labels, image=None, nobjects=None):
+    '''Compute the statistics of all labels in one pass
+
+    labels - a label matrix with 0 as background
+    image - an optional image of the same shape to compute intensity
+            statistics on
+    nobjects - the number of objects, by default the maximum label. Labels
+               above it are treated as background.
+
+    Returns a LabelStatistics object.
+    '''
+    labels = np.asarray(labels)
+    if image is not None:
+        image = np.asarray(image)
+        if image.shape != labels.shape:
+            raise ValueError('The image has the shape %s but the labels have'
+                             ' the shape %s' % (image.shape, labels.shape))
+    if nobjects is None:
+        nobjects = int(labels.max()) if labels.size > 0 else 0
+        foreground = labels > 0
+    else:
+        foreground = (labels > 0) & (labels <= nobjects)
+    label_values = labels[foreground].astype(np.intp)
+    coords = np.nonzero(foreground)
+    ndim = labels.ndim
+    # pixel counts and centroids from weighted bincounts
+    count = np.bincount(label_values, minlength=nobjects + 1)[1:nobjects + 1]
+    present = count > 0
+    safe_count = np.maximum(count, 1)
+    centroid = np.empty((nobjects, ndim))
+    for dim in range(ndim):
+        centroid[:, dim] = np.bincount(
+            label_values, coords[dim],
+            minlength=nobjects + 1)[1:nobjects + 1] / safe_count
+    centroid[~present] = np.nan
+    # sort the pixels by label once so that minima and maxima can be
+    # computed with reduceat over the runs of each label
+    order = np.argsort(label_values, kind='mergesort')
+    sorted_labels = label_values[order]
+    starts = np.searchsorted(sorted_labels, np.arange(1, nobjects + 1))
+    run_starts = starts[present]
+    bbox_min = np.empty((nobjects, ndim), np.intp)
+    bbox_max = np.empty((nobjects, ndim), np.intp)
+    bbox_min.fill(-1)
+    bbox_max.fill(-1)
+    if len(run_starts) > 0:
+        for dim in range(ndim):
+            sorted_coords = coords[dim][order]
+            bbox_min[present, dim] = np.minimum.reduceat(sorted_coords,
+                                                         run_starts)
+            bbox_max[present, dim] = np.maximum.reduceat(sorted_coords,
+                                                         run_starts) + 1
+    columns = dict(labels=np.arange(1, nobjects + 1), count=count,
+                   centroid=centroid, bbox_min=bbox_min, bbox_max=bbox_max,
+                   sum=None, mean=None, variance=None,
+                   minimum=None, maximum=None)
+    if image is not None:
+        values = image[foreground].astype(np.float64)
+        # bincount returns integers if there are no labeled pixels at all
+        total = np.bincount(label_values, values, minlength=nobjects + 1)[
+            1:nobjects + 1].astype(np.float64)
+        mean = total / safe_count
+        # two-pass variance to avoid cancellation for bright objects
+        deviation = values - mean[label_values - 1]
+        variance = np.bincount(label_values, deviation * deviation,
+                               minlength=nobjects + 1)[
+            1:nobjects + 1].astype(np.float64) / safe_count
+        minimum = np.empty(nobjects)
+        maximum = np.empty(nobjects)
+        minimum.fill(np.nan)
+        maximum.fill(np.nan)
+        if len(run_starts) > 0:
+            sorted_values = values[order]
+            minimum[present] = np.minimum.reduceat(sorted_values, run_starts)
+            maximum[present] = np.maximum.reduceat(sorted_values, run_starts)
+        mean[~present] = np.nan
+        variance[~present] = np.nan
+        columns.update(sum=total, mean=mean, variance=variance,
+                       minimum=minimum, maximum=maximum)
+    return LabelStatistics(**columns)
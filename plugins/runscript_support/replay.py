@@ -0,0 +1,316 @@
+'''Capture of the inputs of RunScript scripts and their offline replay
+
+In capture mode, RunScript writes one archive per image set with the
+inputs of the script as they are shipped to worker processes (see
+engine.make_attributes), the outputs the script produced, the script
+source and the names of its outputs. The archive is a zip file whose
+arrays are stored as uncompressed .npy members, so that they can be
+memory-mapped instead of being read, or compressed at the cost of reading
+them into memory.
+
+The archives can be replayed without CellProfiler and without the
+original images (from the plugins directory):
+  python -m runscript_support.replay captures/ --repeat 5 --check
+
+Each archive is run with the compiled script the given number of times and
+the minimum and mean time are printed. --check compares the outputs with
+the recorded outputs, e.g. as a regression test after a change of the
+script given with --script. --profile prints the cProfile statistics of
+all runs.
+'''
+
+import os
+import io
+import sys
+import time
+import struct
+import pstats
+import cPickle
+import zipfile
+import argparse
+import tempfile
+import cProfile
+
+import numpy as np
+
+from runscript_support import engine
+
+CAPTURE_EXT = '.zip'
+CAPTURE_VERSION = 2
+META_NAME = 'meta.pkl'
+ARRAY_DIR = 'arrays/'
+# the fixed part of the local file header of a zip member
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+# an array stored as a member of the archive is replaced in the pickled
+# metadata by {ARRAY_KEY: member name}. A plain dictionary rather than an
+# instance of a class of this module, which would be unpickled as a
+# different class when the module runs as __main__.
+ARRAY_KEY = '__capture_array__'
+
+
+def _array_name(value):
+    # the member name of an array reference or None
+    if isinstance(value, dict) and len(value) == 1:
+        return value.get(ARRAY_KEY)
+    return None
+
+
+def _extract_arrays(value, arrays):
+    # replace the arrays of a nested structure by references
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        name = '%s%d.npy' % (ARRAY_DIR, len(arrays))
+        arrays.append((name, value))
+        return {ARRAY_KEY: name}
+    if isinstance(value, dict):
+        return dict((key, _extract_arrays(item, arrays))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return type(value)(_extract_arrays(item, arrays) for item in value)
+    return value
+
+
+def _insert_arrays(value, load):
+    name = _array_name(value)
+    if name is not None:
+        return load(name)
+    if isinstance(value, dict):
+        return dict((key, _insert_arrays(item, load))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return type(value)(_insert_arrays(item, load) for item in value)
+    return value
+
+
+def capture_path(directory, module_num, image_number):
+    '''Return the path of the archive of an image set'''
+    return os.path.join(directory, 'CPRunScript_%02d_%06d%s' % (
+        module_num, image_number, CAPTURE_EXT))
+
+
+def write_capture(path, inputs, outputs, source, output_names,
+                  image_number, library_dir=None, compress=False):
+    '''Write the inputs and outputs of a run of a script to an archive
+
+    inputs - the inputs of the script (see engine.make_attributes)
+    outputs - dictionary with the outputs of the script, picklable
+    source - the source of the script
+    output_names - the names of the output variables
+    image_number - the number of the image set
+    library_dir - the directory of the script library or None
+    compress - compress the arrays, they cannot be memory-mapped then
+    '''
+    arrays = []
+    meta = {
+        'version': CAPTURE_VERSION,
+        'image_number': image_number,
+        'source': source,
+        'output_names': list(output_names),
+        'library_dir': library_dir,
+        'inputs': _extract_arrays(inputs, arrays),
+        'outputs': _extract_arrays(outputs, arrays),
+    }
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    # write to a temporary file and rename it so that a replay never sees
+    # a partially written archive
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression,
+                             allowZip64=True) as archive:
+            archive.writestr(META_NAME, cPickle.dumps(
+                meta, cPickle.HIGHEST_PROTOCOL))
+            for name, array in arrays:
+                data = io.BytesIO()
+                np.lib.format.write_array(data, array)
+                archive.writestr(name, data.getvalue())
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def _member_array(path, archive, info, mmap):
+    # memory-map an uncompressed member or read it into memory
+    if not mmap or info.compress_type != zipfile.ZIP_STORED:
+        return np.lib.format.read_array(io.BytesIO(archive.read(info)))
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+        f.seek(header[-2] + header[-1], os.SEEK_CUR)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype)
+    return np.memmap(path, dtype, 'r', offset, shape,
+                     'F' if fortran_order else 'C').view(np.ndarray)
+
+
+def read_capture(path, mmap=True):
+    '''Read an archive written by write_capture
+
+    Returns a dictionary with the keys of the archive, see write_capture.
+    The arrays are read-only memory-mapped views if mmap is True and the
+    archive is not compressed.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        meta = cPickle.loads(archive.read(META_NAME))
+        if meta['version'] != CAPTURE_VERSION:
+            raise ValueError('%s has the capture version %s, this version'
+                             ' reads %d' % (path, meta['version'],
+                                            CAPTURE_VERSION))
+        load = lambda name: _member_array(path, archive,
+                                          archive.getinfo(name), mmap)
+        meta['inputs'] = _insert_arrays(meta['inputs'], load)
+        meta['outputs'] = _insert_arrays(meta['outputs'], load)
+    return meta
+
+
+def find_captures(paths):
+    '''Return the archives given directly or contained in directories'''
+    captures = []
+    for path in paths:
+        if os.path.isdir(path):
+            captures += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(CAPTURE_EXT))
+        else:
+            captures.append(path)
+    return captures
+
+
+def _comparable(value):
+    # images and objects are compared by their data
+    for attribute in ('pixel_data', 'segmented'):
+        if hasattr(value, attribute):
+            return getattr(value, attribute)
+    return value
+
+
+def compare_outputs(expected, actual, path=''):
+    '''Return a list of the differences between two outputs'''
+    expected = _comparable(expected)
+    actual = _comparable(actual)
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = []
+        for key in sorted(set(expected) | set(actual)):
+            if key not in expected or key not in actual:
+                differences.append('%s[%r] is missing' % (path, key))
+            else:
+                differences += compare_outputs(
+                    expected[key], actual[key], '%s[%r]' % (path, key))
+        return differences
+    try:
+        expected = np.asarray(expected)
+        actual = np.asarray(actual)
+        if expected.shape != actual.shape:
+            return ['%s has the shape %s instead of %s' % (
+                path, actual.shape, expected.shape)]
+        if expected.dtype.kind in 'fc' or actual.dtype.kind in 'fc':
+            equal = np.allclose(expected, actual, equal_nan=True)
+        else:
+            equal = np.array_equal(expected, actual)
+    except (TypeError, ValueError):
+        equal = expected == actual
+    return [] if equal else ['%s differs' % path]
+
+
+class Replayer(object):
+    '''Runs the scripts of captured image sets
+
+    script_path - a script to run instead of the captured one or None
+    library_dir - the script library to use instead of the captured one
+    mmap - memory-map the arrays of the archives
+    '''
+    def __init__(self, script_path=None, library_dir=None, mmap=True):
+        self.script_source = None
+        if script_path is not None:
+            with open(script_path) as f:
+                self.script_source = f.read()
+        self.library_dir = library_dir
+        self.mmap = mmap
+        # the executors by source, so that a phased script is set up once
+        self.__executors = {}
+
+    def get_executor(self, capture):
+        source = self.script_source or capture['source']
+        library_dir = self.library_dir or capture['library_dir']
+        key = (source, library_dir)
+        if key not in self.__executors:
+            library = None
+            if library_dir is not None:
+                library = engine.get_library(library_dir)
+            self.__executors[key] = engine.ScriptExecutor(
+                compile(source, '<replayed script>', 'exec'), library)
+        return self.__executors[key]
+
+    def replay(self, path, repeat=1, profile=None):
+        '''Run the script of an archive and return the times and outputs'''
+        capture = read_capture(path, self.mmap)
+        executor = self.get_executor(capture)
+        times = []
+        for i in range(repeat):
+            # each run gets fresh attributes like an image set does
+            attributes = engine.make_attributes(capture['inputs'])
+            start = time.time()
+            if profile is not None:
+                profile.enable()
+            try:
+                namespace = executor.execute(attributes)
+            finally:
+                if profile is not None:
+                    profile.disable()
+            times.append(time.time() - start)
+        outputs = dict((name, namespace.get(name))
+                       for name in capture['output_names'])
+        return capture, times, outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay captured inputs of RunScript scripts')
+    parser.add_argument('captures', nargs='+',
+                        help='archives or directories with archives')
+    parser.add_argument('--script', help='run this script file instead of'
+                                         ' the captured script')
+    parser.add_argument('--library', metavar='DIRECTORY',
+                        help='the directory of the script library')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of timed runs of each image set')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the outputs with the captured outputs')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the cProfile statistics of all runs')
+    parser.add_argument('--no-mmap', dest='mmap', action='store_false',
+                        help='read the arrays into memory')
+    options = parser.parse_args(argv)
+    engine.ensure_cpscript_package()
+    replayer = Replayer(options.script, options.library, options.mmap)
+    profile = cProfile.Profile() if options.profile else None
+    failures = 0
+    for path in find_captures(options.captures):
+        capture, times, outputs = replayer.replay(path, options.repeat,
+                                                  profile)
+        line = '%s image set %d: min %.4f s, mean %.4f s' % (
+            os.path.basename(path), capture['image_number'], min(times),
+            sum(times) / len(times))
+        if options.check:
+            differences = compare_outputs(capture['outputs'], outputs)
+            if differences:
+                failures += 1
+                line += ', outputs differ: ' + '; '.join(differences)
+            else:
+                line += ', outputs match'
+        print line
+    if profile is not None:
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(30)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+'''On-disk cache of the outputs of RunScript scripts
+
+Entries are keyed by a hash of the script, its constants and the values of
+its inputs. If an image set is processed again with the same script and
+the same inputs, the outputs are loaded from the cache instead of running
+the script. The least recently used entries are removed when the cache
+grows too large (see codecache.evict).
+'''
+
+import os
+import imp
+import cPickle
+import hashlib
+import tempfile
+
+import numpy as np
+
+from runscript_support import codecache
+
+RESULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'CPRunScript_results')
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+RESULT_EXT = '.rsr'
+
+
+def update_digest(digest, value):
+    '''Add a nested structure of values and arrays to a hash'''
+    if isinstance(value, np.ndarray):
+        digest.update('ndarray %s %r\0' % (value.dtype.str, value.shape))
+        if value.dtype.hasobject:
+            update_digest(digest, value.tolist())
+        else:
+            digest.update(np.ascontiguousarray(value))
+    elif isinstance(value, dict):
+        digest.update('dict %d\0' % len(value))
+        for key in sorted(value):
+            update_digest(digest, key)
+            update_digest(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update('%s %d\0' % (type(value).__name__, len(value)))
+        for item in value:
+            update_digest(digest, item)
+    elif isinstance(value, unicode):
+        digest.update('unicode %s\0' % value.encode('utf-8'))
+    else:
+        digest.update('%s %r\0' % (type(value).__name__, value))
+
+
+class ResultCache(object):
+    '''A size-bounded cache of script outputs
+
+    directory - the directory to store the entries in
+    max_bytes - the maximum total size of all entries
+    '''
+    def __init__(self, directory=RESULT_CACHE_DIR,
+                 max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts):
+        '''Return the cache key for a combination of values and arrays'''
+        digest = hashlib.sha1(imp.get_magic())
+        for part in parts:
+            update_digest(digest, part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Return the cached outputs for a key or None'''
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = cPickle.load(f)
+            # mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError, cPickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key, value):
+        '''Store the outputs for a key
+
+        Returns False if the outputs cannot be pickled and are not cached.
+        '''
+        try:
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return False
+        codecache.make_directory(self.directory)
+        codecache.write_file(self.__path(key), data)
+        self.evict()
+        return True
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits'''
+        codecache.evict(self.directory, (RESULT_EXT,), self.max_bytes)
+
+    def __path(self, key):
+        return os.path.join(self.directory, 'CPRunScript_' + key + RESULT_EXT)
@@ -0,0 +1,111 @@
+'''Sparse representations of objects for RunScript scripts
+
+Objects are usually passed as dense label matrices, which take memory and
+time proportional to the image area even for a few small objects. The
+functions here convert label matrices into sparse forms and back:
+
+- ijv: an (N, 3) array with the row, column and object number of each
+  pixel of an object, ordered by row and column
+- pixel indices: for each object number 1..M an array with the flat
+  indices of its pixels in the label matrix
+- run lengths: an (N, 4) array with the row, first column, length and
+  object number of each horizontal run of pixels of an object
+
+A script can return SparseObjects created by from_ijv or from_rle instead
+of a label matrix. Their pixels are only written into a label matrix if
+CellProfiler cannot store the ijv form directly.
+'''
+
+import numpy as np
+
+
+def _labels(objects):
+    # the label matrix of objects, sparse objects or a label matrix
+    if isinstance(objects, SparseObjects):
+        return objects.segmented
+    return np.asarray(getattr(objects, 'segmented', objects))
+
+
+def ijv(objects):
+    '''Return the ijv form of objects or a label matrix'''
+    if hasattr(objects, 'ijv'):
+        # sparse objects and CellProfiler objects that know their pixels
+        return np.asarray(objects.ijv)
+    labels = _labels(objects)
+    i, j = np.nonzero(labels)
+    return np.column_stack((i, j, labels[i, j])).astype(np.int32)
+
+
+def pixel_indices(objects):
+    '''Return a list with the flat pixel indices of each object 1..M'''
+    labels = _labels(objects)
+    indices = np.flatnonzero(labels)
+    numbers = labels.ravel()[indices]
+    count = numbers.max() if len(numbers) > 0 else 0
+    # a stable sort keeps the pixels of each object in raster order
+    order = np.argsort(numbers, kind='mergesort')
+    sizes = np.bincount(numbers, minlength=count + 1)[1:]
+    return np.split(indices[order], np.cumsum(sizes)[:-1]) \
+        if count > 0 else []
+
+
+def rle(objects):
+    '''Return the horizontal runs of the pixels of the objects'''
+    labels = _labels(objects)
+    height, width = labels.shape
+    padded = np.zeros((height, width + 2), labels.dtype)
+    padded[:, 1:-1] = labels
+    # the positions at which the label changes within each row, every row
+    # with objects starts and ends with a change because of the padding
+    rows, columns = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    same_row = rows[:-1] == rows[1:]
+    starts = columns[:-1][same_row]
+    lengths = columns[1:][same_row] - starts
+    rows = rows[:-1][same_row]
+    numbers = padded[rows, starts + 1]
+    keep = numbers != 0
+    return np.column_stack((rows[keep], starts[keep], lengths[keep],
+                            numbers[keep])).astype(np.int32)
+
+
+class SparseObjects(object):
+    '''Objects given by the ijv form of their pixels
+
+    ijv - an (N, 3) array with the row, column and object number of each
+          pixel, an object may overlap with others
+    shape - the shape of the label matrix
+    '''
+    def __init__(self, ijv, shape):
+        self.ijv = np.asarray(ijv, np.int32).reshape(-1, 3)
+        self.shape = tuple(shape[:2])
+
+    @property
+    def count(self):
+        '''Return the highest object number'''
+        return int(self.ijv[:, 2].max()) if len(self.ijv) > 0 else 0
+
+    @property
+    def segmented(self):
+        '''Return a label matrix, overlapping pixels get the last label'''
+        labels = np.zeros(self.shape, np.int32)
+        labels[self.ijv[:, 0], self.ijv[:, 1]] = self.ijv[:, 2]
+        return labels
+
+
+def from_ijv(ijv, shape):
+    '''Return objects given by the ijv form of their pixels'''
+    return SparseObjects(ijv, shape)
+
+
+def from_rle(runs, shape):
+    '''Return objects given by horizontal runs (see rle)'''
+    runs = np.asarray(runs, np.int64).reshape(-1, 4)
+    rows, starts, lengths, numbers = runs.T
+    total = lengths.sum()
+    # the offset of each pixel within its run
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths,
+                                           lengths)
+    return SparseObjects(np.column_stack((
+        np.repeat(rows, lengths),
+        np.repeat(starts, lengths) + offsets,
+        np.repeat(numbers, lengths))), shape)
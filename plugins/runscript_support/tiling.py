@@ -0,0 +1,213 @@
+'''Tiled execution of RunScript scripts on large images
+
+The image set is divided into square tiles. The script is run once for each
+tile on windows of the input images and label matrices that extend the tile
+by a halo on each side, so that filters and objects near the border of the
+tile see their neighborhood. The outputs of the tiles are stitched:
+
+- images are assembled from the core of each tile, i.e. without the halo
+- each object belongs to the tile whose core contains its centroid, it is
+  taken completely from that tile and renumbered
+- per-object measurements are taken from the tile an object belongs to
+
+Objects that are larger than the halo may be cut by the border of the
+window and should not be used with tiles.
+'''
+
+import numpy as np
+
+from runscript_support import regions
+
+
+class Tile(object):
+    '''A tile of the images of an image set
+
+    index - the number of the tile, starting at 0
+    window - the slices of the tile including the halo in image coordinates
+    core - the slices of the part of the image the tile is responsible for
+    inner - the slices of the core relative to the window
+    shape - the shape of the whole image
+    '''
+    def __init__(self, index, window, core, shape):
+        self.index = index
+        self.window = window
+        self.core = core
+        self.inner = tuple(slice(c.start - w.start, c.stop - w.start)
+                           for c, w in zip(core, window))
+        self.shape = shape
+
+    @property
+    def offset(self):
+        '''Return the image coordinates of the first pixel of the window'''
+        return tuple(w.start for w in self.window)
+
+    def contains(self, points):
+        '''Return which of the points (N, 2) lie in the core of the tile'''
+        points = np.asarray(points)
+        inside = np.ones(len(points), bool)
+        for dim, core in enumerate(self.core):
+            inside &= (points[:, dim] >= core.start) \
+                & (points[:, dim] < core.stop)
+        return inside
+
+
+def make_tiles(shape, tile_size, halo):
+    '''Divide the first two dimensions of an image into tiles
+
+    shape - the shape of the images
+    tile_size - the width and height of the core of the tiles
+    halo - the number of pixels the window extends the core on each side
+    '''
+    tiles = []
+    height, width = shape[:2]
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            core = (slice(y, min(y + tile_size, height)),
+                    slice(x, min(x + tile_size, width)))
+            window = tuple(slice(max(0, c.start - halo), min(n, c.stop + halo))
+                           for c, n in zip(core, (height, width)))
+            tiles.append(Tile(len(tiles), window, core, tuple(shape[:2])))
+    return tiles
+
+
+def crop_inputs(inputs, tile):
+    '''Return the inputs of a script restricted to the window of a tile
+
+    inputs - the inputs of the script (see engine.make_attributes)
+
+    The images and label matrices are views of the window, measurements
+    and constants are passed on unchanged.
+    '''
+    cropped = dict(inputs)
+    cropped['images'] = dict(
+        (name, (pixel_data[tile.window],
+                None if mask is None else mask[tile.window]))
+        for name, (pixel_data, mask) in inputs['images'].iteritems())
+    cropped['objects'] = dict(
+        (name, labels[tile.window])
+        for name, labels in inputs['objects'].iteritems())
+    cropped['tile'] = tile
+    return cropped
+
+
+def owned_labels(labels, tile, offset=(0, 0)):
+    '''Return the labels whose centroid lies in the core of a tile
+
+    labels - a label matrix
+    offset - the image coordinates of the first pixel of the label matrix
+    '''
+    statistics = regions.label_statistics(labels)
+    present = statistics.count > 0
+    centroids = np.floor(statistics.centroid[present]) + np.array(offset)
+    return statistics.labels[present][tile.contains(centroids)]
+
+
+class TileStitcher(object):
+    '''Assembles the outputs of the tiles of an image set
+
+    tiles - the tiles the script has been run on
+    shape - the shape of the whole image
+    '''
+    def __init__(self, tiles, shape):
+        self.tiles = tiles
+        self.shape = tuple(shape[:2])
+        self.images = {}
+        self.objects = {}
+        # for each objects name the number of objects and for each tile the
+        # object numbers in the tile and the corresponding object numbers
+        # in the whole image
+        self.__counts = {}
+        self.__numbering = {}
+
+    def add_image(self, name, tile, pixel_data):
+        '''Add the core of the image a tile has produced'''
+        pixel_data = np.asarray(pixel_data)
+        window_shape = tuple(w.stop - w.start for w in tile.window)
+        if pixel_data.shape[:2] != window_shape:
+            raise ValueError('The image %s of tile %d has the shape %s but'
+                             ' the tile has the shape %s' % (
+                                 name, tile.index, pixel_data.shape[:2],
+                                 window_shape))
+        if name not in self.images:
+            self.images[name] = np.zeros(
+                self.shape + pixel_data.shape[2:], pixel_data.dtype)
+        self.images[name][tile.core] = pixel_data[tile.inner]
+
+    def add_objects(self, name, tile, labels):
+        '''Add the objects a tile owns from the label matrix it has produced
+
+        The objects are renumbered following the objects of the tiles that
+        have been added before.
+        '''
+        labels = np.asarray(labels)
+        if name not in self.objects:
+            self.objects[name] = np.zeros(self.shape, np.int32)
+            self.__counts[name] = 0
+            self.__numbering[name] = [None] * len(self.tiles)
+        local = owned_labels(labels, tile, tile.offset)
+        start = self.__counts[name]
+        numbers = np.arange(start + 1, start + 1 + len(local))
+        lookup = np.zeros(labels.max() + 1 if labels.size > 0 else 1,
+                          np.int32)
+        lookup[local] = numbers
+        relabeled = lookup[labels]
+        foreground = relabeled > 0
+        self.objects[name][tile.window][foreground] = relabeled[foreground]
+        self.__numbering[name][tile.index] = (local, numbers)
+        self.__counts[name] += len(local)
+
+    def assign_objects(self, name, labels):
+        '''Assign the objects of a label matrix of the whole image to tiles
+
+        This is used for input objects, which keep their numbers.
+        '''
+        labels = np.asarray(labels)
+        self.__counts[name] = int(labels.max()) if labels.size > 0 else 0
+        numbering = []
+        for tile in self.tiles:
+            local = owned_labels(labels[tile.window], tile, tile.offset)
+            numbering.append((local, local))
+        self.__numbering[name] = numbering
+
+    def has_objects(self, name):
+        return name in self.__numbering
+
+    def merge_values(self, name, values_per_tile):
+        '''Merge the per-object values computed by each tile
+
+        name - the name of the objects the values belong to
+        values_per_tile - for each tile an array with one value per object
+                          number of the tile
+
+        Returns an array with one value per object of the whole image.
+        '''
+        values_per_tile = [np.asarray(values) for values in values_per_tile]
+        dtype = np.result_type(*values_per_tile)
+        result = np.zeros(self.__counts[name], dtype)
+        if dtype.kind in 'fc':
+            result.fill(np.nan)
+        for tile, values in zip(self.tiles, values_per_tile):
+            local, numbers = self.__numbering[name][tile.index]
+            if len(local) == 0:
+                continue
+            if local.max() > len(values):
+                raise ValueError(
+                    'Tile %d returned %d values for %s but it contains'
+                    ' object %d' % (tile.index, len(values), name,
+                                    local.max()))
+            result[numbers - 1] = values[local - 1]
+        return result
+
+    def merge_tables(self, name, tables_per_tile):
+        '''Merge tables with one row per object number of each tile
+
+        The tables are structured arrays or dictionaries of columns. The
+        result is a dictionary of columns.
+        '''
+        first = tables_per_tile[0]
+        columns = first.dtype.names if isinstance(first, np.ndarray) \
+            else first.keys()
+        return dict(
+            (column, self.merge_values(
+                name, [table[column] for table in tables_per_tile]))
+            for column in columns)
@@ -0,0 +1,124 @@
+'''Shared memory transport of arrays between processes
+
+Arrays are placed in memory-mapped files (in /dev/shm if available) and
+only small handles are sent between the processes. The receiving side maps
+the file and sees the array as a NumPy view without any serialization.
+'''
+
+import os
+import uuid
+import tempfile
+
+import numpy as np
+
+if os.path.isdir('/dev/shm'):
+    SHARED_DIR = '/dev/shm'
+else:
+    SHARED_DIR = tempfile.gettempdir()
+
+SHARED_PREFIX = 'CPRunScript_shm_'
+
+
+class SharedArray(object):
+    '''Picklable handle of an array in a memory-mapped file'''
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = dtype
+        self.shape = shape
+
+    def attach(self, writeable=False):
+        '''Return the array as a view of the memory-mapped file'''
+        return np.memmap(self.path, dtype=self.dtype,
+                         mode='r+' if writeable else 'r',
+                         shape=self.shape).view(np.ndarray)
+
+
+def is_shareable(value):
+    return isinstance(value, np.ndarray) \
+        and value.size > 0 and not value.dtype.hasobject
+
+
+class SharedArrayStore(object):
+    '''Keeps track of the memory-mapped files of shared arrays
+
+    prefix - the prefix of the names of the files, see remove_files
+
+    The files are removed by cleanup(). Arrays that have already been
+    attached stay valid after their files have been removed.
+    '''
+    def __init__(self, prefix=SHARED_PREFIX):
+        self.prefix = prefix
+        self.__paths = set()
+
+    def share(self, array):
+        '''Copy an array into a new memory-mapped file and return a handle'''
+        handle, path = tempfile.mkstemp(prefix=self.prefix, dir=SHARED_DIR)
+        os.close(handle)
+        self.__paths.add(path)
+        shared = np.memmap(path, dtype=array.dtype, mode='w+',
+                           shape=array.shape)
+        shared[...] = array
+        del shared
+        return SharedArray(path, array.dtype, array.shape)
+
+    def adopt(self, shared_array):
+        '''Take over the file of a handle created by another process'''
+        self.__paths.add(shared_array.path)
+
+    def export(self, value):
+        '''Replace all arrays in a nested container by shared handles'''
+        if is_shareable(value):
+            return self.share(value)
+        elif isinstance(value, dict):
+            return dict((k, self.export(v)) for k, v in value.iteritems())
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self.export(v) for v in value)
+        return value
+
+    def cleanup(self):
+        '''Remove the files of all shared arrays'''
+        for path in self.__paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.__paths.clear()
+
+
+def make_prefix():
+    '''Return a file name prefix that is unique to the calling object'''
+    return '%s%d_%s_' % (SHARED_PREFIX, os.getpid(), uuid.uuid4().hex[:8])
+
+
+def remove_files(prefix):
+    '''Remove the files of all shared arrays whose names start with prefix
+
+    This also removes files created by other processes, e.g. the outputs
+    of workers that were never received.
+    '''
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith(prefix):
+            try:
+                os.remove(os.path.join(SHARED_DIR, name))
+            except OSError:
+                pass
+
+
+def shared_arrays(value):
+    '''Return all shared handles in a nested container'''
+    if isinstance(value, SharedArray):
+        return [value]
+    elif isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, (list, tuple)):
+        return []
+    return [shared for v in value for shared in shared_arrays(v)]
+
+
+def resolve(value, writeable=False):
+    '''Replace all shared handles in a nested container by array views'''
+    if isinstance(value, SharedArray):
+        return value.attach(writeable)
+    elif isinstance(value, dict):
+        return dict((k, resolve(v, writeable)) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(resolve(v, writeable) for v in value)
+    return value
@@ -0,0 +1,353 @@
+'''Benchmarks of the RunScript module and its support package
+
+Usage: python test/benchmark.py [--sizes 256,1024] [--objects 10,1000]
+                                [--repeat 5] [--output results.json]
+
+The module is run on a stand-in workspace with synthetic images and label
+matrices, so neither the CellProfiler GUI nor a pipeline is needed. Only
+numpy and scipy are required. If CellProfiler is not installed, the
+modules it provides to RunScript are replaced by the minimal stand-ins of
+cpstandin.
+
+The results are written as JSON, one entry per benchmark and parameter
+combination with the minimum, median and mean time in seconds, so that
+the results of two revisions can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import contextlib
+
+import numpy as np
+import scipy.ndimage as nd
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+# the cellprofiler package of this repository is only used if CellProfiler
+# is not installed, the scripts need it as the parent of cpscript
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.engine as rsengine
+import runscript_support.regions as rsregions
+
+import cpstandin
+
+SCRIPT_PATH = os.path.join(TEST_DIR, 'cpscripts', 'script.py')
+IMAGE_NAME = 'DNA'
+OBJECTS_NAME = 'Nuclei'
+
+
+class FakeImageSet(object):
+    '''Stand-in for cpi.ImageSet holding images by name'''
+    def __init__(self, images=None):
+        self.images = dict(images or {})
+
+    def get_image(self, name):
+        return self.images[name]
+
+    def add(self, name, image):
+        self.images[name] = image
+
+
+class FakeObjectSet(object):
+    '''Stand-in for cpo.ObjectSet holding objects by name'''
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def get_objects(self, name):
+        return self.objects[name]
+
+    def add_objects(self, objects, name):
+        self.objects[name] = objects
+
+
+class FakeMeasurements(object):
+    '''Stand-in for cpmeas.Measurements of a single image set'''
+    def __init__(self, image_set_number=1):
+        self.image_set_number = image_set_number
+        self.values = {}
+
+    def get_current_image_measurement(self, feature):
+        return self.values['Image', feature]
+
+    def get_current_measurement(self, object_name, feature):
+        return self.values[object_name, feature]
+
+    def add_image_measurement(self, feature, value):
+        self.values['Image', feature] = value
+
+    def add_measurement(self, object_name, feature, value,
+                        image_set_number=None):
+        self.values[object_name, feature] = value
+
+
+class FakePipeline(object):
+    def __init__(self, modules):
+        self.__modules = modules
+
+    def modules(self):
+        return self.__modules
+
+
+class FakeWorkspace(object):
+    '''Stand-in for cpw.Workspace with the attributes used by RunScript'''
+    def __init__(self, pipeline, image_set, object_set, measurements):
+        self.pipeline = pipeline
+        self.image_set = image_set
+        self.object_set = object_set
+        self.measurements = measurements
+
+
+def synthetic_inputs(size, nobjects, seed=0):
+    '''Return a random image and a label matrix with disk-shaped objects
+
+    size - the width and height of the image
+    nobjects - the number of objects, objects may overlap each other
+    '''
+    random = np.random.RandomState(seed)
+    pixel_data = random.uniform(size=(size, size))
+    labels = np.zeros((size, size), np.int32)
+    radius = max(2, int(size / (2.5 * np.sqrt(nobjects))))
+    i, j = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = i * i + j * j <= radius * radius
+    centers = random.randint(radius, size - radius, size=(nobjects, 2))
+    for number, (ci, cj) in enumerate(centers):
+        window = labels[ci - radius:ci + radius + 1,
+                        cj - radius:cj + radius + 1]
+        window[disk] = number + 1
+    return pixel_data, labels
+
+
+def measure(func, repeat):
+    '''Call func repeat times and return statistics of the wall time'''
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times)),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Discard the output printed by the benchmarked scripts'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class Benchmarks(object):
+    '''Runs the benchmarks and collects their results'''
+    def __init__(self, sizes, object_counts, repeat):
+        self.sizes = sizes
+        self.object_counts = object_counts
+        self.repeat = repeat
+        self.results = []
+        self.skipped = []
+        with open(SCRIPT_PATH) as f:
+            self.script_source = f.read()
+
+    def add(self, name, func, **params):
+        with quiet():
+            result = measure(func, self.repeat)
+        result.update(name=name, params=params)
+        self.results.append(result)
+        print >> sys.stderr, '%-32s %-28s %10.6f s' % (
+            name, ' '.join('%s=%s' % item for item in sorted(params.items())),
+            result['min'])
+
+    def inputs(self):
+        '''Yield the size, object count and inputs of each combination'''
+        for size in self.sizes:
+            for nobjects in self.object_counts:
+                pixel_data, labels = synthetic_inputs(size, nobjects)
+                inputs = {
+                    'images': {IMAGE_NAME: (pixel_data, None)},
+                    'objects': {OBJECTS_NAME: labels},
+                    'measurements': {},
+                    'constants': {},
+                }
+                yield size, nobjects, inputs
+
+    def run_engine(self):
+        '''Benchmark the execution of scripts without CellProfiler'''
+        executor = rsengine.ScriptExecutor(compile('x = 1', 'empty', 'exec'))
+        self.add('executor_overhead',
+                 lambda: executor.execute(rsengine.common_attributes()))
+        executor = rsengine.ScriptExecutor(
+            compile('def run():\n    return {}\n', 'phased', 'exec'))
+        self.add('executor_overhead_phased',
+                 lambda: executor.execute(rsengine.common_attributes()))
+        codeobj = compile(self.script_source, SCRIPT_PATH, 'exec')
+        executor = rsengine.ScriptExecutor(codeobj)
+        for size, nobjects, inputs in self.inputs():
+            self.add('make_attributes',
+                     lambda: rsengine.make_attributes(inputs),
+                     size=size, objects=nobjects)
+            self.add('execute_script.py',
+                     lambda: executor.execute(
+                         rsengine.make_attributes(inputs)),
+                     size=size, objects=nobjects)
+            pixel_data = inputs['images'][IMAGE_NAME][0]
+            labels = inputs['objects'][OBJECTS_NAME]
+            self.add('label_statistics',
+                     lambda: rsregions.label_statistics(labels, pixel_data),
+                     size=size, objects=nobjects)
+
+            def ndimage_statistics():
+                # the same statistics with one call each, objects that are
+                # completely covered by others give NaN as in label_statistics
+                indexes = np.arange(1, labels.max() + 1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    nd.sum(np.ones(labels.shape), labels, indexes)
+                    nd.center_of_mass(np.ones(labels.shape), labels, indexes)
+                    nd.find_objects(labels)
+                    nd.sum(pixel_data, labels, indexes)
+                    nd.mean(pixel_data, labels, indexes)
+                    nd.variance(pixel_data, labels, indexes)
+                    nd.minimum(pixel_data, labels, indexes)
+                    nd.maximum(pixel_data, labels, indexes)
+            self.add('ndimage_statistics', ndimage_statistics,
+                     size=size, objects=nobjects)
+
+    def make_module(self, runscript, source, code_cache=True,
+                    with_inputs=True):
+        '''Create a RunScript module set up like the test pipeline'''
+        module = runscript.RunScript()
+        module.module_num = 1
+        module.script_text.value = source
+        module.wants_code_cache.value = code_cache
+        if not with_inputs:
+            return module
+        module.add_input_image_cb()
+        module.input_image_groups[-1].image.value = IMAGE_NAME
+        module.add_input_object_cb()
+        module.input_object_groups[-1].objects.value = OBJECTS_NAME
+        for py_name, relate_to_object, on_image, name in (
+                ('py_img_output', False, True, 'ImageMeasurement'),
+                ('py_img_obj_output', True, True, 'ImageObjectMeasurement'),
+                ('py_obj_output', True, False, 'ObjectMeasurement')):
+            module.add_output_measurement_cb()
+            group = module.output_measurement_groups[-1]
+            group.relate_to_object.value = relate_to_object
+            group.on_image.value = on_image
+            group.object.value = OBJECTS_NAME
+            group.image.value = IMAGE_NAME
+            group.measurement_name.value = name
+            group.py_name.value = py_name
+        return module
+
+    def make_workspace(self, module, inputs):
+        images = dict(
+            (name, rsengine.ScriptImage(pixel_data, mask))
+            for name, (pixel_data, mask) in inputs['images'].iteritems())
+        objects = dict(
+            (name, rsengine.ScriptObjects(segmented))
+            for name, segmented in inputs['objects'].iteritems())
+        return FakeWorkspace(FakePipeline([module]), FakeImageSet(images),
+                             FakeObjectSet(objects), FakeMeasurements())
+
+    def run_module(self):
+        '''Benchmark the RunScript module on a stand-in workspace'''
+        if cpstandin.install():
+            print >> sys.stderr, 'CellProfiler is not installed, using' \
+                ' the stand-ins of cpstandin'
+        try:
+            import runscript
+        except ImportError as err:
+            self.skipped.append('RunScript module: %s' % err)
+            print >> sys.stderr, 'Skipping the RunScript module: %s' % err
+            return
+        empty_inputs = {'images': {}, 'objects': {}}
+        # a new comment for each run makes the source miss the code cache
+        runs = iter(xrange(sys.maxint))
+        module = self.make_module(runscript, self.script_source)
+        workspace = self.make_workspace(module, empty_inputs)
+
+        def prepare_cold():
+            module.script_text.value = '%s\n# run %d\n' % (
+                self.script_source, next(runs))
+            module.prepare_run(workspace)
+            module.post_run(workspace)
+        self.add('prepare_run_cache_cold', prepare_cold)
+        module = self.make_module(runscript, self.script_source)
+        self.add('prepare_run_cache_warm',
+                 lambda: module.prepare_run(workspace))
+        module = self.make_module(runscript, self.script_source,
+                                  code_cache=False)
+
+        def prepare_uncached():
+            module.prepare_run(workspace)
+            module.post_run(workspace)
+        self.add('prepare_run_uncached', prepare_uncached)
+        module = self.make_module(runscript, 'x = 1', with_inputs=False)
+        workspace = self.make_workspace(module, empty_inputs)
+        module.prepare_run(workspace)
+        self.add('run_overhead', lambda: module.run(workspace))
+        module.post_run(workspace)
+        module = self.make_module(runscript, self.script_source)
+        module.prepare_run(workspace)
+        for size, nobjects, inputs in self.inputs():
+            workspace = self.make_workspace(module, inputs)
+            self.add('run_script.py', lambda: module.run(workspace),
+                     size=size, objects=nobjects)
+        module.post_run(workspace)
+
+    def report(self):
+        return {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'skipped': self.skipped,
+            'results': self.results,
+        }
+
+
+def parse_ints(text):
+    return [int(x) for x in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RunScript module')
+    parser.add_argument('--sizes', type=parse_ints, default=[256, 1024],
+                        help='comma-separated image widths')
+    parser.add_argument('--objects', type=parse_ints, default=[10, 1000],
+                        help='comma-separated numbers of objects')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--output', default=None,
+                        help='file to write the JSON results to, by default'
+                             ' they are printed')
+    options = parser.parse_args(argv)
+    benchmarks = Benchmarks(options.sizes, options.objects, options.repeat)
+    benchmarks.run_engine()
+    benchmarks.run_module()
+    text = json.dumps(benchmarks.report(), indent=2, sort_keys=True)
+    if options.output is None:
+        print text
+    else:
+        with open(options.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''Minimal stand-ins for the CellProfiler modules imported by RunScript
+
+install() puts modules providing the parts of cellprofiler.cpimage,
+cpmodule, measurements, objects, settings, workspace and preferences that
+RunScript uses into sys.modules, so that the RunScript module can be
+created, prepared and run on a stand-in workspace without CellProfiler.
+Nothing is installed if CellProfiler can be imported.
+
+The settings only hold their values, they are neither validated nor shown.
+'''
+
+import sys
+import types
+import tempfile
+
+import numpy as np
+
+STANDIN_MODULES = ('cpimage', 'cpmodule', 'measurements', 'objects',
+                   'settings', 'workspace', 'preferences')
+
+
+def _module(name, **attributes):
+    module = types.ModuleType('cellprofiler.%s' % name)
+    module.__dict__.update(attributes)
+    return module
+
+
+class Image(object):
+    '''Stand-in for cpi.Image'''
+    def __init__(self, image=None, mask=None, crop_mask=None,
+                 parent_image=None, masking_objects=None, convert=True,
+                 path_name=None, file_name=None, scale=None):
+        if image is not None and convert:
+            image = np.asarray(image, np.float64)
+        self.pixel_data = image
+        self.mask = mask
+        self.scale = scale
+
+    @property
+    def has_mask(self):
+        return self.mask is not None
+
+
+class Objects(object):
+    '''Stand-in for cpo.Objects'''
+    def __init__(self):
+        self.segmented = None
+
+
+class CPModule(object):
+    '''Stand-in for cpm.CPModule'''
+    def __init__(self):
+        self.module_num = 0
+        self.create_settings()
+
+
+class ValidationError(ValueError):
+    def __init__(self, message, setting):
+        ValueError.__init__(self, message)
+        self.message = message
+        self.setting = setting
+
+
+class Setting(object):
+    '''A setting that only holds its value'''
+    def __init__(self, text, value=None, *args, **kwargs):
+        self.text = text
+        self.value = value
+
+    def set_value(self, value):
+        self.value = value
+
+
+class Choice(Setting):
+    def __init__(self, text, choices, value=None, *args, **kwargs):
+        Setting.__init__(self, text, choices[0] if value is None else value)
+        self.choices = choices
+
+
+class DirectoryPath(Setting):
+    def __init__(self, text, *args, **kwargs):
+        Setting.__init__(self, text, '')
+
+    def get_absolute_path(self):
+        return self.value or tempfile.gettempdir()
+
+
+class Measurement(Setting):
+    def __init__(self, text, object_fn, value='None', *args, **kwargs):
+        Setting.__init__(self, text, value)
+        self.object_fn = object_fn
+
+
+class HiddenCount(Setting):
+    def __init__(self, sequence, text='Hidden'):
+        Setting.__init__(self, text)
+        self.sequence = sequence
+
+    @property
+    def value(self):
+        return len(self.sequence)
+
+    @value.setter
+    def value(self, value):
+        pass
+
+
+class Button(Setting):
+    def __init__(self, text, label, *args, **kwargs):
+        Setting.__init__(self, text, label)
+
+
+class Divider(Setting):
+    def __init__(self, text='', *args, **kwargs):
+        Setting.__init__(self, text)
+
+
+class ImageNameSubscriber(Setting):
+    pass
+
+
+class ObjectNameSubscriber(Setting):
+    pass
+
+
+class SettingsGroup(object):
+    def __init__(self):
+        self.settings = []
+
+    def append(self, name, setting):
+        setattr(self, name, setting)
+        self.settings.append(setting)
+
+
+def install():
+    '''Install the stand-ins unless CellProfiler can be imported
+
+    Returns True if the stand-ins have been installed.
+    '''
+    try:
+        import cellprofiler.cpimage
+        return False
+    except ImportError:
+        pass
+    import cellprofiler
+    modules = {
+        'cpimage': _module('cpimage', Image=Image),
+        'cpmodule': _module('cpmodule', CPModule=CPModule),
+        'measurements': _module(
+            'measurements', IMAGE='Image', COLTYPE_FLOAT='float',
+            COLTYPE_INTEGER='integer'),
+        'objects': _module('objects', Objects=Objects),
+        'settings': _module(
+            'settings', YES='Yes', NO='No', NONE='None',
+            ValidationError=ValidationError, Setting=Setting,
+            Binary=Setting, Text=Setting, Integer=Setting, Float=Setting,
+            FilenameText=Setting, ImageNameProvider=Setting,
+            ObjectNameProvider=Setting, Choice=Choice,
+            DirectoryPath=DirectoryPath, Measurement=Measurement,
+            HiddenCount=HiddenCount, DoSomething=Button,
+            RemoveSettingButton=Button, Divider=Divider,
+            ImageNameSubscriber=ImageNameSubscriber,
+            ObjectNameSubscriber=ObjectNameSubscriber,
+            SettingsGroup=SettingsGroup),
+        'workspace': _module('workspace', DISPOSITION_SKIP='Skip'),
+        'preferences': _module(
+            'preferences',
+            DEFAULT_INPUT_FOLDER_NAME='Default Input Folder',
+            DEFAULT_OUTPUT_FOLDER_NAME='Default Output Folder',
+            NO_FOLDER_NAME='None',
+            ABSOLUTE_FOLDER_NAME='Elsewhere...',
+            get_default_output_directory=tempfile.gettempdir),
+    }
+    for name in STANDIN_MODULES:
+        sys.modules['cellprofiler.%s' % name] = modules[name]
+        setattr(cellprofiler, name, modules[name])
+    return True
@@ -0,0 +1,189 @@
+'''Tests of the execution of RunScript scripts without CellProfiler
+
+Usage: python test/test_engine.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.engine as rsengine
+
+PHASED_SCRIPT = '''
+import cellprofiler.cpscript as cpscript
+cpscript.constants['log'].append('body')
+
+def setup():
+    cpscript.constants['log'].append('setup')
+
+def run():
+    cpscript.constants['log'].append('run')
+    total = cpscript.images['DNA'].pixel_data.sum()
+    if total > 10:
+        return {'total': total, 'large': True}
+    return {'total': total}
+
+def post_group():
+    return {'calls': len(cpscript.constants['log'])}
+'''
+
+PLAIN_SCRIPT = '''
+import cellprofiler.cpscript as cpscript
+cpscript.constants['log'].append('body')
+total = cpscript.images['DNA'].pixel_data.sum()
+'''
+
+
+def make_inputs(pixel_data, log, **inputs):
+    result = {
+        'images': {'DNA': (pixel_data, None)},
+        'objects': {},
+        'measurements': {},
+        'constants': {'log': log},
+    }
+    result.update(inputs)
+    return result
+
+
+class TestScriptExecutor(unittest.TestCase):
+    def setUp(self):
+        rsengine.ensure_cpscript_package()
+        self.log = []
+
+    def execute(self, executor, pixel_data):
+        return executor.execute(rsengine.make_attributes(
+            make_inputs(pixel_data, self.log)))
+
+    def test_phased_script_runs_body_once(self):
+        executor = rsengine.ScriptExecutor(
+            compile(PHASED_SCRIPT, 'phased', 'exec'))
+        self.assertTrue(executor.phased)
+        for value in (1, 2, 3):
+            namespace = self.execute(executor, np.ones((2, 2)) * value)
+            self.assertEqual(namespace['total'], 4 * value)
+        self.assertEqual(self.log, ['body', 'setup', 'run', 'run', 'run'])
+
+    def test_outputs_of_earlier_runs_are_not_kept(self):
+        executor = rsengine.ScriptExecutor(
+            compile(PHASED_SCRIPT, 'phased', 'exec'))
+        namespace = self.execute(executor, np.ones((4, 4)))
+        self.assertTrue(namespace['large'])
+        namespace = self.execute(executor, np.ones((2, 2)))
+        self.assertNotIn('large', namespace)
+        self.assertNotIn('large', executor.namespace)
+        with self.assertRaises(KeyError) as context:
+            rsengine.get_outputs(namespace, ['total', 'large'], 2)
+        self.assertIn('large for image set 2', str(context.exception))
+        self.assertEqual(rsengine.get_outputs(namespace, ['total']),
+                         {'total': 4})
+
+    def test_call(self):
+        executor = rsengine.ScriptExecutor(
+            compile(PHASED_SCRIPT, 'phased', 'exec'))
+        attributes = rsengine.make_attributes(
+            make_inputs(np.ones((2, 2)), self.log))
+        # the body and setup() run first in a new process
+        self.assertEqual(executor.call('post_group', attributes),
+                         {'calls': 2})
+        executor.execute(attributes)
+        self.assertEqual(executor.call('post_group', attributes),
+                         {'calls': 3})
+        executor.reset()
+        executor.execute(attributes)
+        self.assertEqual(self.log, ['body', 'setup', 'run',
+                                    'body', 'setup', 'run'])
+
+    def test_plain_script_runs_each_time(self):
+        executor = rsengine.ScriptExecutor(
+            compile(PLAIN_SCRIPT, 'plain', 'exec'))
+        self.assertFalse(executor.phased)
+        for value in (1, 2):
+            namespace = self.execute(executor, np.ones((2, 2)) * value)
+            self.assertEqual(namespace['total'], 4 * value)
+        self.assertEqual(self.log, ['body', 'body'])
+
+    def test_cpscript_is_removed_after_the_run(self):
+        executor = rsengine.ScriptExecutor(
+            compile(PLAIN_SCRIPT, 'plain', 'exec'))
+        self.execute(executor, np.ones((2, 2)))
+        self.assertNotIn(rsengine.CPSCRIPT_MODULE, sys.modules)
+        self.assertNotIn(executor.hook, sys.meta_path)
+
+    def test_read_only_inputs(self):
+        pixel_data = np.ones((2, 2))
+        attributes = rsengine.make_attributes(
+            make_inputs(pixel_data, self.log, read_only=True))
+        image = attributes['images']['DNA']
+        self.assertFalse(image.pixel_data.flags.writeable)
+        self.assertTrue(pixel_data.flags.writeable)
+
+
+class TestStackInputs(unittest.TestCase):
+    def test_stack_inputs(self):
+        log = []
+        inputs_list = [
+            make_inputs(np.ones((2, 3)), log,
+                        objects={'Nuclei': np.ones((2, 3), int)},
+                        measurements={'Image_Count': 1,
+                                      'Nuclei_Area': np.array([6.0])}),
+            make_inputs(np.ones((3, 2)) * 2, log,
+                        objects={'Nuclei': np.ones((3, 2), int) * 2},
+                        measurements={'Image_Count': 2,
+                                      'Nuclei_Area': np.array([3.0, 3.0])}),
+        ]
+        batch = rsengine.stack_inputs(inputs_list, [4, 5])
+        self.assertEqual(batch['batch_size'], 2)
+        np.testing.assert_array_equal(batch['image_numbers'], [4, 5])
+        self.assertIs(batch['constants'], inputs_list[0]['constants'])
+        pixel_data, mask = batch['images']['DNA']
+        self.assertIsNone(mask)
+        # padded with zeros to the common shape
+        self.assertEqual(pixel_data.shape, (2, 3, 3))
+        np.testing.assert_array_equal(pixel_data[0], [[1, 1, 1],
+                                                      [1, 1, 1],
+                                                      [0, 0, 0]])
+        np.testing.assert_array_equal(pixel_data[1], [[2, 2, 0],
+                                                      [2, 2, 0],
+                                                      [2, 2, 0]])
+        self.assertEqual(batch['objects']['Nuclei'].shape, (2, 3, 3))
+        self.assertEqual(batch['objects']['Nuclei'][1, 2, 2], 0)
+        np.testing.assert_array_equal(batch['measurements']['Image_Count'],
+                                      [1, 2])
+        areas = batch['measurements']['Nuclei_Area']
+        self.assertEqual(len(areas), 2)
+        np.testing.assert_array_equal(areas[1], [3.0, 3.0])
+
+    def test_stack_masks(self):
+        masks = [np.ones((2, 2), bool), np.ones((1, 2), bool)]
+        inputs_list = [
+            make_inputs(np.ones(mask.shape), [], images={
+                'DNA': (np.ones(mask.shape), mask)})
+            for mask in masks]
+        pixel_data, mask = rsengine.stack_inputs(
+            inputs_list, [1, 2])['images']['DNA']
+        self.assertEqual(mask.dtype, bool)
+        np.testing.assert_array_equal(mask[1], [[True, True],
+                                                [False, False]])
+
+    def test_batch_attributes(self):
+        inputs_list = [make_inputs(np.ones((2, 2)) * value, [])
+                       for value in (1, 2, 3)]
+        attributes = rsengine.make_attributes(
+            rsengine.stack_inputs(inputs_list, [1, 2, 3]))
+        self.assertEqual(attributes['batch_size'], 3)
+        self.assertEqual(
+            attributes['images']['DNA'].pixel_data.sum(axis=(1, 2)).tolist(),
+            [4, 8, 12])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''Tests of the headless runner of RunScript scripts
+
+Usage: python test/test_headless.py
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.headless as rsheadless
+
+SCRIPT = '''
+import cellprofiler.cpscript as cpscript
+cpscript.constants['log'].append(cpscript.image_numbers)
+total = cpscript.images['DNA'].pixel_data.sum()
+'''
+
+
+class RecordingWriter(object):
+    '''Remembers how many image sets had run when each row was written'''
+    def __init__(self, log):
+        self.log = log
+        self.rows = []
+        self.closed = False
+
+    def write(self, image_number, files, metadata, outputs):
+        self.rows.append((image_number, len(self.log), outputs['total']))
+
+    def close(self):
+        self.closed = True
+
+
+class TestHeadless(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for index in range(3):
+            np.save(os.path.join(self.directory, 'dna_%d.npy' % index),
+                    np.ones((4, 5)) * (index + 1))
+        self.script_path = os.path.join(self.directory, 'script.py')
+        with open(self.script_path, 'w') as f:
+            f.write(SCRIPT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_find_image_sets(self):
+        image_sets = rsheadless.find_image_sets(
+            self.directory, [('DNA', r'dna_\d\.npy$')], [])
+        self.assertEqual([image_set[0] for image_set in image_sets],
+                         [1, 2, 3])
+        self.assertTrue(image_sets[0][1]['images']['DNA'].endswith(
+            'dna_0.npy'))
+
+    def test_results_are_streamed(self):
+        image_sets = rsheadless.find_image_sets(
+            self.directory, [('DNA', r'dna_\d\.npy$')], [])
+        log = []
+        writer = RecordingWriter(log)
+        rsheadless.run(self.script_path, image_sets, {'log': log},
+                       ['total'], [], writer, 1)
+        self.assertTrue(writer.closed)
+        self.assertEqual([row[0] for row in writer.rows], [1, 2, 3])
+        # each row is written before the next image set runs
+        self.assertEqual([row[1] for row in writer.rows], [1, 2, 3])
+        self.assertEqual([row[2] for row in writer.rows], [20, 40, 60])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''Tests of the cache of data derived from images and objects
+
+Usage: python test/test_memo.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.engine as rsengine
+import runscript_support.memo as rsmemo
+
+
+class TestDerivedDataCache(unittest.TestCase):
+    def setUp(self):
+        labels = np.zeros((10, 10), np.int32)
+        labels[1:4, 1:4] = 1
+        labels[6:9, 2:8] = 2
+        self.images = {
+            'DNA': rsengine.ScriptImage(np.arange(100.0).reshape(10, 10))}
+        self.objects = {'Nuclei': rsengine.ScriptObjects(labels)}
+        self.cache = rsmemo.DerivedDataCache(self.images.__getitem__,
+                                             self.objects.__getitem__)
+        self.calls = []
+
+    def compute(self, objects):
+        self.calls.append(objects)
+        return objects.segmented > 0
+
+    def get_mask(self):
+        return self.cache.get('mask', self.compute,
+                              [(rsmemo.KIND_OBJECTS, 'Nuclei')])
+
+    def test_computed_once(self):
+        first = self.get_mask()
+        second = self.get_mask()
+        self.assertIs(first, second)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_results_are_read_only(self):
+        self.assertFalse(self.get_mask().flags.writeable)
+        statistics = self.cache.statistics('Nuclei', 'DNA')
+        self.assertFalse(statistics.sum.flags.writeable)
+        self.assertFalse(statistics.centroid.flags.writeable)
+        slices = self.cache.find_objects('Nuclei')
+        self.assertIsInstance(slices, tuple)
+        self.assertEqual(slices[0], (slice(1, 4), slice(1, 4)))
+        pixel_indices = self.cache.pixel_indices('Nuclei')
+        self.assertFalse(pixel_indices[1].flags.writeable)
+        # the label matrix of the objects stays writable
+        self.assertTrue(self.objects['Nuclei'].segmented.flags.writeable)
+
+    def test_replaced_objects_are_computed_again(self):
+        self.get_mask()
+        labels = np.zeros((10, 10), np.int32)
+        self.objects['Nuclei'] = rsengine.ScriptObjects(labels)
+        self.assertFalse(self.get_mask().any())
+        self.assertEqual(len(self.calls), 2)
+
+    def test_release(self):
+        self.get_mask()
+        self.cache.statistics('Nuclei', 'DNA')
+        self.cache.release(rsmemo.KIND_IMAGE, 'DNA')
+        self.get_mask()
+        self.assertEqual(len(self.calls), 1)
+        self.cache.release(rsmemo.KIND_OBJECTS, 'Nuclei')
+        self.get_mask()
+        self.assertEqual(len(self.calls), 2)
+        self.cache.clear()
+        self.get_mask()
+        self.assertEqual(len(self.calls), 3)
+
+    def test_statistics(self):
+        statistics = self.cache.statistics('Nuclei', 'DNA')
+        np.testing.assert_array_equal(statistics.count, [9, 18])
+        pixel_data = self.images['DNA'].pixel_data
+        np.testing.assert_array_equal(
+            self.cache.label_sums('Nuclei', 'DNA'),
+            [pixel_data[1:4, 1:4].sum(), pixel_data[6:9, 2:8].sum()])
+        # without an image the statistics are a separate entry
+        self.assertIsNone(self.cache.statistics('Nuclei').sum)
+        np.testing.assert_array_equal(self.cache.label_indexes('Nuclei'),
+                                      [1, 2])
+
+    def test_shared_by_scripts(self):
+        # two scripts of an image set see the same cache
+        rsengine.ensure_cpscript_package()
+        script = compile(
+            'import cellprofiler.cpscript as cpscript\n'
+            'mask = cpscript.derived.mask("Nuclei")\n', 'script', 'exec')
+        attributes = rsengine.make_attributes({
+            'images': {},
+            'objects': {'Nuclei': self.objects['Nuclei'].segmented},
+            'measurements': {},
+            'constants': {},
+        })
+        first = rsengine.ScriptExecutor(script).execute(attributes)
+        second = rsengine.ScriptExecutor(script).execute(attributes)
+        self.assertIs(first['mask'], second['mask'])
+        self.assertFalse(first['mask'].flags.writeable)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+'''Tests of the reduced precision pixel data of RunScript scripts
+
+Usage: python test/test_precision.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.precision as rsprecision
+
+
+class TestPrecision(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        # pixel data as CellProfiler loads it from a 12-bit file
+        self.native = random.randint(0, 4096, size=(30, 40)).astype(np.uint16)
+        self.pixel_data = self.native / 4095.0
+
+    def test_integer_type(self):
+        self.assertEqual(rsprecision.integer_type(255), np.uint8)
+        self.assertEqual(rsprecision.integer_type(4095), np.uint16)
+        self.assertEqual(rsprecision.integer_type(65535), np.uint16)
+
+    def test_to_native(self):
+        native = rsprecision.to_native(self.pixel_data, 4095)
+        self.assertEqual(native.dtype, np.uint16)
+        np.testing.assert_array_equal(native, self.native)
+
+    def test_to_native_in_blocks(self):
+        block_pixels = rsprecision.BLOCK_PIXELS
+        rsprecision.BLOCK_PIXELS = 100
+        try:
+            native = rsprecision.to_native(self.pixel_data, 4095)
+        finally:
+            rsprecision.BLOCK_PIXELS = block_pixels
+        np.testing.assert_array_equal(native, self.native)
+
+    def test_to_float(self):
+        scaled = rsprecision.to_float(self.native, 4095)
+        self.assertEqual(scaled.dtype, np.float32)
+        np.testing.assert_allclose(scaled, self.pixel_data, rtol=1e-6)
+        # round trip
+        np.testing.assert_array_equal(
+            rsprecision.to_native(scaled, 4095), self.native)
+
+    def test_to_float_without_scale(self):
+        self.assertRaises(ValueError, rsprecision.to_float, self.native)
+        single = self.pixel_data.astype(np.float32)
+        self.assertIs(rsprecision.to_float(single), single)
+        mask = self.native > 100
+        self.assertIs(rsprecision.to_float(mask), mask)
+
+    def test_convert_input(self):
+        self.assertIs(rsprecision.convert_input(
+            self.pixel_data, rsprecision.P_DOUBLE, 4095), self.pixel_data)
+        single = rsprecision.convert_input(self.pixel_data,
+                                           rsprecision.P_SINGLE, 4095)
+        self.assertEqual(single.dtype, np.float32)
+        native = rsprecision.convert_input(self.pixel_data,
+                                           rsprecision.P_NATIVE, 4095)
+        np.testing.assert_array_equal(native, self.native)
+        # images that were not loaded from integer files
+        for scale in (None, 1):
+            self.assertEqual(rsprecision.convert_input(
+                self.pixel_data, rsprecision.P_NATIVE, scale).dtype,
+                np.float32)
+            self.assertFalse(rsprecision.is_native(scale))
+        self.assertTrue(rsprecision.is_native(4095))
+        # binary images are kept
+        mask = self.native > 100
+        self.assertIs(rsprecision.convert_input(
+            mask, rsprecision.P_NATIVE, 4095), mask)
+
+
+if __name__ == '__main__':
+    unittest.main()
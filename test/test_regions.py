@@ -0,0 +1,121 @@
+'''Tests of the label statistics against scipy.ndimage
+
+Usage: python test/test_regions.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import scipy.ndimage as nd
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.regions as rsregions
+
+
+def random_labels(shape, nobjects, seed=0):
+    '''Return a random image and a label matrix of rectangles'''
+    random = np.random.RandomState(seed)
+    image = random.uniform(size=shape)
+    labels = np.zeros(shape, np.int32)
+    for number in range(1, nobjects + 1):
+        i = random.randint(0, shape[0] - 4)
+        j = random.randint(0, shape[1] - 4)
+        height, width = random.randint(1, 5, size=2)
+        labels[i:i + height, j:j + width] = number
+    return image, labels
+
+
+class TestLabelStatistics(unittest.TestCase):
+    def assert_matches_ndimage(self, labels, image):
+        statistics = rsregions.label_statistics(labels, image)
+        indexes = np.arange(1, labels.max() + 1)
+        present = statistics.count > 0
+        np.testing.assert_array_equal(statistics.labels, indexes)
+        np.testing.assert_array_equal(
+            statistics.count, nd.sum(np.ones(labels.shape), labels, indexes))
+        np.testing.assert_allclose(
+            statistics.sum, nd.sum(image, labels, indexes))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroid = np.array(nd.center_of_mass(
+                np.ones(labels.shape), labels, indexes))
+            expected = {
+                'mean': nd.mean(image, labels, indexes),
+                'variance': nd.variance(image, labels, indexes),
+            }
+        np.testing.assert_allclose(statistics.centroid[present],
+                                   centroid[present])
+        for name, values in expected.items():
+            np.testing.assert_allclose(getattr(statistics, name)[present],
+                                       values[present], err_msg=name)
+            self.assertTrue(np.all(np.isnan(
+                getattr(statistics, name)[~present])))
+        np.testing.assert_allclose(
+            statistics.minimum[present],
+            nd.minimum(image, labels, indexes[present]))
+        np.testing.assert_allclose(
+            statistics.maximum[present],
+            nd.maximum(image, labels, indexes[present]))
+        slices = nd.find_objects(labels)
+        self.assertEqual(statistics.slices(), slices)
+        return statistics
+
+    def test_random_objects(self):
+        image, labels = random_labels((50, 60), 40)
+        # an object without pixels
+        labels[labels == 3] = 0
+        statistics = self.assert_matches_ndimage(labels, image)
+        self.assertEqual(statistics.count[2], 0)
+
+    def test_3d(self):
+        image = np.random.RandomState(0).uniform(size=(6, 20, 20))
+        labels = np.zeros(image.shape, np.int32)
+        labels[1:3, 2:5, 4:9] = 1
+        labels[4:6, 10:20, 0:3] = 3
+        statistics = self.assert_matches_ndimage(labels, image)
+        self.assertEqual(statistics.centroid.shape, (3, 3))
+
+    def test_without_image(self):
+        image, labels = random_labels((30, 30), 10)
+        statistics = rsregions.label_statistics(labels)
+        self.assertIsNone(statistics.sum)
+        self.assertIsNone(statistics.mean)
+        self.assertEqual(len(statistics), labels.max())
+
+    def test_nobjects(self):
+        image, labels = random_labels((30, 30), 10)
+        nobjects = 5
+        statistics = rsregions.label_statistics(labels, image, nobjects)
+        self.assertEqual(len(statistics), nobjects)
+        # labels above nobjects are background
+        kept = np.where(labels <= nobjects, labels, 0)
+        expected = rsregions.label_statistics(kept, image)
+        np.testing.assert_array_equal(statistics.count,
+                                      expected.count[:nobjects])
+        np.testing.assert_allclose(statistics.sum, expected.sum[:nobjects])
+        # more objects than labels give objects without pixels
+        statistics = rsregions.label_statistics(labels, image, 15)
+        self.assertEqual(len(statistics), 15)
+        self.assertTrue(np.all(statistics.count[10:] == 0))
+        self.assertTrue(np.all(statistics.bbox_min[10:] == -1))
+
+    def test_empty(self):
+        labels = np.zeros((5, 5), np.int32)
+        statistics = rsregions.label_statistics(labels, np.ones((5, 5)))
+        self.assertEqual(len(statistics), 0)
+        self.assertEqual(statistics.slices(), [])
+
+    def test_shape_mismatch(self):
+        self.assertRaises(ValueError, rsregions.label_statistics,
+                          np.zeros((5, 5), int), np.zeros((4, 5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
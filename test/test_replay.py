@@ -0,0 +1,76 @@
+'''Tests of the capture and replay of RunScript scripts
+
+Usage: python test/test_replay.py
+
+Only numpy is needed, the replay tool runs without CellProfiler.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.replay as rsreplay
+
+SCRIPT = '''
+import cellprofiler.cpscript as cpscript
+doubled = cpscript.images['DNA'].pixel_data * 2
+'''
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        pixel_data = np.random.RandomState(0).uniform(size=(20, 30))
+        inputs = {
+            'images': {'DNA': (pixel_data, None)},
+            'objects': {},
+            'measurements': {},
+            'constants': {},
+            'read_only': True,
+        }
+        self.path = rsreplay.capture_path(self.directory, 1, 1)
+        rsreplay.write_capture(self.path, inputs, {'doubled': pixel_data * 2},
+                               SCRIPT, ['doubled'], 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_capture(self):
+        capture = rsreplay.read_capture(self.path)
+        pixel_data, mask = capture['inputs']['images']['DNA']
+        self.assertEqual(pixel_data.shape, (20, 30))
+        self.assertIsNone(mask)
+        self.assertFalse(pixel_data.flags.writeable)
+        np.testing.assert_array_equal(capture['outputs']['doubled'],
+                                      pixel_data * 2)
+
+    def test_command_line(self):
+        # run as a module, the way the documentation shows it
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            [PLUGIN_DIR, ROOT_DIR] +
+            filter(None, [environment.get('PYTHONPATH')]))
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'runscript_support.replay',
+             self.directory, '--repeat', '3', '--check'],
+            cwd=PLUGIN_DIR, env=environment,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        self.assertIn('outputs match', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+'''Tests of the sparse representations of objects
+
+Usage: python test/test_sparse.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.engine as rsengine
+import runscript_support.sparse as rssparse
+
+
+def make_labels():
+    labels = np.zeros((6, 8), np.int32)
+    labels[0, 0:3] = 1
+    labels[1:3, 5:8] = 2
+    labels[4, 1] = 4
+    labels[4, 2:4] = 2
+    # an object touching the right border
+    labels[5, 6:8] = 1
+    return labels
+
+
+class TestSparse(unittest.TestCase):
+    def setUp(self):
+        self.labels = make_labels()
+
+    def test_ijv(self):
+        ijv = rssparse.ijv(self.labels)
+        self.assertEqual(ijv.shape, (int((self.labels > 0).sum()), 3))
+        np.testing.assert_array_equal(ijv[:3], [[0, 0, 1], [0, 1, 1],
+                                                [0, 2, 1]])
+        np.testing.assert_array_equal(
+            rssparse.from_ijv(ijv, self.labels.shape).segmented, self.labels)
+        # objects and sparse objects give the same ijv
+        np.testing.assert_array_equal(
+            rssparse.ijv(rsengine.ScriptObjects(self.labels)), ijv)
+        np.testing.assert_array_equal(
+            rssparse.ijv(rssparse.from_ijv(ijv, self.labels.shape)), ijv)
+
+    def test_rle(self):
+        runs = rssparse.rle(self.labels)
+        np.testing.assert_array_equal(runs, [
+            [0, 0, 3, 1],
+            [1, 5, 3, 2],
+            [2, 5, 3, 2],
+            [4, 1, 1, 4],
+            [4, 2, 2, 2],
+            [5, 6, 2, 1]])
+        objects = rssparse.from_rle(runs, self.labels.shape)
+        np.testing.assert_array_equal(objects.segmented, self.labels)
+        np.testing.assert_array_equal(objects.ijv, rssparse.ijv(self.labels))
+
+    def test_random_round_trips(self):
+        random = np.random.RandomState(0)
+        for shape in ((1, 1), (1, 20), (20, 1), (17, 23)):
+            labels = random.randint(0, 4, size=shape).astype(np.int32)
+            np.testing.assert_array_equal(
+                rssparse.from_rle(rssparse.rle(labels), shape).segmented,
+                labels)
+            np.testing.assert_array_equal(
+                rssparse.from_ijv(rssparse.ijv(labels), shape).segmented,
+                labels)
+
+    def test_pixel_indices(self):
+        indices = rssparse.pixel_indices(self.labels)
+        self.assertEqual(len(indices), 4)
+        for number, object_indices in enumerate(indices):
+            np.testing.assert_array_equal(
+                object_indices, np.flatnonzero(self.labels == number + 1))
+        # object 3 has no pixels
+        self.assertEqual(len(indices[2]), 0)
+
+    def test_empty(self):
+        labels = np.zeros((3, 4), np.int32)
+        self.assertEqual(rssparse.ijv(labels).shape, (0, 3))
+        self.assertEqual(rssparse.rle(labels).shape, (0, 4))
+        self.assertEqual(rssparse.pixel_indices(labels), [])
+        objects = rssparse.from_rle(rssparse.rle(labels), labels.shape)
+        self.assertEqual(objects.count, 0)
+        np.testing.assert_array_equal(objects.segmented, labels)
+
+    def test_overlapping_objects(self):
+        ijv = [[0, 0, 1], [0, 1, 1], [0, 1, 2], [1, 1, 2]]
+        objects = rssparse.from_ijv(ijv, (2, 2))
+        self.assertEqual(objects.count, 2)
+        # the shared pixel keeps both objects in the ijv form
+        np.testing.assert_array_equal(rssparse.ijv(objects), ijv)
+        np.testing.assert_array_equal(objects.segmented, [[1, 2], [0, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+'''Tests of the tiled execution of RunScript scripts
+
+Usage: python test/test_tiling.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+PLUGIN_DIR = os.path.join(ROOT_DIR, 'plugins')
+for path in (PLUGIN_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import runscript_support.regions as rsregions
+import runscript_support.tiling as rstiling
+
+
+def make_labels():
+    '''Return a label matrix with squares in each quadrant and between'''
+    labels = np.zeros((20, 30), np.int32)
+    for number, (i, j) in enumerate([(2, 2), (2, 20), (12, 4), (12, 22),
+                                     (8, 13)]):
+        labels[i:i + 4, j:j + 4] = number + 1
+    return labels
+
+
+class TestTiles(unittest.TestCase):
+    def test_make_tiles(self):
+        tiles = rstiling.make_tiles((20, 30, 3), 16, 4)
+        self.assertEqual(len(tiles), 4)
+        self.assertEqual([tile.index for tile in tiles], [0, 1, 2, 3])
+        # the cores cover the image exactly once
+        covered = np.zeros((20, 30), int)
+        for tile in tiles:
+            covered[tile.core] += 1
+        self.assertTrue(np.all(covered == 1))
+        last = tiles[-1]
+        self.assertEqual(last.core, (slice(16, 20), slice(16, 30)))
+        self.assertEqual(last.window, (slice(12, 20), slice(12, 30)))
+        self.assertEqual(last.inner, (slice(4, 8), slice(4, 18)))
+        self.assertEqual(last.offset, (12, 12))
+        np.testing.assert_array_equal(
+            last.contains([[16, 16], [15, 16], [19, 29], [20, 29]]),
+            [True, False, True, False])
+
+    def test_crop_inputs(self):
+        pixel_data = np.arange(600.0).reshape(20, 30)
+        mask = pixel_data > 100
+        inputs = {
+            'images': {'DNA': (pixel_data, mask), 'Actin': (pixel_data, None)},
+            'objects': {'Nuclei': make_labels()},
+            'measurements': {'Image_Count': 5},
+            'constants': {'threshold': 0.5},
+        }
+        tile = rstiling.make_tiles((20, 30), 16, 4)[1]
+        cropped = rstiling.crop_inputs(inputs, tile)
+        self.assertIs(cropped['tile'], tile)
+        cropped_pixels, cropped_mask = cropped['images']['DNA']
+        np.testing.assert_array_equal(cropped_pixels,
+                                      pixel_data[0:20, 12:30])
+        np.testing.assert_array_equal(cropped_mask, mask[0:20, 12:30])
+        self.assertIsNone(cropped['images']['Actin'][1])
+        # views of the window, not copies
+        self.assertTrue(np.may_share_memory(cropped_pixels, pixel_data))
+        self.assertEqual(cropped['objects']['Nuclei'].shape, (20, 18))
+        self.assertIs(cropped['measurements'], inputs['measurements'])
+        self.assertNotIn('tile', inputs)
+
+    def test_owned_labels(self):
+        labels = make_labels()
+        tiles = rstiling.make_tiles(labels.shape, 15, 3)
+        owned = [rstiling.owned_labels(labels[tile.window], tile,
+                                       tile.offset).tolist()
+                 for tile in tiles]
+        # each object belongs to exactly one tile
+        self.assertEqual(sorted(sum(owned, [])), [1, 2, 3, 4, 5])
+        # the centroids of objects 3 and 4 lie in row 13 of the upper tiles
+        self.assertEqual(owned, [[1, 3, 5], [2, 4], [], []])
+
+
+class TestTileStitcher(unittest.TestCase):
+    def setUp(self):
+        self.labels = make_labels()
+        self.pixel_data = np.random.RandomState(0).uniform(size=(20, 30))
+        self.tiles = rstiling.make_tiles(self.labels.shape, 15, 5)
+        self.stitcher = rstiling.TileStitcher(self.tiles, self.labels.shape)
+
+    def test_images(self):
+        for tile in self.tiles:
+            self.stitcher.add_image('Doubled', tile,
+                                    self.pixel_data[tile.window] * 2)
+        np.testing.assert_array_equal(self.stitcher.images['Doubled'],
+                                      self.pixel_data * 2)
+        self.assertRaises(ValueError, self.stitcher.add_image, 'Doubled',
+                          self.tiles[0], self.pixel_data)
+
+    def test_objects(self):
+        # each tile segments the objects in its window
+        for tile in self.tiles:
+            self.stitcher.add_objects('Cells', tile, self.labels[tile.window])
+        stitched = self.stitcher.objects['Cells']
+        self.assertTrue(self.stitcher.has_objects('Cells'))
+        self.assertEqual(stitched.max(), 5)
+        # the objects are renumbered but keep their pixels
+        np.testing.assert_array_equal(stitched > 0, self.labels > 0)
+        pairs = set(zip(self.labels[self.labels > 0],
+                        stitched[self.labels > 0]))
+        self.assertEqual(len(pairs), 5)
+
+    def test_merge_values(self):
+        for tile in self.tiles:
+            self.stitcher.add_objects('Cells', tile, self.labels[tile.window])
+        # each tile measures all objects in its window, including those
+        # that are cut or owned by other tiles
+        values_per_tile = []
+        for tile in self.tiles:
+            statistics = rsregions.label_statistics(
+                self.labels[tile.window], self.pixel_data[tile.window])
+            values_per_tile.append(statistics.sum)
+        merged = self.stitcher.merge_values('Cells', values_per_tile)
+        expected = rsregions.label_statistics(
+            self.stitcher.objects['Cells'], self.pixel_data).sum
+        np.testing.assert_allclose(merged, expected)
+
+    def test_merge_input_objects(self):
+        # input objects keep their numbers
+        self.stitcher.assign_objects('Nuclei', self.labels)
+        values_per_tile = [
+            rsregions.label_statistics(self.labels[tile.window]).count
+            for tile in self.tiles]
+        merged = self.stitcher.merge_values('Nuclei', values_per_tile)
+        np.testing.assert_array_equal(merged, [16] * 5)
+        tables = [{'Area': values,
+                   'Number': np.arange(1, len(values) + 1)}
+                  for values in values_per_tile]
+        merged = self.stitcher.merge_tables('Nuclei', tables)
+        self.assertEqual(sorted(merged), ['Area', 'Number'])
+        np.testing.assert_array_equal(merged['Number'], [1, 2, 3, 4, 5])
+        structured = [np.array(zip(values), dtype=[('Area', float)])
+                      for values in values_per_tile]
+        merged = self.stitcher.merge_tables('Nuclei', structured)
+        np.testing.assert_array_equal(merged['Area'], [16] * 5)
+
+    def test_missing_values(self):
+        self.stitcher.assign_objects('Nuclei', self.labels)
+        values_per_tile = [[] for tile in self.tiles]
+        self.assertRaises(ValueError, self.stitcher.merge_values, 'Nuclei',
+                          values_per_tile)
+
+
+if __name__ == '__main__':
+    unittest.main()